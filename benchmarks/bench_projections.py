@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Memory and construction time of listing rows as active records against projections
+
+Needs no database, the objects are built from synthetic rows the way the listings build them.
+Run `PYTHONPATH=rses/src python benchmarks/bench_projections.py [rows]`, results are printed as JSON.
+"""
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+from objects.projections import IngredientRow
+from objects.stock import Ingredient, IngredientType
+
+
+def synthetic_rows(count: int) -> List[tuple]:
+    """Rows as returned by the ingredient listing query"""
+    return [(i, f'Ingredient {i}', 'g', i % 50 + 1, f'Type {i % 50 + 1}', 1.0, 0.5, 30) for i in range(1, count + 1)]
+
+
+def as_active_records(rows: List[tuple]) -> List[Any]:
+    """What the listing built before projections, with the type object it needs for json_dict"""
+    return [Ingredient(ingredient_id=row[0], name=row[1], unit=row[2],
+                       ingredient_type=IngredientType(ingredient_type_id=row[3], name=row[4]),
+                       suggestion_threshold=row[5], rebuy_threshold=row[6], durability=row[7]) for row in rows]
+
+
+def as_projections(rows: List[tuple]) -> List[Any]:
+    return [IngredientRow(*row) for row in rows]
+
+
+def measure(build: Callable[[List[tuple]], List[Any]], rows: List[tuple], repeat: int = 5) -> Dict[str, float]:
+    """Best construction and serialization time of all the rows and memory they take"""
+    build_times = list()
+    json_times = list()
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        built = build(rows)
+        build_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        [item.json_dict for item in built]
+        json_times.append(time.perf_counter() - start)
+        del built
+    gc.collect()
+    tracemalloc.start()
+    built = build(rows)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    return dict(build_seconds=min(build_times), json_seconds=min(json_times), bytes_per_row=memory / len(rows))
+
+
+def run(count: int = 100000) -> Dict[str, Dict[str, float]]:
+    rows = synthetic_rows(count)
+    return dict(active_record=measure(as_active_records, rows), projection=measure(as_projections, rows))
+
+
+if __name__ == '__main__':
+    print(json.dumps(run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000), indent=2))
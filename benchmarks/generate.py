@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Seeds the database with a synthetic kitchen for benchmarks, the same for the same scale and seed
+
+Everything in the database is replaced! Point RSES_DB_URL at a database made for benchmarking and run
+`PYTHONPATH=rses/src python benchmarks/generate.py --scale small`. Rows are generated lazily
+and loaded with COPY in chunks, so even the large scale needs little memory.
+"""
+import argparse
+import datetime
+import itertools
+import logging
+import random
+import sys
+import time
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+from psycopg2 import sql
+
+from rses_connections import db, copy_rows
+from rses_invalidation import bus, EVERYTHING
+from objects.forecasting import ConsumptionForecaster
+from objects.ledger import StockLedger
+from objects.pricing import DealDetector
+from objects.recommendation import recommender
+
+log = logging.getLogger(__name__)
+
+# Rows loaded in one COPY
+CHUNK: int = 50000
+# Generated history ends here, so the data does not depend on when it was generated
+END: datetime.datetime = datetime.datetime(2018, 1, 1)
+WORDS = (
+    'boil', 'bake', 'fry', 'chop', 'stir', 'mix', 'whisk', 'simmer', 'season', 'serve', 'roast', 'grill', 'pour',
+    'slice', 'dice', 'knead', 'rest', 'cover', 'drain', 'melt', 'butter', 'flour', 'sugar', 'salt', 'pepper',
+    'onion', 'garlic', 'potatoes', 'dough', 'sauce', 'soup', 'pan', 'oven', 'bowl', 'minutes', 'until', 'golden',
+    'soft', 'crispy', 'gently', 'quickly', 'hot', 'cold', 'fresh', 'dumplings', 'cabbage', 'pork', 'cream',
+)
+
+
+class Scale(NamedTuple):
+    """How big the generated kitchen is"""
+    ingredient_types: int
+    ingredients: int
+    stock_lots: int
+    recipes: int
+    ingredients_per_recipe: int
+    categories: int
+    recipes_made: int
+    history_days: int
+
+
+SCALES = dict(
+    tiny=Scale(10, 200, 5000, 300, 6, 10, 2000, 90),
+    small=Scale(50, 2000, 200000, 2000, 8, 20, 50000, 365),
+    medium=Scale(100, 5000, 1000000, 10000, 8, 30, 300000, 730),
+    large=Scale(200, 10000, 5000000, 20000, 10, 50, 2000000, 1095),
+)
+# Referencing tables come first, so they can be truncated together
+TABLES = (
+    'stock_snapshot_amount', 'stock_snapshot', 'stock_ledger', 'price_sketch', 'consumption_forecast',
+    'shopping_list', 'recipe_stats', 'recipe_made', 'recipe_ingredients', 'categorized_recipes', 'recipe_category',
+    'recipe', 'stock', 'ingredient', 'ingredient_type',
+)
+
+
+class KitchenGenerator:
+    """Generates the rows of every table from a seeded random generator, table by table"""
+
+    def __init__(self, scale: Scale, seed: int = 42) -> None:
+        """
+        :param scale:   How many rows of what
+        :param seed:    Same seed and scale always generate the same kitchen
+        """
+        self.scale: Scale = scale
+        self.seed: int = seed
+
+    def __str__(self):
+        return f'Kitchen generator of {self.scale}'
+
+    def __repr__(self):
+        return f'KitchenGenerator(scale={self.scale}, seed={self.seed})'
+
+    def generate(self) -> None:
+        """Replaces everything in the database with the generated kitchen"""
+        started = time.monotonic()
+        db.run_transaction(lambda cur: cur.execute(sql.SQL('TRUNCATE {} RESTART IDENTITY').format(
+            sql.SQL(', ').join(sql.Identifier(table) for table in TABLES)
+        )))
+        self.__load('ingredient_type', ('id', 'name'), self.ingredient_types())
+        self.__load('ingredient', ('id', 'name', 'unit', 'ingredient_type', 'suggestion_threshold',
+                                   'rebuy_threshold', 'durability'), self.ingredients())
+        self.__load('stock', ('ingredient', 'amount', 'amount_left', 'expiration_date', 'time_bought', 'price'),
+                    self.stock())
+        self.__load('recipe', ('id', 'name', 'directions', 'prepare_time', 'portions'), self.recipes())
+        self.__load('recipe_category', ('id', 'name'), self.categories())
+        self.__load('recipe_ingredients', ('recipe', 'ingredient', 'amount'), self.recipe_ingredients())
+        self.__load('categorized_recipes', ('recipe', 'category'), self.categorized_recipes())
+        self.__load('recipe_made', ('recipe', 'time_made', 'portions', 'price'), self.recipes_made())
+        self.__load('shopping_list', ('ingredient', 'wanted_amount'), self.shopping_list())
+        db.run_transaction(_reset_sequences)
+        log.info('Building derived data')
+        recommender.rebuild_stats()
+        DealDetector.rebuild()
+        ConsumptionForecaster().refresh(END.date())
+        StockLedger.backfill()
+        StockLedger.snapshot()
+        db.run_transaction(lambda cur: cur.execute('ANALYZE'))
+        bus.publish(EVERYTHING)
+        log.info('Generated %s in %.1fs', self.scale, time.monotonic() - started)
+
+    def ingredient_types(self) -> Iterator[tuple]:
+        for index in range(1, self.scale.ingredient_types + 1):
+            yield index, f'Type {index:04d}'
+
+    def ingredients(self) -> Iterator[tuple]:
+        rng = self.__rng('ingredient')
+        for index in range(1, self.scale.ingredients + 1):
+            threshold = rng.choice((0.0, 0.0, 1.0, 2.0, 5.0))
+            yield (index, f'Ingredient {index:05d}', rng.choice(('g', 'kg', 'ml', 'l', 'pcs')),
+                   rng.randint(1, self.scale.ingredient_types), threshold * 2, threshold,
+                   rng.choice((None, 3, 7, 30, 365)))
+
+    def stock(self) -> Iterator[tuple]:
+        rng = self.__rng('stock')
+        for _ in range(self.scale.stock_lots):
+            bought = self.__time(rng)
+            amount = float(rng.randint(1, 20))
+            # Most of the history is used up
+            left = 0.0 if rng.random() < 0.8 else round(amount * rng.random(), 2)
+            expiration = (bought + datetime.timedelta(days=rng.randint(3, 400))).date() if rng.random() < 0.5 else None
+            price = round(amount * rng.uniform(0.5, 50.0), 2) if rng.random() < 0.9 else None
+            yield self.__ingredient(rng), amount, left, expiration, bought, price
+
+    def recipes(self) -> Iterator[tuple]:
+        rng = self.__rng('recipe')
+        for index in range(1, self.scale.recipes + 1):
+            directions = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 120)))
+            yield index, f'Recipe {index:05d}', directions, rng.randint(5, 180), rng.randint(1, 8)
+
+    def categories(self) -> Iterator[tuple]:
+        for index in range(1, self.scale.categories + 1):
+            yield index, f'Category {index:03d}'
+
+    def recipe_ingredients(self) -> Iterator[tuple]:
+        rng = self.__rng('recipe_ingredients')
+        for recipe in range(1, self.scale.recipes + 1):
+            count = min(rng.randint(2, self.scale.ingredients_per_recipe * 2 - 2), self.scale.ingredients)
+            for ingredient in sorted(set(self.__ingredient(rng) for _ in range(count))):
+                yield recipe, ingredient, round(rng.uniform(0.1, 3.0), 2)
+
+    def categorized_recipes(self) -> Iterator[tuple]:
+        rng = self.__rng('categorized_recipes')
+        for recipe in range(1, self.scale.recipes + 1):
+            for category in sorted(set(rng.randint(1, self.scale.categories) for _ in range(rng.randint(0, 3)))):
+                yield recipe, category
+
+    def recipes_made(self) -> Iterator[tuple]:
+        rng = self.__rng('recipe_made')
+        for _ in range(self.scale.recipes_made):
+            # Favourites are cooked a lot more often than the rest
+            recipe = _skewed(rng, self.scale.recipes)
+            yield recipe, self.__time(rng), rng.randint(1, 8), round(rng.uniform(20, 500), 2)
+
+    def shopping_list(self) -> Iterator[tuple]:
+        rng = self.__rng('shopping_list')
+        for ingredient in sorted(rng.sample(range(1, self.scale.ingredients + 1), self.scale.ingredients // 50)):
+            yield ingredient, float(rng.randint(1, 10))
+
+    def __rng(self, table: str) -> random.Random:
+        """Own generator of every table, so changing one table does not change the others"""
+        return random.Random(f'{self.seed}:{table}')
+
+    def __time(self, rng: random.Random) -> datetime.datetime:
+        return END - datetime.timedelta(seconds=rng.randint(0, self.scale.history_days * 86400))
+
+    def __ingredient(self, rng: random.Random) -> int:
+        """Popular ingredients are used a lot more often than the rest"""
+        return _skewed(rng, self.scale.ingredients)
+
+    @staticmethod
+    def __load(table: str, columns: Sequence[str], rows: Iterable[tuple]) -> None:
+        rows = iter(rows)
+        total = 0
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK))
+            if not chunk:
+                break
+            total += db.run_transaction(lambda cur: copy_rows(cur, table, columns, chunk))
+        log.info('Loaded %s rows into %s', total, table)
+
+
+def _skewed(rng: random.Random, count: int) -> int:
+    """Id between 1 and count, low ids are picked a lot more often"""
+    return int(count * rng.random() ** 2) + 1
+
+
+def _reset_sequences(cur) -> None:
+    """Moves the id sequences past the generated ids"""
+    for table in ('ingredient_type', 'ingredient', 'recipe', 'recipe_category'):
+        cur.execute(sql.SQL('SELECT setval(pg_get_serial_sequence(%s, %s), max(id)) FROM {}').format(
+            sql.Identifier(table)
+        ), (table, 'id'))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Replace the database with a synthetic kitchen for benchmarks')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small', help='How big the kitchen is')
+    parser.add_argument('--seed', type=int, default=42, help='Same seed generates the same kitchen')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    KitchenGenerator(SCALES[args.scale], args.seed).generate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
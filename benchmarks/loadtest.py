@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Drives the API with concurrent households shopping, cooking and browsing, to find where it saturates
+
+Seed a database with `benchmarks/generate.py`, start the app on it (any worker model) and run
+`python benchmarks/loadtest.py --url http://127.0.0.1:5000 --households 5 10 20 40 --duration 30`.
+Every household logs in for its own session and runs scenarios picked by `--mix`, with a random think
+time between requests. Each stage of households reports throughput, error rate and per route latency
+percentiles and database queries per request (from the X-RSES-Queries header of the API).
+Needs nothing but the standard library, the clients are plain asyncio streams.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+API: str = '/rses/api'
+SEARCH_TEXTS = ('boil', 'potatoes', 'golden crispy', 'cream sauce', 'dough rest', 'fresh garlic')
+
+
+class Response(NamedTuple):
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+
+
+class Sample(NamedTuple):
+    """One request as measured by the client"""
+    route: str
+    status: int
+    seconds: float
+    queries: Optional[int]
+
+
+class HttpClient:
+    """Minimal HTTP/1.1 client over one connection, reconnecting when the server closes it"""
+
+    def __init__(self, host: str, port: int) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.cookies: Dict[str, str] = dict()
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    def __str__(self):
+        return f'HTTP client of {self.host}:{self.port}'
+
+    def __repr__(self):
+        return f'HttpClient(host={self.host}, port={self.port})'
+
+    async def request(self, method: str, path: str, body: bytes = b'',
+                      content_type: str = 'application/json') -> Response:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        headers = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', f'Content-Length: {len(body)}']
+        if body:
+            headers.append(f'Content-Type: {content_type}')
+        if self.cookies:
+            headers.append('Cookie: ' + '; '.join(f'{name}={value}' for name, value in self.cookies.items()))
+        self._writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode() + body)
+        try:
+            return await self.__read_response()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            await self.close()
+            raise
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = self._reader = None
+
+    async def __read_response(self) -> Response:
+        status_line = (await self._reader.readuntil(b'\r\n')).decode('latin-1')
+        version, status = status_line.split(' ', 2)[:2]
+        headers = dict()
+        while True:
+            line = (await self._reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name == 'set-cookie':
+                cookie_name, cookie_value = value.strip().split(';', 1)[0].split('=', 1)
+                self.cookies[cookie_name] = cookie_value
+            headers[name] = value.strip()
+        if 'content-length' in headers:
+            body = await self._reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self._reader.read()
+        if version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close' \
+                or 'content-length' not in headers:
+            await self.close()
+        return Response(int(status), headers, body)
+
+
+class Household:
+    """One logged in client running scenarios, recording every request it makes"""
+
+    def __init__(self, client: HttpClient, rng: random.Random, ingredients: int, think: float,
+                 samples: List[Sample]) -> None:
+        """
+        :param client:      Connection of the household, with its own session
+        :param rng:         Seeded generator of what the household does
+        :param ingredients: Ids of ingredients go from 1 to this
+        :param think:       Mean pause between requests in seconds
+        :param samples:     Where measured requests go
+        """
+        self.client: HttpClient = client
+        self.rng: random.Random = rng
+        self.ingredients: int = ingredients
+        self.think: float = think
+        self.samples: List[Sample] = samples
+
+    def __str__(self):
+        return f'Household on {self.client}'
+
+    def __repr__(self):
+        return f'Household(client={self.client!r}, think={self.think})'
+
+    async def login(self, password: str) -> None:
+        body = urllib.parse.urlencode(dict(password=password)).encode()
+        await self.client.request('POST', '/rses/authorize', body, 'application/x-www-form-urlencoded')
+        if 'session' not in self.client.cookies:
+            raise RuntimeError('Login failed, is --password the RSES_MASTER_PASSWORD of the app?')
+
+    async def call(self, route: str, method: str, path: str, payload: Any = None) -> Optional[Any]:
+        """Requests path, recorded under the route, returns the parsed JSON body of a successful response"""
+        if self.think:
+            await asyncio.sleep(self.rng.expovariate(1 / self.think))
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode() if payload else b''
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, API + path, body)
+        except (OSError, asyncio.IncompleteReadError):
+            self.samples.append(Sample(route, 0, time.perf_counter() - start, None))
+            return None
+        queries = response.headers.get('x-rses-queries')
+        self.samples.append(Sample(route, response.status, time.perf_counter() - start,
+                                   int(queries) if queries is not None else None))
+        if response.status >= 400:
+            return None
+        try:
+            return json.loads(response.body)
+        except ValueError:
+            return None
+
+    def ingredient(self) -> int:
+        # Like in the generated kitchen, popular ingredients are used a lot more often
+        return int(self.ingredients * self.rng.random() ** 2) + 1
+
+    async def browse(self) -> None:
+        """Looks through ingredients and recipes"""
+        page = self.rng.randint(0, 5) * 50
+        await self.call('GET /list/ingredient_type', 'GET', '/list/ingredient_type/50/0')
+        await self.call('GET /list/total/ingredient', 'GET', '/list/total/ingredient')
+        await self.call('GET /list/ingredient', 'GET', f'/list/ingredient/50/{page}')
+        name = urllib.parse.quote(f'ingredient {self.rng.randint(0, 99):02d}')
+        await self.call('GET /list/ingredient?name', 'GET', f'/list/ingredient/50/0?name={name}')
+        text = urllib.parse.quote(self.rng.choice(SEARCH_TEXTS))
+        await self.call('GET /search/recipe', 'GET', f'/search/recipe/20/0?q={text}')
+        await self.call('GET /stock/history', 'GET', f'/stock/history/{self.ingredient()}/20')
+
+    async def shop(self) -> None:
+        """Checks what to buy and whether it is a deal, then brings home the receipt"""
+        await self.call('GET /forecast', 'GET', '/forecast/7')
+        cart = [dict(ingredient=self.ingredient(), price=round(self.rng.uniform(1, 100), 2),
+                     amount=self.rng.randint(1, 10)) for _ in range(self.rng.randint(3, 15))]
+        await self.call('GET /deal', 'GET', f"/deal/{cart[0]['ingredient']}?price={cart[0]['price']}")
+        await self.call('POST /deal/cart', 'POST', '/deal/cart', cart)
+        receipt = '\n'.join(json.dumps(dict(ingredient=f"Ingredient {item['ingredient']:05d}", amount=item['amount'],
+                                            price=item['price'])) for item in cart)
+        await self.call('POST /import/stock', 'POST', '/import/stock', receipt)
+
+    async def cook(self) -> None:
+        """Decides what to cook from what is in stock"""
+        await self.call('GET /plan', 'GET', f'/plan/7/{self.rng.randint(1, 4)}')
+        mode = self.rng.choice(('forgotten', 'favourites'))
+        await self.call('GET /recommend/recipe', 'GET', f'/recommend/recipe/{mode}/10?cookable=true')
+        await self.call('GET /stock/at', 'GET', '/stock/at/' + time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+
+SCENARIOS: Dict[str, Callable[[Household], Awaitable[None]]] = dict(
+    browse=Household.browse, shop=Household.shop, cook=Household.cook,
+)
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Weights of scenarios written as browse=6,shop=2,cook=2"""
+    mix = dict()
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f'Unknown scenario {name}, pick from {", ".join(SCENARIOS)}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+def summarize(samples: List[Sample], seconds: float) -> Dict[str, Any]:
+    """Throughput, error rate and latencies overall and per route"""
+    by_route: Dict[str, List[Sample]] = defaultdict(list)
+    for sample in samples:
+        by_route[sample.route].append(sample)
+    routes = dict()
+    for route, route_samples in sorted(by_route.items()):
+        times = sorted(sample.seconds for sample in route_samples)
+        counted = [sample.queries for sample in route_samples if sample.queries is not None]
+        routes[route] = dict(
+            requests=len(route_samples), errors=sum(1 for sample in route_samples if not 0 < sample.status < 400),
+            p50_ms=percentile(times, 0.5) * 1000, p95_ms=percentile(times, 0.95) * 1000,
+            p99_ms=percentile(times, 0.99) * 1000,
+            queries=sum(counted) / len(counted) if counted else None,
+        )
+    errors = sum(route['errors'] for route in routes.values())
+    return dict(seconds=seconds, requests=len(samples), throughput=len(samples) / seconds if seconds else 0.0,
+                error_rate=errors / len(samples) if samples else 0.0, routes=routes)
+
+
+async def run_stage(host: str, port: int, households: int, duration: float, mix: Dict[str, float], think: float,
+                    password: str, ingredients: int, seed: int) -> Dict[str, Any]:
+    """Runs the households for the duration, returns the summary of what they measured"""
+    samples: List[Sample] = list()
+    deadline = time.monotonic() + duration
+    names, weights = list(mix), list(mix.values())
+
+    async def live(index: int) -> None:
+        household = Household(HttpClient(host, port), random.Random(seed * 1000 + index), ingredients, think,
+                              samples)
+        try:
+            await household.login(password)
+            while time.monotonic() < deadline:
+                await SCENARIOS[household.rng.choices(names, weights)[0]](household)
+        finally:
+            await household.client.close()
+
+    start = time.monotonic()
+    await asyncio.gather(*(live(index) for index in range(households)))
+    summary = summarize(samples, time.monotonic() - start)
+    summary['households'] = households
+    return summary
+
+
+async def count_ingredients(host: str, port: int, password: str) -> int:
+    household = Household(HttpClient(host, port), random.Random(0), 0, 0.0, list())
+    await household.login(password)
+    found = await household.call('total', 'GET', '/list/total/ingredient')
+    await household.client.close()
+    if not found or not found['total']:
+        raise RuntimeError('No ingredients, seed the database with benchmarks/generate.py first')
+    return found['total']
+
+
+def print_stage(summary: Dict[str, Any]) -> None:
+    print(f"{summary['households']} households: {summary['throughput']:.1f} req/s, "
+          f"{summary['error_rate'] * 100:.2f}% errors")
+    for route, stats in summary['routes'].items():
+        queries = f"{stats['queries']:.1f}" if stats['queries'] is not None else '-'
+        print(f"  {route:<30} {stats['requests']:>7} p50 {stats['p50_ms']:8.1f}ms p95 {stats['p95_ms']:8.1f}ms "
+              f"p99 {stats['p99_ms']:8.1f}ms queries {queries:>5} errors {stats['errors']}")
+
+
+async def load_test(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    url = urllib.parse.urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+    ingredients = await count_ingredients(host, port, args.password)
+    stages = list()
+    for households in args.households:
+        summary = await run_stage(host, port, households, args.duration, args.mix, args.think, args.password,
+                                  ingredients, args.seed)
+        print_stage(summary)
+        stages.append(summary)
+    return stages
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Load test the API with concurrent households')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='Where the app runs')
+    parser.add_argument('--password', default='kitchen', help='RSES_MASTER_PASSWORD of the app')
+    parser.add_argument('--households', type=int, nargs='+', default=[10],
+                        help='Concurrent households, one stage for each number, to find the saturation point')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds each stage runs')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('browse=6,shop=2,cook=2'),
+                        help='Weights of the scenarios, browse=6,shop=2,cook=2 by default')
+    parser.add_argument('--think', type=float, default=0.5, help='Mean pause between requests in seconds')
+    parser.add_argument('--seed', type=int, default=42, help='Same seed makes the households do the same')
+    parser.add_argument('--output', help='Write the results of all stages as JSON into this file')
+    args = parser.parse_args(argv)
+    stages = asyncio.get_event_loop().run_until_complete(load_test(args))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(dict(url=args.url, mix=args.mix, think=args.think, stages=stages), file, indent=2)
+    return 0 if all(stage['error_rate'] < 0.01 for stage in stages) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Times the hot paths against a generated kitchen and compares the results between commits
+
+Seed the database with `benchmarks/generate.py` first (cooking and taking stock change it, so seed again
+before every run that should be compared), then run
+`PYTHONPATH=rses/src python benchmarks/run.py --output results.json`. A later run with
+`--compare results.json` exits with 1 when the median of any case got slower than the threshold.
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+import bench_projections
+from rses_connections import db
+from rses_errors import NotEnoughIngredients
+from objects.cooking import Recipe
+from objects.recommendation import FAVOURITES, FORGOTTEN
+from objects.shopping import ShoppingList
+from objects.stock import Ingredient
+
+log = logging.getLogger(__name__)
+
+# Cases by name, registered by `case`
+CASES: Dict[str, 'Case'] = dict()
+SEARCH_TEXTS = ('boil', 'potatoes', 'golden crispy', 'cream sauce', 'dough rest')
+LISTINGS = (
+    '/rses/api/list/ingredient_type/50/0',
+    '/rses/api/list/total/ingredient_type',
+    '/rses/api/list/ingredient/50/0',
+    '/rses/api/list/ingredient/50/0?name=ingredient 00',
+    '/rses/api/list/total/ingredient',
+    f'/rses/api/recommend/recipe/{FORGOTTEN}/10',
+    f'/rses/api/recommend/recipe/{FAVOURITES}/10',
+    '/rses/api/plan/7/2',
+    '/rses/api/forecast/7',
+)
+
+
+class Kitchen(NamedTuple):
+    """What the cases pick from, so the same seed picks the same items"""
+    ingredients: int
+    recipes: int
+    rng: random.Random
+
+    def ingredient(self) -> int:
+        return self.rng.randint(1, self.ingredients)
+
+    def recipe(self) -> int:
+        return self.rng.randint(1, self.recipes)
+
+
+class Case(NamedTuple):
+    """Benchmarked operation, `setup` prepares what a round needs outside of the measured time"""
+    name: str
+    run: Callable[[Any], Any]
+    setup: Callable[[Kitchen], Any]
+    rounds: int
+
+
+def case(name: str, rounds: int = 20, setup: Callable[[Kitchen], Any] = lambda kitchen: None):
+    """Registers the decorated function as a benchmark case"""
+    def register(function: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        CASES[name] = Case(name, function, setup, rounds)
+        return function
+    return register
+
+
+@case('shopping_list', rounds=10)
+def shopping_list(_) -> None:
+    ShoppingList()
+
+
+@case('recipe_load', rounds=50, setup=lambda kitchen: kitchen.recipe())
+def recipe_load(recipe_id: int) -> None:
+    Recipe(recipe_id=recipe_id)
+
+
+@case('recipe_price', rounds=50, setup=lambda kitchen: Recipe(recipe_id=kitchen.recipe()))
+def recipe_price(recipe: Recipe) -> None:
+    recipe.current_price
+
+
+@case('recipe_cook', rounds=20, setup=lambda kitchen: Recipe(recipe_id=kitchen.recipe()))
+def recipe_cook(recipe: Recipe) -> None:
+    try:
+        recipe.cook()
+    except NotEnoughIngredients:
+        pass
+
+
+@case('recipe_cook_parallel', rounds=5, setup=lambda kitchen: [Recipe(recipe_id=kitchen.recipe()) for _ in range(32)])
+def recipe_cook_parallel(recipes: List[Recipe]) -> None:
+    """Throughput of cooking at the same time, the stock of popular ingredients is contended"""
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(recipe_cook, recipes))
+
+
+@case('ingredient_in_stock', rounds=100, setup=lambda kitchen: Ingredient(ingredient_id=kitchen.ingredient()))
+def ingredient_in_stock(ingredient: Ingredient) -> None:
+    ingredient.in_stock
+
+
+@case('ingredient_average_price', rounds=100, setup=lambda kitchen: Ingredient(ingredient_id=kitchen.ingredient()))
+def ingredient_average_price(ingredient: Ingredient) -> None:
+    ingredient.average_price
+
+
+@case('ingredient_remove_stock', rounds=50, setup=lambda kitchen: Ingredient(ingredient_id=kitchen.ingredient()))
+def ingredient_remove_stock(ingredient: Ingredient) -> None:
+    try:
+        ingredient.remove_stock(0.01)
+    except NotEnoughIngredients:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _client():
+    """Authorized test client of the app, imported late so cases without it don't need Flask"""
+    from flask_app.app import create_app
+    client = create_app().test_client()
+    with client.session_transaction() as session:
+        session['authorized'] = True
+    return client
+
+
+class FailedRequest(RuntimeError):
+    """Benchmarked endpoint didn't succeed, its timing would be of the error handling"""
+
+
+def _get(client, url: str) -> None:
+    response = client.get(url)
+    if not 200 <= response.status_code < 300:
+        raise FailedRequest(f'{url} returned {response.status_code}')
+
+
+def _register_listings() -> None:
+    """A case for every listing endpoint, served through the whole app"""
+    for url in LISTINGS:
+        name = 'api' + url[len('/rses/api'):].split('?')[0].replace('/', '_')
+        if '?' in url:
+            name += '_filtered'
+        case(name, rounds=30, setup=lambda kitchen, url=url: (_client(), url))(lambda args: _get(*args))
+    case('api_search_recipe', rounds=30, setup=lambda kitchen: (
+        _client(), f'/rses/api/search/recipe/20/0?q={kitchen.rng.choice(SEARCH_TEXTS)}'
+    ))(lambda args: _get(*args))
+
+
+_register_listings()
+
+
+def measure(bench: Case, kitchen: Kitchen, warmup: int = 2) -> Dict[str, float]:
+    """Runs the case, each round with freshly set up arguments, returns statistics of the rounds in seconds"""
+    for _ in range(warmup):
+        bench.run(bench.setup(kitchen))
+    times = list()
+    for _ in range(bench.rounds):
+        argument = bench.setup(kitchen)
+        start = time.perf_counter()
+        bench.run(argument)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return dict(rounds=len(times), min=times[0], median=statistics.median(times), mean=statistics.mean(times),
+                p95=times[min(len(times) - 1, int(len(times) * 0.95))], max=times[-1])
+
+
+def run(names: Optional[List[str]] = None, seed: int = 42) -> Dict[str, Any]:
+    """
+    Runs the cases against the database
+
+    :param names:   Only these cases, all by default
+    :param seed:    Same seed picks the same recipes and ingredients
+    :return:        Results with what they were measured on, ready to be dumped as JSON
+    """
+    row = db.select('SELECT (SELECT max(id) FROM ingredient) AS ingredients, (SELECT max(id) FROM recipe) AS recipes')
+    if not row.ingredients or not row.recipes:
+        raise RuntimeError('The database is empty, seed it with benchmarks/generate.py first')
+    kitchen = Kitchen(row.ingredients, row.recipes, random.Random(seed))
+    results = dict()
+    for name, bench in CASES.items():
+        if names and name not in names:
+            continue
+        log.info('Running %s', name)
+        results[name] = measure(bench, kitchen)
+    if not names or 'projections' in names:
+        results['projections'] = bench_projections.run(20000)
+    return dict(meta=_meta(seed), results=results)
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """Cases whose median is slower than threshold times the baseline, described for the output"""
+    regressions = list()
+    for name, stats in current['results'].items():
+        before = baseline['results'].get(name)
+        if not before or 'median' not in stats or 'median' not in before:
+            continue
+        ratio = stats['median'] / before['median'] if before['median'] else 1.0
+        line = f"{name}: {before['median'] * 1000:.3f}ms -> {stats['median'] * 1000:.3f}ms ({ratio:.2f}x)"
+        print(line)
+        if ratio > threshold:
+            regressions.append(line)
+    return regressions
+
+
+def _meta(seed: int) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, time=datetime.datetime.now().isoformat(timespec='seconds'), seed=seed,
+                python=platform.python_version(), machine=platform.machine())
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths against a generated kitchen')
+    parser.add_argument('--only', nargs='+', choices=sorted(CASES) + ['projections'], help='Run only these cases')
+    parser.add_argument('--seed', type=int, default=42, help='Same seed picks the same items')
+    parser.add_argument('--output', help='Write the results as JSON into this file')
+    parser.add_argument('--compare', help='Results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Slower median than this times the earlier one is a regression (1.2 by default)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        results = run(args.only, args.seed)
+    except FailedRequest as error:
+        print('Failed:', error, file=sys.stderr)
+        return 1
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.threshold)
+        if regressions:
+            print('Regressions:', *regressions, sep='\n  ')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
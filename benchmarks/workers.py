@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Compares the worker models of the production server under the same household load
+
+Seed the database with `benchmarks/generate.py`, then run
+`PYTHONPATH=rses/src python benchmarks/workers.py --households 10 40 160`. Every model is served by
+`rses_serve.py` on its own port, loaded by `loadtest.py` stage by stage and stopped, the summary of
+the stages is printed for each model and written as JSON with `--output`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import loadtest
+
+SERVE: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'rses', 'src', 'rses_serve.py')
+# Pooled connections of all the workers have to fit into max_connections of the database
+MODELS = dict(
+    sync=dict(RSES_WORKER_CLASS='sync', RSES_DB_POOL_SIZE='1'),
+    gthread=dict(RSES_WORKER_CLASS='gthread', RSES_THREADS='8', RSES_DB_POOL_SIZE='8'),
+    gevent=dict(RSES_WORKER_CLASS='gevent', RSES_THREADS='100', RSES_DB_POOL_SIZE='10'),
+)
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.2)
+    raise RuntimeError(f'Server did not start on port {port} within {timeout}s')
+
+
+def run_model(name: str, port: int, args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Serves the app with the worker model and load tests it"""
+    env = dict(os.environ, PORT=str(port), RSES_WORKERS=str(args.workers), **MODELS[name])
+    server = subprocess.Popen([sys.executable, SERVE], env=env)
+    try:
+        wait_for_port(port)
+        options = argparse.Namespace(url=f'http://127.0.0.1:{port}', password=args.password,
+                                     households=args.households, duration=args.duration, mix=args.mix,
+                                     think=args.think, seed=args.seed)
+        print(f'== {name} ==')
+        return asyncio.get_event_loop().run_until_complete(loadtest.load_test(options))
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Compare worker models of the production server')
+    parser.add_argument('--models', nargs='+', choices=sorted(MODELS), default=sorted(MODELS))
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes, 0 for twice the CPUs plus one')
+    parser.add_argument('--households', type=int, nargs='+', default=[10, 40, 160])
+    parser.add_argument('--duration', type=float, default=30, help='Seconds each stage runs')
+    parser.add_argument('--mix', type=loadtest.parse_mix, default=loadtest.parse_mix('browse=6,shop=2,cook=2'))
+    parser.add_argument('--think', type=float, default=0.5, help='Mean pause between requests in seconds')
+    parser.add_argument('--password', default='kitchen', help='RSES_MASTER_PASSWORD of the app')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--port', type=int, default=5100, help='First port, each model gets the next one')
+    parser.add_argument('--output', help='Write the results as JSON into this file')
+    args = parser.parse_args(argv)
+    results = {name: run_model(name, args.port + index, args) for index, name in enumerate(args.models)}
+    print('\nmodel      households  req/s   errors   p95 of the slowest route')
+    for name, stages in results.items():
+        for stage in stages:
+            slowest = max((route['p95_ms'] for route in stage['routes'].values()), default=0.0)
+            print(f"{name:<10} {stage['households']:>10} {stage['throughput']:>6.1f} "
+                  f"{stage['error_rate'] * 100:>7.2f}% {slowest:>10.1f}ms")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,14 @@
+DROP TABLE IF EXISTS schema_migration;
+DROP TABLE IF EXISTS scheduled_job;
+DROP TABLE IF EXISTS stock_snapshot_amount;
+DROP TABLE IF EXISTS stock_snapshot;
+DROP TABLE IF EXISTS stock_ledger;
+DROP TYPE IF EXISTS STOCK_MOVEMENT;
+DROP TABLE IF EXISTS price_sketch;
+DROP TABLE IF EXISTS consumption_forecast;
 DROP TABLE IF EXISTS shopping_list;
 DROP TYPE IF EXISTS SHOPPING_STATUS;
+DROP TABLE IF EXISTS recipe_stats;
 DROP TABLE IF EXISTS recipe_made;
 DROP TABLE IF EXISTS recipe_ingredients;
 DROP TABLE IF EXISTS categorized_recipes;
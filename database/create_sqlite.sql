@@ -0,0 +1,163 @@
+-- Schema of database/create.sql with database/migrations applied, for the SQLite backend, see rses/src/rses_sqlite.py
+-- Ids are rowids, enums are checked text, timestamps are local time with milliseconds and recipes have no search
+PRAGMA foreign_keys = ON;
+
+DROP TABLE IF EXISTS stock_snapshot_amount;
+DROP TABLE IF EXISTS stock_snapshot;
+DROP TABLE IF EXISTS stock_ledger;
+DROP TABLE IF EXISTS price_sketch;
+DROP TABLE IF EXISTS consumption_forecast;
+DROP TABLE IF EXISTS shopping_list;
+DROP TABLE IF EXISTS recipe_stats;
+DROP TABLE IF EXISTS recipe_made;
+DROP TABLE IF EXISTS recipe_ingredients;
+DROP TABLE IF EXISTS categorized_recipes;
+DROP TABLE IF EXISTS recipe_category;
+DROP TABLE IF EXISTS recipe;
+DROP TABLE IF EXISTS stock;
+DROP TABLE IF EXISTS ingredient;
+DROP TABLE IF EXISTS ingredient_type;
+
+
+CREATE TABLE ingredient_type
+(
+  id   INTEGER PRIMARY KEY AUTOINCREMENT,
+  name VARCHAR(50) NOT NULL UNIQUE
+);
+
+CREATE TABLE ingredient
+(
+  id                   INTEGER PRIMARY KEY AUTOINCREMENT,
+  name                 VARCHAR(80) NOT NULL UNIQUE,
+  unit                 VARCHAR(10) NOT NULL,
+  ingredient_type      INT NOT NULL,
+  suggestion_threshold FLOAT DEFAULT 0.0,
+  rebuy_threshold      FLOAT DEFAULT 0.0,
+  durability           INT DEFAULT NULL,
+  FOREIGN KEY (ingredient_type) REFERENCES ingredient_type (id) ON DELETE CASCADE
+);
+
+CREATE TABLE stock
+(
+  id              INTEGER PRIMARY KEY AUTOINCREMENT,
+  ingredient      INT NOT NULL,
+  amount          FLOAT NOT NULL,
+  amount_left     FLOAT NOT NULL,
+  expiration_date DATE,
+  time_bought     TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+  price           FLOAT,
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE
+);
+CREATE INDEX stock_ingredient_time_bought_idx ON stock (ingredient, time_bought);
+CREATE INDEX stock_time_bought_idx ON stock (time_bought);
+
+CREATE TABLE recipe
+(
+  id           INTEGER PRIMARY KEY AUTOINCREMENT,
+  name         VARCHAR(60) NOT NULL UNIQUE,
+  directions   TEXT NOT NULL,
+  picture      VARCHAR(250),
+  prepare_time INT,
+  portions     INT  NOT NULL,
+  language     TEXT NOT NULL DEFAULT 'simple'
+);
+
+CREATE TABLE recipe_category
+(
+  id   INTEGER PRIMARY KEY AUTOINCREMENT,
+  name VARCHAR(20) NOT NULL UNIQUE
+);
+
+CREATE TABLE categorized_recipes
+(
+  recipe   INT,
+  category INT,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE CASCADE,
+  FOREIGN KEY (category) REFERENCES recipe_category (id) ON DELETE CASCADE,
+  PRIMARY KEY (recipe, category)
+);
+
+CREATE TABLE recipe_ingredients
+(
+  recipe     INT,
+  ingredient INT,
+  amount     FLOAT NOT NULL,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE CASCADE,
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE,
+  PRIMARY KEY (recipe, ingredient)
+);
+CREATE INDEX recipe_ingredients_ingredient_idx ON recipe_ingredients (ingredient);
+
+CREATE TABLE recipe_made
+(
+  recipe    INT,
+  time_made TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+  portions  INT   NOT NULL,
+  price     FLOAT NOT NULL,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE CASCADE
+);
+CREATE INDEX recipe_made_recipe_time_made_idx ON recipe_made (recipe, time_made);
+
+CREATE TABLE recipe_stats
+(
+  recipe       INT PRIMARY KEY,
+  times_cooked INT   NOT NULL DEFAULT 0,
+  last_cooked  TIMESTAMP,
+  frequency    FLOAT NOT NULL DEFAULT 0.0,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE CASCADE
+);
+
+CREATE TABLE shopping_list
+(
+  ingredient    INT PRIMARY KEY,
+  wanted_amount FLOAT NOT NULL,
+  status        TEXT DEFAULT 'list' CHECK (status IN ('list', 'cart')),
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE
+);
+
+CREATE TABLE consumption_forecast
+(
+  ingredient  INT PRIMARY KEY,
+  daily_rate  FLOAT     NOT NULL,
+  computed_at TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE
+);
+
+CREATE TABLE price_sketch
+(
+  ingredient INT PRIMARY KEY,
+  sketch     JSON      NOT NULL,
+  updated    TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE
+);
+
+CREATE TABLE stock_ledger
+(
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  time       TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+  ingredient INT       NOT NULL,
+  lot        INT       NOT NULL,
+  movement   TEXT      NOT NULL CHECK (movement IN ('purchase', 'consume', 'adjust', 'expire')),
+  amount     FLOAT     NOT NULL,
+  recipe     INT,
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE SET NULL
+);
+CREATE INDEX stock_ledger_time_idx ON stock_ledger (time);
+CREATE INDEX stock_ledger_ingredient_time_idx ON stock_ledger (ingredient, time);
+CREATE INDEX stock_ledger_lot_idx ON stock_ledger (lot);
+
+CREATE TABLE stock_snapshot
+(
+  taken_at TIMESTAMP PRIMARY KEY
+);
+
+CREATE TABLE stock_snapshot_amount
+(
+  taken_at   TIMESTAMP,
+  ingredient INT,
+  amount     FLOAT NOT NULL,
+  FOREIGN KEY (taken_at) REFERENCES stock_snapshot (taken_at) ON DELETE CASCADE,
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE,
+  PRIMARY KEY (taken_at, ingredient)
+);
@@ -0,0 +1,15 @@
+-- rses: no-transaction
+-- Indexes of the hot access paths, built without locking out writes.
+-- A build that fails leaves an INVALID index behind, `migrate` drops it and builds it again when run again.
+
+-- Stock of an ingredient (thresholds, prices, cooking), newest or oldest lots first, and deleting an ingredient
+CREATE INDEX CONCURRENTLY IF NOT EXISTS stock_ingredient_time_bought_idx ON stock (ingredient, time_bought);
+
+-- Recent purchases, for forecasting consumption
+CREATE INDEX CONCURRENTLY IF NOT EXISTS stock_time_bought_idx ON stock (time_bought);
+
+-- Recipes using an ingredient, and deleting an ingredient - the primary key starts with the recipe
+CREATE INDEX CONCURRENTLY IF NOT EXISTS recipe_ingredients_ingredient_idx ON recipe_ingredients (ingredient);
+
+-- History of a recipe, and deleting a recipe
+CREATE INDEX CONCURRENTLY IF NOT EXISTS recipe_made_recipe_time_made_idx ON recipe_made (recipe, time_made);
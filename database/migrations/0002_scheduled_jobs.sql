@@ -0,0 +1,12 @@
+-- Last runs of background jobs, so a slot due on several nodes runs once, see rses/src/rses_scheduler.py
+CREATE TABLE scheduled_job
+(
+  name         TEXT PRIMARY KEY,
+  last_slot    TIMESTAMP NOT NULL,
+  last_started TIMESTAMP NOT NULL,
+  last_seconds FLOAT,
+  last_error   TEXT,
+  runs         INT NOT NULL DEFAULT 0,
+  failures     INT NOT NULL DEFAULT 0
+);
+COMMENT ON COLUMN scheduled_job.last_slot IS 'When the last run was due';
@@ -0,0 +1,21 @@
+-- Aggregated cooking history the recommendations are scored by, see rses/src/objects/recommendation.py.
+-- Written by cooking, filled from the history there is, with the default half-life of 30 days
+CREATE TABLE IF NOT EXISTS recipe_stats
+(
+  recipe       INT PRIMARY KEY,
+  times_cooked INT   NOT NULL DEFAULT 0,
+  last_cooked  TIMESTAMP,
+  frequency    FLOAT NOT NULL DEFAULT 0.0,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE CASCADE
+);
+COMMENT ON TABLE recipe_stats IS 'Aggregated history of recipe_made, kept up to date when cooking';
+COMMENT ON COLUMN recipe_stats.frequency IS 'Each time cooked counts as 1 halved every half-life, as of last_cooked';
+
+INSERT INTO recipe_stats (recipe, times_cooked, last_cooked, frequency)
+SELECT recipe, count(*), max(time_made), sum(exp(-ln(2) * extract(EPOCH FROM last_made - time_made) / (30 * 86400)))
+FROM (
+  SELECT recipe, time_made, max(time_made) OVER (PARTITION BY recipe) AS last_made
+  FROM recipe_made
+) AS history
+GROUP BY recipe
+ON CONFLICT (recipe) DO NOTHING;
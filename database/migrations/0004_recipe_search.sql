@@ -0,0 +1,8 @@
+-- Full text search over recipe names and directions, see `RecipeSearch` in rses/src/objects/cooking.py.
+-- Adding the generated column rewrites the recipe table
+ALTER TABLE recipe ADD COLUMN IF NOT EXISTS language REGCONFIG NOT NULL DEFAULT 'simple';
+ALTER TABLE recipe ADD COLUMN IF NOT EXISTS search TSVECTOR GENERATED ALWAYS AS (
+  setweight(to_tsvector(language, name), 'A') || setweight(to_tsvector(language, directions), 'B')
+) STORED;
+COMMENT ON COLUMN recipe.language IS 'Text search configuration the recipe is written for';
+CREATE INDEX IF NOT EXISTS recipe_search_idx ON recipe USING GIN (search);
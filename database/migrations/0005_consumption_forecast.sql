@@ -0,0 +1,9 @@
+-- Forecast consumption, filled by `rses_cli.py forecast` or the forecast job
+CREATE TABLE IF NOT EXISTS consumption_forecast
+(
+  ingredient  INT PRIMARY KEY,
+  daily_rate  FLOAT     NOT NULL,
+  computed_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE
+);
+COMMENT ON TABLE consumption_forecast IS 'Forecast daily consumption of ingredients, refreshed in a batch';
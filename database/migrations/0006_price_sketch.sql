@@ -0,0 +1,9 @@
+-- Price sketches deals are rated against, built from the stock there is by `rses_cli.py rebuild-prices`
+CREATE TABLE IF NOT EXISTS price_sketch
+(
+  ingredient INT PRIMARY KEY,
+  sketch     JSONB     NOT NULL,
+  updated    TIMESTAMP NOT NULL DEFAULT NOW(),
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE
+);
+COMMENT ON TABLE price_sketch IS 'T-digest of unit prices of every purchase of an ingredient, see rses_quantiles.py';
@@ -0,0 +1,44 @@
+-- Ledger of stock movements with snapshots, see rses/src/objects/ledger.py.
+-- The stock there is gets recorded by `rses_cli.py snapshot-stock --backfill`
+DO $$
+BEGIN
+  CREATE TYPE STOCK_MOVEMENT AS ENUM ('purchase', 'consume', 'adjust', 'expire');
+EXCEPTION
+  WHEN duplicate_object THEN NULL;
+END
+$$;
+CREATE TABLE IF NOT EXISTS stock_ledger
+(
+  id         BIGSERIAL PRIMARY KEY,
+  time       TIMESTAMP      NOT NULL DEFAULT clock_timestamp(),
+  ingredient INT            NOT NULL,
+  lot        INT            NOT NULL,
+  movement   STOCK_MOVEMENT NOT NULL,
+  amount     FLOAT          NOT NULL,
+  recipe     INT,
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE,
+  FOREIGN KEY (recipe) REFERENCES recipe (id) ON DELETE SET NULL
+);
+COMMENT ON TABLE stock_ledger IS 'Append-only history of changes of stock lots';
+COMMENT ON COLUMN stock_ledger.lot IS 'Id of the stock lot, kept without a reference for the history';
+COMMENT ON COLUMN stock_ledger.amount IS 'Change of the amount left, negative when taken';
+CREATE INDEX IF NOT EXISTS stock_ledger_time_idx ON stock_ledger (time);
+CREATE INDEX IF NOT EXISTS stock_ledger_ingredient_time_idx ON stock_ledger (ingredient, time);
+CREATE INDEX IF NOT EXISTS stock_ledger_lot_idx ON stock_ledger (lot);
+
+CREATE TABLE IF NOT EXISTS stock_snapshot
+(
+  taken_at TIMESTAMP PRIMARY KEY
+);
+COMMENT ON TABLE stock_snapshot IS 'Points in time with the amounts in stock precomputed from the ledger';
+
+CREATE TABLE IF NOT EXISTS stock_snapshot_amount
+(
+  taken_at   TIMESTAMP,
+  ingredient INT,
+  amount     FLOAT NOT NULL,
+  FOREIGN KEY (taken_at) REFERENCES stock_snapshot (taken_at) ON DELETE CASCADE,
+  FOREIGN KEY (ingredient) REFERENCES ingredient (id) ON DELETE CASCADE,
+  PRIMARY KEY (taken_at, ingredient)
+);
+COMMENT ON TABLE stock_snapshot_amount IS 'Amount of every ingredient in stock at the time of the snapshot';
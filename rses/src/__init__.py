@@ -2,11 +2,33 @@
 """The python source, importable if someone adds RSES as a submodule"""
 import sys
 import os
+import types
 
 # So that our code's imports works in different application - careful about namespaces!
 # Top level should be  prefixed with `rses_`
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
-# Expose the blueprints
-from flask_app.blueprints.api.api import rses_api_bp
-from flask_app.blueprints.client.client import rses_web_client_bp
+# The blueprints, imported (with Flask) only when they are first asked for, e.g. `from rses.src import rses_api_bp`
+_BLUEPRINTS = dict(
+    rses_api_bp='flask_app.blueprints.api.api',
+    rses_async_api_bp='flask_app.blueprints.api.async_api',
+    rses_web_client_bp='flask_app.blueprints.client.client',
+)
+
+
+class _LazyBlueprints(types.ModuleType):
+    """This package, with the blueprints loaded on first access"""
+
+    def __getattr__(self, name):
+        if name not in _BLUEPRINTS:
+            raise AttributeError(f'module {__name__} has no attribute {name}')
+        import importlib
+        blueprint = getattr(importlib.import_module(_BLUEPRINTS[name]), name)
+        setattr(self, name, blueprint)
+        return blueprint
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(_BLUEPRINTS))
+
+
+sys.modules[__name__].__class__ = _LazyBlueprints
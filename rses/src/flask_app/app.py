@@ -1,35 +1,64 @@
 # coding=utf-8
 """Flask app, just imports the otherwise modular blueprints and it's configuration"""
-from flask import Flask, url_for, redirect
+from typing import Any, Dict, Optional
 
-from flask_app.blueprints.api.api import rses_api_bp
+from flask import Flask, url_for, redirect
 
-app = Flask(__name__)
-app.config.from_object('rses_config')
-app.register_blueprint(rses_api_bp)
+# Config keys the database adapter is created with, by its arguments
+_ADAPTER_OPTIONS = dict(url='RSES_DB_URL', cache_bytes='RSES_QUERY_CACHE_BYTES', pool_size='RSES_DB_POOL_SIZE',
+                        pool_timeout='RSES_DB_POOL_TIMEOUT', prepared_statements='RSES_PREPARED_STATEMENTS',
+                        statement_timeout='RSES_STATEMENT_TIMEOUT')
 
-# Registering stuff based on if web client is wanted
-if app.config['RSES_WEB_CLIENT']:
-    from flask_app.blueprints.client.client import rses_web_client_bp
+def create_app(config: Optional[Dict[str, Any]] = None, backend: Any = None) -> Flask:
+    """
+    Creates the app with the blueprints it is configured for, each imported only when registered
 
-    app.register_blueprint(rses_web_client_bp)
+    :param config:  Overrides of `rses_config`, the database adapter is configured with the ones of `_ADAPTER_OPTIONS`
+    :param backend: Storage to use instead of the one RSES_DB_URL points to, e.g. `rses_sqlite.SQLiteAdapter()`
+    """
+    from rses_connections import db
+    from rses_invalidation import bus
 
+    app = Flask(__name__)
+    app.config.from_object('rses_config')
+    app.config.update(config or dict())
+    adapter_options = {option: config[key] for option, key in _ADAPTER_OPTIONS.items() if key in (config or dict())}
+    if backend is not None:
+        db.use(backend)
+    elif adapter_options:
+        db.configure(**adapter_options)
 
-    def home():
-        """Temporary home view if client is registered"""
-        return redirect(url_for('RSES_CLIENT.home'))
+    from flask_app.blueprints.api.api import rses_api_bp
+    app.register_blueprint(rses_api_bp)
+    if app.config['RSES_ASYNC_API']:
+        from flask_app.blueprints.api.async_api import rses_async_api_bp
+        from rses_async import adb
+        if 'RSES_DB_URL' in (config or dict()):
+            adb.url = config['RSES_DB_URL']
+        app.register_blueprint(rses_async_api_bp)
+    # Evicts in-process caches when other workers write, does nothing unless RSES_INVALIDATION_BUS is on
+    bus.start()
 
+    # Registering stuff based on if web client is wanted
+    if app.config['RSES_WEB_CLIENT']:
+        from flask_app.blueprints.client.client import rses_web_client_bp
 
-    app.route('/')(home)
-else:
-    # Redirect root url to API index if not running web client
-    def home():
-        """Temporary home view if only api is registered"""
-        return redirect(url_for('RSES_API.index'))
+        app.register_blueprint(rses_web_client_bp)
 
+        def home():
+            """Temporary home view if client is registered"""
+            return redirect(url_for('RSES_CLIENT.home'))
+    else:
+        # Redirect root url to API index if not running web client
+        def home():
+            """Temporary home view if only api is registered"""
+            return redirect(url_for('RSES_API.index'))
 
     app.route('/')(home)
+    return app
+
 
 if __name__ == '__main__':
+    app = create_app()
     port = app.config['PORT']
     app.run(host='0.0.0.0', port=port, debug=True)
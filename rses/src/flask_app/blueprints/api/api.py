@@ -1,20 +1,66 @@
 # coding=utf-8
 """API for more than just one client"""
+import datetime
 import html
+import io
 from urllib.parse import unquote
 
 from flask import Blueprint, json, current_app, session, abort, request
 
-from objects import stock
+from objects import stock, cooking
+from objects.forecasting import ConsumptionForecaster
+from objects.ledger import StockLedger
+from objects.importing import RecipeImporter, StockIngester, FORMATS
+from objects.planning import MealPlanner
+from objects.pricing import DealDetector
+from objects.recommendation import recommender, MODES
+from rses_config import RSES_REQUEST_BUDGET, RSES_ROUTE_BUDGETS, RSES_RETRY_AFTER
+from rses_connections import db, queries, PoolTimeout
+from rses_deadlines import deadlines, timeouts
+from rses_errors import QueryTimeout
+from rses_scheduler import scheduler
+from rses_statements import statement_stats
 
 rses_api_bp = Blueprint('RSES_API', __name__, url_prefix='/rses/api')
 
+# Fields of an ingredient the API can change
+INGREDIENT_CHANGES = ('name', 'unit', 'suggestion_threshold', 'rebuy_threshold', 'durability')
+
 
 @rses_api_bp.before_request
 def before_api_request():
-    """Cancels request if the session is not authorized"""
+    """Cancels request if the session is not authorized, opens the latency budget of the route"""
+    queries.reset()
+    deadlines.reset()
     if not session.get('authorized', False):
         return abort(403)
+    route = request.endpoint.rsplit('.', 1)[-1] if request.endpoint else ''
+    budget = RSES_ROUTE_BUDGETS.get(request.endpoint, RSES_ROUTE_BUDGETS.get(route, RSES_REQUEST_BUDGET))
+    if budget:
+        deadlines.push(budget, route)
+
+
+@rses_api_bp.after_request
+def after_api_request(response):
+    """Tells how many database queries the request took, for load testing"""
+    response.headers['X-RSES-Queries'] = str(queries.count)
+    return response
+
+
+@rses_api_bp.teardown_request
+def teardown_api_request(_exception=None):
+    """Closes the latency budget, the thread serves another request next"""
+    deadlines.reset()
+
+
+@rses_api_bp.errorhandler(QueryTimeout)
+@rses_api_bp.errorhandler(PoolTimeout)
+def unavailable(error):
+    """The database did not make it in time, the client may try again later"""
+    response = json.jsonify(dict(status=503, error='timeout' if isinstance(error, QueryTimeout) else 'busy',
+                                 budget=getattr(error, 'budget', None), retry_after=RSES_RETRY_AFTER))
+    response.headers['Retry-After'] = str(RSES_RETRY_AFTER)
+    return response, 503
 
 
 @rses_api_bp.route('/')
@@ -26,6 +72,19 @@ def index():
     return ret
 
 
+@rses_api_bp.route('/stats', methods=['GET'])
+def stats():
+    """
+    Hit rates of the prepared statements and of the query cache of this process, timed out queries by budget
+    and runtimes of the background jobs run by this process
+    """
+    cache = db.cache
+    cache_stats = None if cache is None else dict(hits=cache.hits, misses=cache.misses, entries=len(cache),
+                                                  bytes=cache.size)
+    return json.jsonify(dict(status='OK', statements=statement_stats.json_dict, cache=cache_stats,
+                             timeouts=dict(timeouts), jobs=scheduler.stats)), 200
+
+
 ####################
 # INGREDIENT TYPES #
 ####################
@@ -113,21 +172,25 @@ def ingredient_create(name: str):
 
 @rses_api_bp.route('/ingredient/<int:ingredient_id>/change', methods=['POST'])
 def ingredient_rename(ingredient_id: int):
-    """Changes the parameters of an ingredient type"""
+    """Changes the parameters of an ingredient, any of `INGREDIENT_CHANGES`"""
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict) or not params.keys() <= set(INGREDIENT_CHANGES):
+        return json.jsonify(dict(status=400, editable=INGREDIENT_CHANGES)), 400
     ingredient = stock.Ingredient(ingredient_id=ingredient_id)
-    params = request.get_json()
-    for name, value in params.items():
-        setattr(ingredient, name, value)
+    # All the changes are written in a single update
+    with ingredient.deferred():
+        for name, value in params.items():
+            setattr(ingredient, name, value)
     return json.jsonify(dict(status='OK', changed_ingredienty=ingredient.json_dict)), 200
 
 
 @rses_api_bp.route('/list/ingredient/<int:limit>/<int:offset>', methods=['GET'])
 @rses_api_bp.route('/list/ingredient/<int:limit>/<int:offset>', methods=['GET'])
 def list_ingredients(limit: int, offset: int):
-    """Lists Ingredient Types"""
-    filters = request.args
-    listing = stock.IngredientTypeListing().show(limit, offset, filters)
-    return json.jsonify(dict(status='OK', ingredient_types=listing)), 200
+    """Lists Ingredients, filtered by ?name=, ?unit= and ?ingredient_type= (name of the type)"""
+    filters = request.args.to_dict()
+    listing = stock.IngredientListing().show(limit, offset, filters)
+    return json.jsonify(dict(status='OK', ingredients=listing)), 200
 
 
 @rses_api_bp.route('/list/total/ingredient', methods=['GET'])
@@ -135,3 +198,119 @@ def total_ingredients():
     """Returns total amount of Ingredient Types"""
     total = stock.IngredientListing().total
     return json.jsonify(dict(status='OK', total=total)), 200
+
+
+###########
+# RECIPES #
+###########
+@rses_api_bp.route('/recommend/recipe/<string:mode>/<int:limit>', methods=['GET'])
+def recommend_recipes(mode: str, limit: int):
+    """Recommends recipes that haven't been made in a while (forgotten) or favourites, ?cookable=true to filter"""
+    if mode not in MODES:
+        return json.jsonify(dict(status=404, modes=MODES)), 404
+    cookable_only = request.args.get('cookable', 'false').lower() == 'true'
+    recommendations = recommender.recommend(mode, limit, cookable_only)
+    return json.jsonify(dict(status='OK', recipes=[item.json_dict for item in recommendations])), 200
+
+
+@rses_api_bp.route('/plan/<int:meals>/<int:portions>', methods=['GET', 'POST'])
+def plan_meals(meals: int, portions: int):
+    """Plans meals using up what is about to expire, POST also adds what is missing to the shopping list"""
+    plan = MealPlanner().plan(meals, portions)
+    if request.method == 'POST':
+        plan.push_to_shopping_list()
+    return json.jsonify(dict(status='OK', plan=plan.json_dict)), 200
+
+
+@rses_api_bp.route('/search/recipe/<int:limit>/<int:offset>', methods=['GET'])
+def search_recipes(limit: int, offset: int):
+    """Full text search of recipes, ?q=text, optionally &category=<id> (repeatable) and &cookable=true"""
+    text = request.args.get('q', '').strip()
+    if not text:
+        return json.jsonify(dict(status=400, error='Missing search text q')), 400
+    try:
+        categories = [int(category) for category in request.args.getlist('category')]
+    except ValueError:
+        return json.jsonify(dict(status=400, error='Categories have to be ids')), 400
+    cookable_only = request.args.get('cookable', 'false').lower() == 'true'
+    found = cooking.RecipeSearch().show(text, limit, offset, categories, cookable_only)
+    return json.jsonify(dict(status='OK', **found)), 200
+
+
+@rses_api_bp.route('/import/recipes', methods=['POST'])
+def import_recipes():
+    """Imports recipes streamed in the body as JSON lines or CSV (?format=csv)"""
+    file_format = request.args.get('format', 'jsonl')
+    if file_format not in FORMATS:
+        return json.jsonify(dict(status=400, formats=FORMATS)), 400
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8')
+    report = RecipeImporter().import_stream(stream, file_format)
+    return json.jsonify(dict(status='OK', report=report.json_dict)), 201
+
+
+#########
+# STOCK #
+#########
+@rses_api_bp.route('/import/stock', methods=['POST'])
+def ingest_stock():
+    """Adds purchased stock from receipt lines streamed in the body as JSON lines or CSV (?format=csv)"""
+    file_format = request.args.get('format', 'jsonl')
+    if file_format not in FORMATS:
+        return json.jsonify(dict(status=400, formats=FORMATS)), 400
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8')
+    report = StockIngester().ingest_stream(stream, file_format)
+    return json.jsonify(dict(status='OK', report=report.json_dict)), 201
+
+
+@rses_api_bp.route('/forecast/<int:horizon_days>', methods=['GET'])
+def forecast(horizon_days: int):
+    """Ingredients forecast to cross one of their thresholds within the days, soonest first"""
+    due = ConsumptionForecaster.due(horizon_days)
+    return json.jsonify(dict(status='OK', forecast=[item.json_dict for item in due])), 200
+
+
+@rses_api_bp.route('/deal/<int:ingredient_id>', methods=['GET'])
+def deal(ingredient_id: int):
+    """How good is ?price= for ?amount= (1 unit by default) of the ingredient, percentile and z-score of its history"""
+    try:
+        price = float(request.args['price'])
+        amount = float(request.args.get('amount', 1))
+    except (KeyError, ValueError):
+        return json.jsonify(dict(status=400)), 400
+    if amount <= 0:
+        return json.jsonify(dict(status=400)), 400
+    check = DealDetector().check(ingredient_id, price, amount)
+    return json.jsonify(dict(status='OK', deal=check.json_dict)), 200
+
+
+@rses_api_bp.route('/deal/cart', methods=['POST'])
+def deal_cart():
+    """Rates every item of a cart, the body is a JSON list of objects with ingredient, price and amount"""
+    try:
+        items = [(int(item['ingredient']), float(item['price']), float(item.get('amount', 1)))
+                 for item in request.get_json(force=True)]
+    except (KeyError, ValueError, TypeError):
+        return json.jsonify(dict(status=400)), 400
+    if any(amount <= 0 for _, _, amount in items):
+        return json.jsonify(dict(status=400)), 400
+    checks = DealDetector().check_cart(items)
+    return json.jsonify(dict(status='OK', deals=[check.json_dict for check in checks])), 200
+
+
+@rses_api_bp.route('/stock/at/<string:when>', methods=['GET'])
+def stock_at(when: str):
+    """Amounts of ingredients in stock at a point in time, given in ISO format"""
+    try:
+        when = datetime.datetime.strptime(unquote(when), '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return json.jsonify(dict(status=400)), 400
+    amounts = StockLedger.stock_at(when)
+    return json.jsonify(dict(status='OK', stock=[dict(ingredient=ingredient, amount=amount)
+                                                 for ingredient, amount in amounts.items()])), 200
+
+
+@rses_api_bp.route('/stock/history/<int:ingredient_id>/<int:limit>', methods=['GET'])
+def stock_history(ingredient_id: int, limit: int):
+    """Latest movements of stock of the ingredient, where it came from and where it went"""
+    movements = StockLedger.history(ingredient_id, limit)
+    return json.jsonify(dict(status='OK', history=[movement.json_dict for movement in movements])), 200
@@ -0,0 +1,113 @@
+# coding=utf-8
+"""
+Hot read routes of the API with their independent queries gathered, run concurrently on the loop of `rses_async`
+
+Registered by the app when RSES_ASYNC_API is on. The page and the total of a listing come in one response,
+so a client makes one request instead of two and waits for the slower query instead of both.
+"""
+import asyncio
+import html
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote
+
+from flask import Blueprint, json, request
+
+from flask_app.blueprints.api.api import before_api_request, after_api_request, teardown_api_request, unavailable
+from objects.forecasting import ConsumptionForecaster, Forecast
+from objects.projections import IngredientRow, IngredientTypeRow, json_dicts
+from objects.shopping import ShoppingList
+from objects.stock import IngredientListing, IngredientTypeListing
+from rses_async import adb, loop
+from rses_config import RSES_FORECAST_HORIZON_DAYS
+from rses_connections import PoolTimeout
+from rses_errors import QueryTimeout
+
+rses_async_api_bp = Blueprint('RSES_ASYNC_API', __name__, url_prefix='/rses/api/async')
+rses_async_api_bp.before_request(before_api_request)
+rses_async_api_bp.after_request(after_api_request)
+rses_async_api_bp.teardown_request(teardown_api_request)
+rses_async_api_bp.register_error_handler(QueryTimeout, unavailable)
+rses_async_api_bp.register_error_handler(PoolTimeout, unavailable)
+
+QUERY_INGREDIENTS = """
+SELECT i.id, i.name, i.unit, t.id AS type_id, t.name AS type_name,
+       i.suggestion_threshold, i.rebuy_threshold, i.durability
+FROM ingredient i
+JOIN ingredient_type t ON t.id = i.ingredient_type
+WHERE i.id = ANY(%s)
+"""
+
+
+async def ingredient_type_page(limit: int, offset: int, name_filter: str) -> Tuple[List[Dict[str, Any]], int]:
+    """Page of ingredient types and how many there are in total"""
+    rows, total = await asyncio.gather(
+        adb.select_all(IngredientTypeListing.QUERY_SHOW, f'%{name_filter}%'.lower(), limit, offset),
+        adb.select(IngredientTypeListing.QUERY_TOTAL),
+    )
+    return json_dicts(IngredientTypeRow(*row) for row in rows), total.total
+
+
+async def ingredient_page(limit: int, offset: int,
+                          wanted_filters: Optional[dict]) -> Tuple[List[Dict[str, Any]], int]:
+    """Page of ingredients and how many there are in total"""
+    rows, total = await asyncio.gather(
+        adb.select_all(IngredientListing.QUERY_SHOW, *IngredientListing.filter_args(wanted_filters), limit, offset),
+        adb.select(IngredientListing.QUERY_TOTAL),
+    )
+    return json_dicts(IngredientRow(*row) for row in rows), total.total
+
+
+async def shopping_list(horizon_days: float) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    What is on the shopping list and what is suggested, like `ShoppingList` but without writing anything
+
+    Ingredients below their rebuy threshold are listed apart, `ShoppingList` adds them to the list when it is built.
+    """
+    wanted, below_rebuy, below_suggestion, due = await asyncio.gather(
+        adb.select_all(ShoppingList.QUERY_WANTED),
+        adb.select_all(ShoppingList.QUERY_BELOW_REBUY),
+        adb.select_all(ShoppingList.QUERY_BELOW_SUGGESTION),
+        adb.select_all(ConsumptionForecaster.QUERY_DUE, horizon_days),
+    )
+    wanted_amounts = {row.ingredient: row.wanted_amount for row in wanted}
+    rebuy = [row.id for row in below_rebuy if row.id not in wanted_amounts]
+    suggested = [row.id for row in below_suggestion if row.id not in wanted_amounts and row.id not in rebuy]
+    forecast = [Forecast(*row) for row in due]
+    listed = [*wanted_amounts, *rebuy, *suggested]
+    forecast = [item for item in forecast if item.ingredient_id not in listed]
+    rows = await adb.select_all(QUERY_INGREDIENTS, listed) if listed else []
+    # Deleted in the meantime when missing
+    ingredients = {row.id: IngredientRow(*row).json_dict for row in rows}
+    return dict(
+        list=[dict(ingredients[ingredient], amount=amount) for ingredient, amount in wanted_amounts.items()
+              if ingredient in ingredients],
+        below_rebuy=[ingredients[ingredient] for ingredient in rebuy if ingredient in ingredients],
+        suggested=[ingredients[ingredient] for ingredient in suggested if ingredient in ingredients],
+        forecast=[item.json_dict for item in forecast],
+    )
+
+
+@rses_async_api_bp.route('/list/ingredient_type/<int:limit>/<int:offset>', methods=['GET'])
+@rses_async_api_bp.route('/list/ingredient_type/<int:limit>/<int:offset>/<string:name_filter>', methods=['GET'])
+def list_ingredient_types(limit: int, offset: int, name_filter: str = ''):
+    """Lists Ingredient Types with their total"""
+    name_filter = html.unescape(unquote(name_filter))
+    listing, total = loop.run(ingredient_type_page(limit, offset, name_filter))
+    return json.jsonify(dict(status='OK', ingredient_types=listing, total=total)), 200
+
+
+@rses_async_api_bp.route('/list/ingredient/<int:limit>/<int:offset>', methods=['GET'])
+def list_ingredients(limit: int, offset: int):
+    """Lists Ingredients with their total, filtered by ?name=, ?unit= and ?ingredient_type= (name of the type)"""
+    listing, total = loop.run(ingredient_page(limit, offset, request.args.to_dict()))
+    return json.jsonify(dict(status='OK', ingredients=listing, total=total)), 200
+
+
+@rses_async_api_bp.route('/shopping_list', methods=['GET'])
+def get_shopping_list():
+    """The shopping list with suggestions, ?horizon= days of the forecast suggestions"""
+    try:
+        horizon_days = float(request.args.get('horizon', RSES_FORECAST_HORIZON_DAYS))
+    except ValueError:
+        return json.jsonify(dict(status=400)), 400
+    return json.jsonify(dict(status='OK', **loop.run(shopping_list(horizon_days)))), 200
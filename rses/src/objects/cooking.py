@@ -1,13 +1,17 @@
 # coding=utf-8
 """Objects related to cooking"""
-from typing import List, Optional, Dict, Any
+from contextlib import contextmanager
+from typing import List, Optional, Dict, Any, Iterator
 import logging
 
-from psycopg2 import sql
-
 import rses_errors
+from rses_config import RSES_SEARCH_LANGUAGES
 from rses_connections import db
-from objects.stock import Ingredient
+from rses_invalidation import bus, entity_key
+from objects.ledger import CONSUME
+from objects.projections import RecipeMatch, json_dicts
+from objects.stock import Ingredient, StockReservation
+from objects.recommendation import record_cooked
 
 log = logging.getLogger(__name__)
 
@@ -51,6 +55,7 @@ class RecipeCategory:
         """
         db.update(query, new_name, self._id)
         self._name = new_name
+        bus.publish(entity_key('recipe_category', self._id))
 
     def exists(self) -> bool:
         """Checks whether the recipe category exists"""
@@ -67,18 +72,23 @@ class RecipeCategory:
         return bool(res)
 
     def create(self) -> None:
-        """Creates the recipe category"""
-        if self.exists() or self._id:
+        """Creates the recipe category, raises AlreadyExists if there is one with the same name"""
+        if self._id:
             raise rses_errors.AlreadyExists(self)
         if self._name is None:
             raise rses_errors.MissingParameter('name')
         query = """
-        INSERT INTO recipe_category (id, name)
-        VALUES (DEFAULT, %s)
-        RETURNING *
+        INSERT INTO recipe_category (name)
+        VALUES (%s)
+        ON CONFLICT DO NOTHING
+        RETURNING id
         """
-        self._id = db.insert(query, self._name).id
+        res = db.insert(query, self._name)
+        if res is None:
+            raise rses_errors.AlreadyExists(self)
+        self._id = res.id
         log.debug('Created, new id: %s', self.id)
+        bus.publish(entity_key('recipe_category', self._id))
 
     def delete(self) -> None:
         """Deletes the recipe category"""
@@ -89,6 +99,7 @@ class RecipeCategory:
         WHERE id = %s
         """
         db.delete(query, self._id)
+        bus.publish(entity_key('recipe_category', self._id))
 
     def items(self) -> List['Recipe']:
         """All ingredients of this type"""
@@ -112,9 +123,37 @@ class RecipeCategory:
         res = db.select(query, self._id)
         self._name = res.name
 
+    @classmethod
+    def get_or_create(cls, name: str) -> 'RecipeCategory':
+        """Loads recipe category by name, creating it if it does not exist yet, in a single query"""
+        query = """
+        WITH created AS (
+          INSERT INTO recipe_category (name)
+          VALUES (%s)
+          ON CONFLICT DO NOTHING
+          RETURNING id
+        )
+        SELECT id FROM created
+        UNION ALL
+        SELECT id FROM recipe_category WHERE name = %s
+        """
+        res = db.insert(query, name, name)
+        if res is None:  # Created concurrently after our query started, so it could not see it
+            query = """
+            SELECT id
+            FROM recipe_category
+            WHERE name = %s
+            """
+            res = db.select(query, name)
+        bus.publish(entity_key('recipe_category', res.id))
+        return cls(recipe_category_id=res.id, name=name)
+
 
 class Recipe:
     """A recipe object"""
+    # Columns the setters update, nothing else is ever put into an update
+    COLUMNS = ('name', 'directions', 'picture', 'prepare_time', 'portions', 'language')
+
     def __init__(
             self, *,
             recipe_id: Optional[int] = None,
@@ -122,7 +161,8 @@ class Recipe:
             directions: str = '',
             picture: Optional[str] = None,
             prepare_time: Optional[int] = None,
-            portions: Optional[int] = None
+            portions: Optional[int] = None,
+            language: str = RSES_SEARCH_LANGUAGES[0]
     ) -> None:
         """
         :param name:            Name of the recipe
@@ -130,6 +170,7 @@ class Recipe:
         :param picture:         Picture of the finished thing
         :param prepare_time:    Prepare time in minutes
         :param portions:        For how many portions should the recipe be shown
+        :param language:        Text search configuration of the language it is written in, for searching
         """
         self._id: Optional[int] = recipe_id
         self._name: Optional[str] = name
@@ -137,8 +178,12 @@ class Recipe:
         self._picture: Optional[str] = picture
         self._prepare_time: Optional[int] = prepare_time
         self._portions: Optional[int] = portions
+        self._language: str = language
         self.ingredients: Dict[Ingredient, float] = dict()
         self.categories: List[RecipeCategory] = list()
+        # Columns changed while writes are deferred, saved all at once by `save`
+        self._deferred: bool = False
+        self._dirty: Dict[str, Any] = dict()
         if not self._id:
             self.create()
         else:
@@ -195,6 +240,15 @@ class Recipe:
     def portions(self, new_amount: int):
         self._portions = self.__updater('portions', new_amount)
 
+    @property
+    def language(self) -> str:
+        """Text search configuration of the language the recipe is written in, used for stemming when searching"""
+        return self._language
+
+    @language.setter
+    def language(self, new_language: str):
+        self._language = self.__updater('language', new_language)
+
     @property
     def wanted_portions(self) -> int:
         """For how many portions the ingredients are being shown"""
@@ -227,10 +281,14 @@ class Recipe:
             if param is None:
                 raise rses_errors.MissingParameter(name)
         query = """
-        INSERT INTO recipe (name, directions, picture, prepare_time, portions) 
-        VALUES (%s, %s, %s, %s, %s)
+        INSERT INTO recipe (name, directions, picture, prepare_time, portions, language) 
+        VALUES (%s, %s, %s, %s, %s, %s)
+        RETURNING id
         """
-        db.insert(query, self._name, self._directions, self._picture, self._prepare_time, self._portions)
+        self._id = db.insert(query, self._name, self._directions, self._picture, self._prepare_time,
+                             self._portions, self._language).id
+        log.debug('Created, new id: %s', self._id)
+        bus.publish(entity_key('recipe', self._id))
 
     def delete(self) -> None:
         """Deletes the recipe"""
@@ -239,6 +297,7 @@ class Recipe:
         WHERE id = %s
         """
         db.delete(query, self._name)
+        bus.publish(entity_key('recipe', self._id))
 
     def add_ingredient(self, ingredient: Ingredient, amount: float) -> None:
         """Adds an ingredient to the recipe"""
@@ -289,21 +348,35 @@ class Recipe:
         return True
 
     def cook(self) -> None:
-        """Adds the recipe the a log of cooked recipes and subtracts the ingredients from stock"""
-        if not self.can_be_cooked():
-            raise rses_errors.NotEnoughIngredients
+        """
+        Adds the recipe the a log of cooked recipes and subtracts the ingredients from stock
+
+        Also updates the aggregated history used for recommendations. All happens in one transaction,
+        in which the needed stock is locked and checked, so it is safe to cook at the same time as someone else,
+        raises NotEnoughIngredients otherwise
+        """
+        amounts: Dict[int, float] = dict()
+        for ingredient, amount in self.ingredients.items():
+            amounts[ingredient.id] = amounts.get(ingredient.id, 0.0) + amount
+        reservation = StockReservation(amounts, CONSUME, self._id)
+        price = self.current_price
         query = """
         INSERT INTO recipe_made (recipe, portions, price) 
         VALUES (%s, %s, %s)
         """
-        db.insert(query, self._id, self._portions, self.current_price)
-        for ingredient, amount in self.ingredients.items():
-            ingredient.remove_stock(amount)
+
+        def cook_in_transaction(cur) -> None:
+            """Takes the ingredients and records the cooking"""
+            reservation.take(cur)
+            cur.execute(query, (self._id, self._portions, price))
+            record_cooked(cur, self._id)
+        db.run_transaction(cook_in_transaction)
+        bus.publish(entity_key('recipe_made', self._id), entity_key('stock'))
 
     def __load_from_db(self) -> None:
         """Loads the recipe, it's ingredients and categories from the database"""
         query = """
-        SELECT name, directions, picture, prepare_time, portions
+        SELECT name, directions, picture, prepare_time, portions, language::TEXT AS language
         FROM recipe
         WHERE id = %s
         """
@@ -313,6 +386,7 @@ class Recipe:
         self._picture = res.picture
         self._prepare_time = res.prepare_time
         self._portions = res.portions
+        self._language = res.language
 
         query_ingredients = """
         SELECT ingredient, amount
@@ -322,7 +396,7 @@ class Recipe:
         res = db.select_all(query_ingredients, self._id)
         for i in res:
             ingredient = Ingredient(ingredient_id=i.ingredient)
-            self.ingredients[ingredient] = res.amount
+            self.ingredients[ingredient] = i.amount
         query_categories = """
         SELECT category
         FROM categorized_recipes
@@ -332,13 +406,139 @@ class Recipe:
         for category in res:
             self.categories.append(RecipeCategory(recipe_category_id=category.category))
 
+    @property
+    def dirty(self) -> Dict[str, Any]:
+        """Columns with their new values that were changed while deferred and not saved yet"""
+        return dict(self._dirty)
+
+    @contextmanager
+    def deferred(self) -> Iterator['Recipe']:
+        """
+        Setters within the block only mark the columns as changed, which are then saved in a single update
+
+        If the block raises, nothing is saved and the changes stay in `dirty`
+        """
+        self._deferred = True
+        try:
+            yield self
+        finally:
+            self._deferred = False
+        self.save()
+
+    def save(self) -> None:
+        """Writes all the changed columns in a single update"""
+        if not self._dirty:
+            return
+        log.debug('Saving changed columns %s of %s', ', '.join(self._dirty), self._name)
+        self.__check_columns(*self._dirty)
+        query = f"""
+        UPDATE recipe
+        SET {', '.join(f'{column} = %s' for column in self._dirty)}
+        WHERE id = %s
+        """
+        db.update(query, *self._dirty.values(), self._id)
+        self._dirty.clear()
+        bus.publish(entity_key('recipe', self._id))
+
     def __updater(self, column: str, new_value: Any) -> Any:
-        """Updates the Ingredient entry's value for specified column"""
-        log.debug('Updating recipe column %s from %s to %s', column, getattr(self, 'column'), new_value)
-        query = sql.SQL("""
+        """Updates the Recipe entry's value for specified column, or marks it as changed if deferred"""
+        self.__check_columns(column)
+        if self._deferred:
+            log.debug('Deferring update of recipe column %s to %s', column, new_value)
+            self._dirty[column] = new_value
+            return new_value
+        log.debug('Updating recipe column %s from %s to %s', column, getattr(self, column, None), new_value)
+        query = f"""
         UPDATE recipe
-        SET {} = %s
+        SET {column} = %s
         WHERE id = %s
-        """).format(sql.Identifier(column))
+        """
         db.update(query, new_value, self._id)
+        bus.publish(entity_key('recipe', self._id))
         return new_value
+
+    def __check_columns(self, *columns: str) -> None:
+        """Refuses columns that are not in `COLUMNS`, they are put into the update query as they are"""
+        unknown = set(columns).difference(self.COLUMNS)
+        if unknown:
+            raise ValueError(f'Columns {", ".join(sorted(unknown))} of recipe can not be updated')
+
+
+class RecipeSearch:
+    """Full text search in names and directions of recipes"""
+
+    def __init__(self, languages: Optional[List[str]] = None) -> None:
+        """
+        :param languages:   Text search configurations the query is parsed with, all configured by default
+        """
+        self.languages: List[str] = languages or RSES_SEARCH_LANGUAGES
+
+    def __str__(self):
+        return f'Recipe search in {", ".join(self.languages)}'
+
+    def __repr__(self):
+        return f'RecipeSearch(languages={self.languages})'
+
+    def show(self, text: str, limit: int = 20, offset: int = 0, categories: Optional[List[int]] = None,
+             cookable_only: bool = False) -> Dict[str, Any]:
+        """
+        Searches recipes, best matches first
+
+        The query is parsed with every configured language and the results are or-ed, so a recipe matches
+        if the words match in its own language. That keeps the query constant, so the GIN index is used.
+
+        :param text:            What to search for, supports "quoted phrases", or, and -excluded words
+        :param limit:           How many to list
+        :param offset:          Search result offset
+        :param categories:      Only recipes in all of these categories (ids)
+        :param cookable_only:   Only recipes that can be cooked from what is in stock
+        :return:                Total count of matches and the listed recipes with highlighted snippets
+        """
+        categories = categories or list()
+        query_text = ' || '.join(['websearch_to_tsquery(%s::REGCONFIG, %s)'] * len(self.languages))
+        query = f"""
+        SELECT found.id, found.name, found.rank, found.total,
+               ts_headline(found.language, found.directions, found.query, 'MaxFragments=2, MinWords=5, MaxWords=20')
+                 AS snippet
+        FROM (
+          SELECT r.id, r.name, r.language, r.directions, q.query,
+                 ts_rank_cd(r.search, q.query) AS rank,
+                 count(*) OVER () AS total
+          FROM recipe r, (SELECT {query_text} AS query) AS q
+          WHERE r.search @@ q.query
+          AND (
+            cardinality(%s::INT[]) = 0
+            OR (
+              SELECT count(*)
+              FROM categorized_recipes cr
+              WHERE cr.recipe = r.id
+              AND cr.category = ANY(%s::INT[])
+            ) = cardinality(%s::INT[])
+          )
+          AND (
+            NOT %s
+            OR NOT EXISTS (
+              SELECT 1
+              FROM recipe_ingredients ri
+              WHERE ri.recipe = r.id
+              AND ri.amount > (
+                SELECT COALESCE(sum(s.amount_left), 0)
+                FROM stock s
+                WHERE s.ingredient = ri.ingredient
+              )
+            )
+          )
+          ORDER BY rank DESC, r.name
+          LIMIT %s
+          OFFSET %s
+        ) AS found
+        ORDER BY found.rank DESC, found.name
+        """
+        args: List[Any] = list()
+        for language in self.languages:
+            args.extend([language, text])
+        args.extend([categories, categories, categories, cookable_only, limit, offset])
+        res = db.select_all(query, *args)
+        total = res[0].total if res else 0
+        recipes = json_dicts(RecipeMatch(item.id, item.name, item.rank, item.snippet) for item in res)
+        return dict(total=total, recipes=recipes)
@@ -0,0 +1,158 @@
+# coding=utf-8
+"""Forecasting consumption of ingredients, to buy them before they run out"""
+import datetime
+import logging
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Union
+
+from rses_config import RSES_FORECAST_HORIZON_DAYS
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, entity_key
+
+log = logging.getLogger(__name__)
+
+
+class Forecast(NamedTuple):
+    """When is an ingredient going to cross its thresholds at the forecast rate of consumption"""
+    ingredient_id: int
+    name: str
+    daily_rate: float
+    in_stock: float
+    days_to_suggestion: Optional[float]
+    days_to_rebuy: Optional[float]
+
+    @property
+    def buy_within(self) -> float:
+        """Days until the first threshold is crossed"""
+        return min(days for days in (self.days_to_suggestion, self.days_to_rebuy) if days is not None)
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, str, float, None]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(id=self.ingredient_id, name=self.name, daily_rate=self.daily_rate, in_stock=self.in_stock,
+                    days_to_suggestion=self.days_to_suggestion, days_to_rebuy=self.days_to_rebuy,
+                    buy_within=round(self.buy_within, 1))
+
+
+def smooth(series: Sequence[float], alpha: float) -> float:
+    """
+    Simple exponential smoothing, recent values count the most
+
+    :param series:  Values from the oldest, without gaps
+    :param alpha:   Weight of each new value against the level so far, between 0 and 1
+    :return:        The smoothed level after the last value
+    """
+    if not series:
+        return 0.0
+    # Starting from the mean instead of the first value does not overrate a single old day
+    level = sum(series) / len(series)
+    for value in series:
+        level += alpha * (value - level)
+    return level
+
+
+class ConsumptionForecaster:
+    """
+    Estimates how much of every ingredient is used per day, in a batch for all of them at once.
+
+    Daily usage comes from the history of cooked recipes and is smoothed, so recent weeks count the most.
+    Stock that was used up outside of recipes is covered by the average rate at which recently bought
+    lots were used, the higher of the two estimates wins. Rates are stored in consumption_forecast,
+    requests then only project the current stock against the thresholds with them.
+    """
+    # Hot query, tests/test_query_plans.py checks it is planned with an index
+    QUERY_STOCK_RATES = """
+    SELECT ingredient, sum(amount - amount_left) / GREATEST(%s - min(time_bought)::DATE, 1) AS rate
+    FROM stock
+    WHERE time_bought >= %s
+    GROUP BY ingredient
+    """
+    # Shared with the async routes
+    QUERY_DUE = """
+    WITH in_stock AS (
+      SELECT ingredient, sum(amount_left) AS amount
+      FROM stock
+      WHERE amount_left > 0
+      GROUP BY ingredient
+    ), projected AS (
+      SELECT i.id, i.name, f.daily_rate, COALESCE(s.amount, 0) AS in_stock,
+             CASE WHEN i.suggestion_threshold > 0
+               THEN GREATEST(COALESCE(s.amount, 0) - i.suggestion_threshold, 0) / f.daily_rate
+             END AS days_to_suggestion,
+             CASE WHEN i.rebuy_threshold > 0
+               THEN GREATEST(COALESCE(s.amount, 0) - i.rebuy_threshold, 0) / f.daily_rate
+             END AS days_to_rebuy
+      FROM consumption_forecast f
+      JOIN ingredient i ON i.id = f.ingredient
+      LEFT JOIN in_stock s ON s.ingredient = f.ingredient
+      WHERE i.suggestion_threshold > 0 OR i.rebuy_threshold > 0
+    )
+    SELECT *
+    FROM projected
+    WHERE LEAST(days_to_suggestion, days_to_rebuy) <= %s
+    ORDER BY LEAST(days_to_suggestion, days_to_rebuy), name
+    """
+
+    def __init__(self, alpha: float = 0.1, history_days: int = 90) -> None:
+        """
+        :param alpha:           Smoothing factor, higher reacts faster to changes in consumption
+        :param history_days:    How far into the history to look
+        """
+        self.alpha: float = alpha
+        self.history_days: int = history_days
+
+    def __str__(self):
+        return f'Consumption forecaster over {self.history_days} days'
+
+    def __repr__(self):
+        return f'ConsumptionForecaster(alpha={self.alpha}, history_days={self.history_days})'
+
+    def rates(self, today: Optional[datetime.date] = None) -> Dict[int, float]:
+        """Forecast daily consumption of every ingredient that was used in the history, by its id"""
+        today = today or datetime.date.today()
+        start = today - datetime.timedelta(days=self.history_days)
+        query_cooked = """
+        SELECT ri.ingredient, rm.time_made::DATE AS day, sum(ri.amount * rm.portions / GREATEST(r.portions, 1)) AS used
+        FROM recipe_made rm
+        JOIN recipe r ON r.id = rm.recipe
+        JOIN recipe_ingredients ri ON ri.recipe = rm.recipe
+        WHERE rm.time_made >= %s
+        AND rm.time_made < %s
+        GROUP BY ri.ingredient, day
+        """
+        series: Dict[int, List[float]] = defaultdict(lambda: [0.0] * self.history_days)
+        for row in db.select_all(query_cooked, start, today):
+            series[row.ingredient][(row.day - start).days] += row.used
+        rates = {ingredient: smooth(days, self.alpha) for ingredient, days in series.items()}
+        for row in db.select_all(self.QUERY_STOCK_RATES, today, start):
+            rates[row.ingredient] = max(rates.get(row.ingredient, 0.0), row.rate)
+        return rates
+
+    def refresh(self, today: Optional[datetime.date] = None) -> int:
+        """
+        Computes the rates of all ingredients and replaces the stored forecast with them
+
+        :return:    For how many ingredients there is a forecast
+        """
+        rates = {ingredient: rate for ingredient, rate in self.rates(today).items() if rate > 0}
+        log.debug('Storing consumption forecast of %s ingredients', len(rates))
+        ingredients = list(rates)
+
+        def store(cur: TransactionCursor) -> None:
+            cur.execute('DELETE FROM consumption_forecast')
+            cur.execute("""
+            INSERT INTO consumption_forecast (ingredient, daily_rate)
+            SELECT * FROM unnest(%s::INT[], %s::FLOAT[])
+            """, (ingredients, [rates[ingredient] for ingredient in ingredients]))
+        db.run_transaction(store)
+        bus.publish(entity_key('consumption_forecast'))
+        return len(rates)
+
+    @staticmethod
+    def due(horizon_days: float = RSES_FORECAST_HORIZON_DAYS) -> List[Forecast]:
+        """
+        Ingredients that will cross one of their thresholds within the horizon, soonest first
+
+        Ingredients that are already below a threshold are included with 0 days.
+        """
+        return [Forecast(*row) for row in db.select_all(ConsumptionForecaster.QUERY_DUE, horizon_days, cache=True)]
@@ -0,0 +1,387 @@
+# coding=utf-8
+"""Bulk imports of recipes and stock"""
+import csv
+import itertools
+import json
+import logging
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Union
+
+from rses_config import RSES_SEARCH_LANGUAGES
+from rses_connections import db, copy_rows, TransactionCursor
+from rses_invalidation import bus, entity_key
+from objects.ledger import record_movements, PURCHASE
+from objects.pricing import record_prices
+
+log = logging.getLogger(__name__)
+
+JSONL: str = 'jsonl'
+CSV: str = 'csv'
+FORMATS = (JSONL, CSV)
+# How many names of missing ingredients and numbers of unreadable lines are kept for the report
+_MISSING_SAMPLE: int = 100
+
+
+def read_jsonl(stream: TextIO, report: Optional['ImportReport'] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Reads records from JSON lines, one per line, line by line. A recipe looks like::
+
+        {"name": "Pancakes", "directions": "...", "portions": 4, "prepare_time": 20, "language": "english",
+         "ingredients": {"Flour": 250, "Milk": 0.5}, "categories": ["Sweet"]}
+
+    Ingredients can also be a list of objects with name and amount. A line of a receipt (stock) looks like::
+
+        {"ingredient": "Flour", "amount": 1000, "price": 25.9, "time_bought": "2017-05-17T18:30:00",
+         "expiration_date": "2018-01-01"}
+
+    Only ingredient and amount are required. Lines that are not JSON objects are skipped and counted
+    as invalid in the report.
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if isinstance(record, dict):
+            yield record
+        else:
+            _reject(report, number)
+
+
+def read_stock_csv(stream: TextIO) -> Iterator[Dict[str, Any]]:
+    """Reads lines of receipts from CSV with a header, columns are the same as for JSON lines, row by row"""
+    for row in csv.DictReader(stream):
+        yield {column: value if value != '' else None for column, value in row.items()}
+
+
+def read_csv(stream: TextIO, report: Optional['ImportReport'] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Reads recipes from CSV with a header, one recipe per row, row by row
+
+    Columns are the same as for JSON lines, ingredients are written as 'Flour:250;Milk:0.5'
+    and categories as 'Sweet;Quick'. Rows with an amount that is not a number are skipped and counted
+    as invalid in the report.
+    """
+    reader = csv.DictReader(stream)
+    for row in reader:
+        ingredients = dict()
+        try:
+            for item in filter(None, (row.get('ingredients') or '').split(';')):
+                name, _, amount = item.rpartition(':')
+                ingredients[name.strip()] = float(amount)
+        except ValueError:
+            _reject(report, reader.line_num)
+            continue
+        row['ingredients'] = ingredients
+        row['categories'] = [name.strip() for name in (row.get('categories') or '').split(';') if name.strip()]
+        yield row
+
+
+class ImportReport:
+    """What happened during an import"""
+
+    def __init__(self) -> None:
+        self.read: int = 0
+        self.created: int = 0
+        self.invalid: int = 0
+        self.missing_ingredients: Set[str] = set()
+        self.invalid_lines: List[int] = list()
+
+    def __str__(self):
+        return f'Imported {self.created} of {self.read} records, {self.invalid} invalid'
+
+    def __repr__(self):
+        return f'ImportReport(read={self.read}, created={self.created}, invalid={self.invalid}, ' \
+               f'missing_ingredients={self.missing_ingredients}, invalid_lines={self.invalid_lines})'
+
+    def reject(self, line: int) -> None:
+        """
+        Counts a line of the input that could not be read at all
+
+        :param line:    Number of the line, from 1
+        """
+        self.read += 1
+        self.invalid += 1
+        if len(self.invalid_lines) < _MISSING_SAMPLE:
+            self.invalid_lines.append(line)
+
+    @property
+    def skipped(self) -> int:
+        """Records that were not created because they already exist (recipes of the same name)"""
+        return self.read - self.invalid - self.created
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, List[str], List[int]]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(read=self.read, created=self.created, skipped=self.skipped, invalid=self.invalid,
+                    missing_ingredients=sorted(self.missing_ingredients), invalid_lines=self.invalid_lines)
+
+
+class RecipeImporter:
+    """
+    Imports recipes with their ingredients and categories in chunks, with constant memory.
+
+    Each chunk is copied into temporary staging tables and merged in a single transaction, names are resolved
+    to ids by joins, so a chunk takes a handful of statements no matter how big it is. Recipes that already
+    exist are skipped, missing categories are created, ingredients have to exist and are reported otherwise.
+    """
+
+    def __init__(self, chunk_size: int = 1000, language: str = RSES_SEARCH_LANGUAGES[0]) -> None:
+        """
+        :param chunk_size:  How many recipes to merge in one transaction
+        :param language:    Text search configuration for recipes that don't specify it
+        """
+        self.chunk_size: int = chunk_size
+        self.language: str = language
+
+    def __str__(self):
+        return f'Recipe importer in chunks of {self.chunk_size}'
+
+    def __repr__(self):
+        return f'RecipeImporter(chunk_size={self.chunk_size}, language={self.language})'
+
+    def import_stream(self, stream: TextIO, file_format: str = JSONL) -> ImportReport:
+        """Imports recipes from a text stream in JSON lines or CSV"""
+        if file_format not in FORMATS:
+            raise ValueError(f'Unknown format {file_format}, use one of {", ".join(FORMATS)}')
+        report = ImportReport()
+        records = read_jsonl(stream, report) if file_format == JSONL else read_csv(stream, report)
+        return self.import_records(records, report)
+
+    def import_records(self, records: Iterable[Dict[str, Any]], report: Optional[ImportReport] = None) -> ImportReport:
+        """
+        Imports recipes from dictionaries, see `read_jsonl` for their shape
+
+        :param records:     The recipes
+        :param report:      Report to add to, of the lines the records were read from
+        """
+        report = report or ImportReport()
+        for chunk in _chunks(records, self.chunk_size):
+            report.read += len(chunk)
+            valid = [record for record in chunk if record.get('name') and record.get('portions')]
+            report.invalid += len(chunk) - len(valid)
+            if valid:
+                created, missing = db.run_transaction(lambda cur: self.__merge(cur, valid))
+                report.created += created
+                for name in missing:
+                    if len(report.missing_ingredients) < _MISSING_SAMPLE:
+                        report.missing_ingredients.add(name)
+            log.debug('%s', report)
+        bus.publish(*(entity_key(table) for table in
+                      ('recipe', 'recipe_category', 'recipe_ingredients', 'categorized_recipes')))
+        return report
+
+    def __merge(self, cur: TransactionCursor, chunk: List[Dict[str, Any]]) -> Any:
+        """
+        Stages the chunk and merges it into the recipe tables
+
+        :return:    How many recipes were created and names of ingredients that don't exist
+        """
+        cur.execute("""
+        CREATE TEMPORARY TABLE import_recipe (
+          name TEXT, directions TEXT, picture TEXT, prepare_time INT, portions INT, language TEXT
+        ) ON COMMIT DROP;
+        CREATE TEMPORARY TABLE import_recipe_ingredient (recipe TEXT, ingredient TEXT, amount FLOAT) ON COMMIT DROP;
+        CREATE TEMPORARY TABLE import_recipe_category (recipe TEXT, category TEXT) ON COMMIT DROP;
+        CREATE TEMPORARY TABLE import_created (id INT, name TEXT) ON COMMIT DROP;
+        """)
+        copy_rows(cur, 'import_recipe', ('name', 'directions', 'picture', 'prepare_time', 'portions', 'language'), (
+            (record['name'], record.get('directions') or '', record.get('picture') or None,
+             record.get('prepare_time') or None, record['portions'], record.get('language') or self.language)
+            for record in chunk
+        ))
+        copy_rows(cur, 'import_recipe_ingredient', ('recipe', 'ingredient', 'amount'), (
+            (record['name'], name, amount) for record in chunk for name, amount in _ingredients(record)
+        ))
+        copy_rows(cur, 'import_recipe_category', ('recipe', 'category'), (
+            (record['name'], category) for record in chunk for category in record.get('categories') or ()
+        ))
+        query_recipes = """
+        WITH created AS (
+          INSERT INTO recipe (name, directions, picture, prepare_time, portions, language)
+          SELECT DISTINCT ON (name) name, directions, picture, prepare_time, portions, language::REGCONFIG
+          FROM import_recipe
+          ON CONFLICT DO NOTHING
+          RETURNING id, name
+        )
+        INSERT INTO import_created
+        SELECT id, name
+        FROM created
+        """
+        cur.execute(query_recipes)
+        created = cur.rowcount
+        query_missing = """
+        SELECT DISTINCT staged.ingredient AS name
+        FROM import_recipe_ingredient staged
+        JOIN import_created c ON c.name = staged.recipe
+        LEFT JOIN ingredient i ON i.name = staged.ingredient
+        WHERE i.id IS NULL
+        """
+        cur.execute(query_missing)
+        missing = [row.name for row in cur.fetchall()]
+        query_ingredients = """
+        INSERT INTO recipe_ingredients (recipe, ingredient, amount)
+        SELECT c.id, i.id, sum(staged.amount)
+        FROM import_recipe_ingredient staged
+        JOIN import_created c ON c.name = staged.recipe
+        JOIN ingredient i ON i.name = staged.ingredient
+        GROUP BY c.id, i.id
+        """
+        cur.execute(query_ingredients)
+        query_categories = """
+        INSERT INTO recipe_category (name)
+        SELECT DISTINCT staged.category
+        FROM import_recipe_category staged
+        JOIN import_created c ON c.name = staged.recipe
+        ON CONFLICT DO NOTHING
+        """
+        cur.execute(query_categories)
+        query_categorized = """
+        INSERT INTO categorized_recipes (recipe, category)
+        SELECT DISTINCT c.id, rc.id
+        FROM import_recipe_category staged
+        JOIN import_created c ON c.name = staged.recipe
+        JOIN recipe_category rc ON rc.name = staged.category
+        """
+        cur.execute(query_categorized)
+        return created, missing
+
+
+class StockIngester:
+    """
+    Adds purchased stock in bulk, from receipts or back-filled history, with constant memory.
+
+    Lines are copied into a staging table in chunks and merged in a single statement per chunk, ingredient
+    names are resolved by a join and missing expiration dates are computed from the ingredient's durability.
+    Caches depending on stock are invalidated once per ingestion, not per line.
+    """
+
+    def __init__(self, chunk_size: int = 5000) -> None:
+        """
+        :param chunk_size:  How many lines to merge in one transaction
+        """
+        self.chunk_size: int = chunk_size
+
+    def __str__(self):
+        return f'Stock ingester in chunks of {self.chunk_size}'
+
+    def __repr__(self):
+        return f'StockIngester(chunk_size={self.chunk_size})'
+
+    def ingest_stream(self, stream: TextIO, file_format: str = JSONL) -> ImportReport:
+        """Ingests receipt lines from a text stream in JSON lines or CSV"""
+        if file_format not in FORMATS:
+            raise ValueError(f'Unknown format {file_format}, use one of {", ".join(FORMATS)}')
+        report = ImportReport()
+        records = read_jsonl(stream, report) if file_format == JSONL else read_stock_csv(stream)
+        return self.ingest_records(records, report)
+
+    def ingest_records(self, records: Iterable[Dict[str, Any]], report: Optional[ImportReport] = None) -> ImportReport:
+        """
+        Ingests receipt lines from dictionaries, see `read_jsonl` for their shape
+
+        :param records:     The receipt lines
+        :param report:      Report to add to, of the lines the records were read from
+        """
+        report = report or ImportReport()
+        ingredients: Set[int] = set()
+        for chunk in _chunks(records, self.chunk_size):
+            report.read += len(chunk)
+            valid = [record for record in chunk if record.get('ingredient') and _amount(record) > 0]
+            report.invalid += len(chunk) - len(valid)
+            if valid:
+                created, missing = db.run_transaction(lambda cur: self.__merge(cur, valid, ingredients))
+                report.created += created
+                report.invalid += len(valid) - created
+                for name in missing:
+                    if len(report.missing_ingredients) < _MISSING_SAMPLE:
+                        report.missing_ingredients.add(name)
+            log.debug('%s', report)
+        if ingredients:
+            bus.publish(entity_key('stock'), entity_key('price_sketch'),
+                        *(entity_key('ingredient', ingredient) for ingredient in ingredients))
+        return report
+
+    @staticmethod
+    def __merge(cur: TransactionCursor, chunk: List[Dict[str, Any]], ingredients: Set[int]) -> Any:
+        """
+        Stages the chunk and merges it into stock
+
+        :param ingredients:     Ids of ingredients that got new stock are added here
+        :return:                How many lots were added and names of ingredients that don't exist
+        """
+        cur.execute("""
+        CREATE TEMPORARY TABLE import_stock (
+          ingredient TEXT, amount FLOAT, price FLOAT, time_bought TIMESTAMP, expiration_date DATE
+        ) ON COMMIT DROP
+        """)
+        copy_rows(cur, 'import_stock', ('ingredient', 'amount', 'price', 'time_bought', 'expiration_date'), (
+            (record['ingredient'], record['amount'], record.get('price'), record.get('time_bought'),
+             record.get('expiration_date'))
+            for record in chunk
+        ))
+        query_missing = """
+        SELECT DISTINCT staged.ingredient AS name
+        FROM import_stock staged
+        LEFT JOIN ingredient i ON i.name = staged.ingredient
+        WHERE i.id IS NULL
+        """
+        cur.execute(query_missing)
+        missing = [row.name for row in cur.fetchall()]
+        query_stock = """
+        INSERT INTO stock (ingredient, amount, amount_left, expiration_date, time_bought, price)
+        SELECT i.id, staged.amount, staged.amount,
+               COALESCE(staged.expiration_date, COALESCE(staged.time_bought, NOW())::DATE + i.durability),
+               COALESCE(staged.time_bought, NOW()), staged.price
+        FROM import_stock staged
+        JOIN ingredient i ON i.name = staged.ingredient
+        RETURNING id, ingredient, amount, time_bought, price / NULLIF(amount, 0) AS unit_price
+        """
+        cur.execute(query_stock)
+        added = cur.fetchall()
+        record_movements(cur, PURCHASE, [row.ingredient for row in added], [row.id for row in added],
+                         [row.amount for row in added], [row.time_bought for row in added])
+        prices: Dict[int, List[float]] = dict()
+        for row in added:
+            ingredients.add(row.ingredient)
+            if row.unit_price is not None:
+                prices.setdefault(row.ingredient, list()).append(row.unit_price)
+        record_prices(cur, prices)
+        return len(added), missing
+
+
+def _reject(report: Optional[ImportReport], line: int) -> None:
+    """Skips an unreadable line of the input, counted in the report if there is one"""
+    log.warning('Skipping unreadable line %s of the import', line)
+    if report is not None:
+        report.reject(line)
+
+
+def _amount(record: Dict[str, Any]) -> float:
+    """Amount of a receipt line, 0 if it is missing or not a number"""
+    try:
+        return float(record.get('amount') or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _chunks(records: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Splits the records into lists of at most size records, reading them lazily"""
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _ingredients(record: Dict[str, Any]) -> Iterator[Any]:
+    """(name, amount) pairs of the record's ingredients, given as a mapping or a list of objects"""
+    ingredients: Optional[Union[Dict[str, float], List[Dict[str, Any]]]] = record.get('ingredients')
+    if not ingredients:
+        return iter(())
+    if isinstance(ingredients, dict):
+        return iter(ingredients.items())
+    return ((item['name'], item['amount']) for item in ingredients)
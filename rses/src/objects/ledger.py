@@ -0,0 +1,247 @@
+# coding=utf-8
+"""Append-only ledger of stock movements, for the history of stock and its state at any point in time"""
+import datetime
+import logging
+from typing import Dict, List, NamedTuple, Optional, Sequence, Union
+
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, entity_key
+
+log = logging.getLogger(__name__)
+
+PURCHASE: str = 'purchase'
+CONSUME: str = 'consume'
+ADJUST: str = 'adjust'
+EXPIRE: str = 'expire'
+MOVEMENTS = (PURCHASE, CONSUME, ADJUST, EXPIRE)
+
+
+def record_movements(cur: TransactionCursor, movement: str, ingredients: Sequence[int], lots: Sequence[int],
+                     amounts: Sequence[float], times: Optional[Sequence[Optional[datetime.datetime]]] = None,
+                     recipe_id: Optional[int] = None) -> None:
+    """
+    Appends movements of stock lots to the ledger, run in the transaction changing the stock
+
+    :param cur:         Cursor of the transaction changing the stock
+    :param movement:    What happened, one of MOVEMENTS
+    :param ingredients: Ingredient of each lot
+    :param lots:        Ids of the changed stock lots
+    :param amounts:     Change of each lot, positive when added, negative when taken
+    :param times:       When it happened, for history recorded after the fact, now by default
+    :param recipe_id:   The recipe the stock was consumed by
+    """
+    if not lots:
+        return
+    query = """
+    INSERT INTO stock_ledger (time, ingredient, lot, movement, amount, recipe)
+    SELECT COALESCE(moved.time, clock_timestamp()), moved.ingredient, moved.lot, %s, moved.amount, %s
+    FROM unnest(%s::TIMESTAMP[], %s::INT[], %s::INT[], %s::FLOAT[]) AS moved (time, ingredient, lot, amount)
+    """
+    cur.execute(query, (movement, recipe_id, list(times or [None] * len(lots)), list(ingredients), list(lots),
+                        list(amounts)))
+    earliest = min((time for time in times or () if time is not None), default=None)
+    if earliest is not None:
+        # Snapshots taken after the movement happened don't include it and have to go
+        cur.execute('DELETE FROM stock_snapshot WHERE taken_at >= %s', (earliest,))
+
+
+class Movement(NamedTuple):
+    """One change of a stock lot"""
+    time: datetime.datetime
+    ingredient_id: int
+    lot: int
+    movement: str
+    amount: float
+    recipe_id: Optional[int]
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, str, float, None]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(time=self.time.isoformat(), ingredient=self.ingredient_id, lot=self.lot,
+                    movement=self.movement, amount=self.amount, recipe=self.recipe_id)
+
+
+class StockLedger:
+    """
+    History of stock, answering what was in the pantry at any point in time and where an ingredient went.
+
+    Every change of stock appends a movement to stock_ledger in the same transaction. Snapshots of the total
+    amounts are taken periodically (see `snapshot`), each one compacted from the previous snapshot and the
+    movements since, so the state at a point in time is the nearest older snapshot plus a bounded tail.
+    """
+
+    def __str__(self):
+        return 'Stock ledger'
+
+    def __repr__(self):
+        return 'StockLedger()'
+
+    @staticmethod
+    def stock_at(when: datetime.datetime, ingredient_id: Optional[int] = None) -> Dict[int, float]:
+        """
+        Amounts in stock at the time
+
+        :param when:            Point in time
+        :param ingredient_id:   Only this ingredient, all by default
+        :return:                Amounts of ingredients that were in stock, by ingredient id
+        """
+        query = """
+        WITH base AS (
+          SELECT taken_at
+          FROM stock_snapshot
+          WHERE taken_at <= %s
+          ORDER BY taken_at DESC
+          LIMIT 1
+        )
+        SELECT ingredient, sum(amount) AS amount
+        FROM (
+          SELECT ingredient, amount
+          FROM stock_snapshot_amount
+          WHERE taken_at = (SELECT taken_at FROM base)
+          UNION ALL
+          SELECT ingredient, amount
+          FROM stock_ledger
+          WHERE time > COALESCE((SELECT taken_at FROM base), '-infinity'::TIMESTAMP)
+          AND time <= %s
+        ) AS moved
+        WHERE %s::INT IS NULL OR ingredient = %s
+        GROUP BY ingredient
+        HAVING abs(sum(amount)) > 1e-9
+        """
+        rows = db.select_all(query, when, when, ingredient_id, ingredient_id)
+        return {row.ingredient: row.amount for row in rows}
+
+    @staticmethod
+    def history(ingredient_id: int, limit: int = 50, since: Optional[datetime.datetime] = None,
+                until: Optional[datetime.datetime] = None) -> List[Movement]:
+        """Movements of the ingredient between the times, latest first"""
+        query = """
+        SELECT time, ingredient, lot, movement::TEXT AS movement, amount, recipe
+        FROM stock_ledger
+        WHERE ingredient = %s
+        AND time >= COALESCE(%s::TIMESTAMP, '-infinity'::TIMESTAMP)
+        AND time <= COALESCE(%s::TIMESTAMP, 'infinity'::TIMESTAMP)
+        ORDER BY time DESC
+        LIMIT %s
+        """
+        return [Movement(*row) for row in db.select_all(query, ingredient_id, since, until, limit)]
+
+    @staticmethod
+    def snapshot() -> datetime.datetime:
+        """
+        Takes a snapshot of the amounts in stock now, run periodically
+
+        Writers of the ledger are blocked for the moment it takes, so no movement can commit behind it.
+
+        :return:    Time of the snapshot
+        """
+        def take(cur: TransactionCursor) -> datetime.datetime:
+            cur.execute('LOCK TABLE stock_ledger IN SHARE MODE')
+            cur.execute('SELECT clock_timestamp()::TIMESTAMP AS now, max(taken_at) AS previous FROM stock_snapshot')
+            row = cur.fetchone()
+            cur.execute('INSERT INTO stock_snapshot (taken_at) VALUES (%s)', (row.now,))
+            query = """
+            INSERT INTO stock_snapshot_amount (taken_at, ingredient, amount)
+            SELECT %(now)s, ingredient, sum(amount)
+            FROM (
+              SELECT ingredient, amount
+              FROM stock_snapshot_amount
+              WHERE taken_at = %(previous)s::TIMESTAMP
+              UNION ALL
+              SELECT ingredient, amount
+              FROM stock_ledger
+              WHERE time > COALESCE(%(previous)s::TIMESTAMP, '-infinity'::TIMESTAMP)
+              AND time <= %(now)s
+            ) AS moved
+            GROUP BY ingredient
+            HAVING abs(sum(amount)) > 1e-9
+            """
+            cur.execute(query, dict(now=row.now, previous=row.previous))
+            return row.now
+        taken_at = db.run_transaction(take)
+        log.debug('Took a stock snapshot at %s', taken_at)
+        return taken_at
+
+    @staticmethod
+    def prune(keep: datetime.timedelta) -> int:
+        """Drops snapshots older than keep, except the newest of them, so history stays reachable, returns count"""
+        query = """
+        DELETE FROM stock_snapshot
+        WHERE taken_at < (
+          SELECT max(taken_at)
+          FROM stock_snapshot
+          WHERE taken_at < NOW() - %s
+        )
+        """
+        return db.delete(query, keep)
+
+    @staticmethod
+    def expire(today: Optional[datetime.date] = None) -> int:
+        """
+        Throws out what is left of lots past their expiration date (or durability), recording it in the ledger
+
+        :return:    How many lots expired
+        """
+        today = today or datetime.date.today()
+
+        def throw_out(cur: TransactionCursor) -> int:
+            query = """
+            UPDATE stock s
+            SET amount_left = 0
+            FROM (
+              SELECT s.id, s.amount_left
+              FROM stock s
+              JOIN ingredient i ON i.id = s.ingredient
+              WHERE s.amount_left > 0
+              AND COALESCE(s.expiration_date, s.time_bought::DATE + i.durability) < %s
+              ORDER BY s.ingredient, s.time_bought, s.id
+              FOR UPDATE OF s
+            ) AS expired
+            WHERE s.id = expired.id
+            RETURNING s.id, s.ingredient, expired.amount_left
+            """
+            cur.execute(query, (today,))
+            lots = cur.fetchall()
+            record_movements(cur, EXPIRE, [lot.ingredient for lot in lots], [lot.id for lot in lots],
+                             [-lot.amount_left for lot in lots])
+            return len(lots)
+        expired = db.run_transaction(throw_out)
+        if expired:
+            bus.publish(entity_key('stock'))
+        log.debug('%s stock lots expired', expired)
+        return expired
+
+    @staticmethod
+    def backfill() -> int:
+        """
+        Records stock that predates the ledger, as bought when it was and used up (adjusted) now
+
+        :return:    How many lots were recorded
+        """
+        def record(cur: TransactionCursor) -> int:
+            # All in the database, there can be millions of lots
+            query = """
+            WITH lots AS (
+              SELECT s.id, s.ingredient, s.amount, s.amount_left, s.time_bought
+              FROM stock s
+              WHERE NOT EXISTS (SELECT 1 FROM stock_ledger l WHERE l.lot = s.id)
+            ), bought AS (
+              INSERT INTO stock_ledger (time, ingredient, lot, movement, amount)
+              SELECT COALESCE(time_bought, clock_timestamp()), ingredient, id, %s, amount
+              FROM lots
+              RETURNING time
+            ), used AS (
+              INSERT INTO stock_ledger (ingredient, lot, movement, amount)
+              SELECT ingredient, id, %s, amount_left - amount
+              FROM lots
+              WHERE amount_left < amount
+            )
+            SELECT count(*) AS lots, min(time) AS earliest
+            FROM bought
+            """
+            cur.execute(query, (PURCHASE, ADJUST))
+            row = cur.fetchone()
+            if row.earliest is not None:
+                cur.execute('DELETE FROM stock_snapshot WHERE taken_at >= %s', (row.earliest,))
+            return row.lots
+        return db.run_transaction(record)
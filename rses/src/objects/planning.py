@@ -0,0 +1,221 @@
+# coding=utf-8
+"""Planning meals for the week against what is in stock"""
+import datetime
+import logging
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from rses_config import RSES_PLANNER_EXPIRY_DAYS
+from rses_connections import db
+from rses_invalidation import bus, entity_key
+from objects.stock import Ingredient
+
+log = logging.getLogger(__name__)
+
+
+class PlannedMeal(NamedTuple):
+    """A recipe picked for one of the meals"""
+    recipe_id: int
+    name: str
+    portions: int
+    cost: float
+    rescued: float
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, str, float]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(recipe=self.recipe_id, name=self.name, portions=self.portions,
+                    cost=round(self.cost, 2), rescued=round(self.rescued, 2))
+
+
+class MealPlan:
+    """Picked meals and what has to be bought for them"""
+
+    def __init__(self, meals: List[PlannedMeal], shopping: Dict[int, float]) -> None:
+        """
+        :param meals:       The meals in the order they were picked
+        :param shopping:    How much of which ingredient (by id) is missing in stock for the meals
+        """
+        self.meals: List[PlannedMeal] = meals
+        self.shopping: Dict[int, float] = shopping
+
+    def __str__(self):
+        return f'Meal plan of {len(self.meals)} meals for {self.cost}'
+
+    def __repr__(self):
+        return f'MealPlan(meals={self.meals}, shopping={self.shopping})'
+
+    @property
+    def cost(self) -> float:
+        """Estimated price of everything that has to be bought"""
+        return sum(meal.cost for meal in self.meals)
+
+    @property
+    def rescued(self) -> float:
+        """Value of the soon to expire stock the plan uses up"""
+        return sum(meal.rescued for meal in self.meals)
+
+    def push_to_shopping_list(self) -> None:
+        """
+        Makes sure the shopping list wants at least what is missing for the plan
+
+        Pushing the same plan again changes nothing, what is already wanted there counts towards the plan.
+        """
+        if not self.shopping:
+            return
+        log.debug('Adding %s ingredients of a meal plan to the shopping list', len(self.shopping))
+        query = """
+        INSERT INTO shopping_list (ingredient, wanted_amount)
+        SELECT * FROM unnest(%s::INT[], %s::FLOAT[])
+        ON CONFLICT (ingredient) DO UPDATE SET
+          wanted_amount = GREATEST(shopping_list.wanted_amount, EXCLUDED.wanted_amount)
+        """
+        ingredients = list(self.shopping)
+        db.insert(query, ingredients, [self.shopping[ingredient] for ingredient in ingredients])
+        bus.publish(*(entity_key('shopping_list', ingredient) for ingredient in ingredients))
+
+    @property
+    def json_dict(self) -> Dict[str, Union[float, list]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        shopping = [dict(ingredient=ingredient, amount=amount) for ingredient, amount in self.shopping.items()]
+        return dict(meals=[meal.json_dict for meal in self.meals], shopping=shopping,
+                    cost=round(self.cost, 2), rescued=round(self.rescued, 2))
+
+
+class MealPlanner:
+    """
+    Picks recipes for a number of meals, so that as little as possible has to be bought
+    and as much as possible of what is about to expire gets eaten.
+
+    Everything is loaded in a few bulk queries, recipes are then scored against a simulated stock.
+    The search is greedy - the best recipe is picked for each meal, its ingredients are taken from
+    the simulated stock (soonest to expire first) and only recipes sharing an ingredient with it are scored again.
+    """
+
+    def __init__(self, expiry_days: int = RSES_PLANNER_EXPIRY_DAYS, waste_weight: float = 1.0) -> None:
+        """
+        :param expiry_days:     Stock expiring within this many days counts as rescued when used
+        :param waste_weight:    How much is rescuing stock worth compared to saving the same amount on shopping
+        """
+        self.expiry_days: int = expiry_days
+        self.waste_weight: float = waste_weight
+        # Per portion needs of every recipe, (ingredient, amount) pairs
+        self._needs: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+        self._recipes: Dict[int, str] = dict()
+        # Which recipes need an ingredient
+        self._used_by: Dict[int, List[int]] = defaultdict(list)
+        # Usable lots of every ingredient, soonest to expire first, as [days to expiration, amount left]
+        self._lots: Dict[int, List[List[float]]] = defaultdict(list)
+        self._prices: Dict[int, float] = dict()
+        self._default_price: float = 0.0
+
+    def __str__(self):
+        return 'Meal planner'
+
+    def __repr__(self):
+        return f'MealPlanner(expiry_days={self.expiry_days}, waste_weight={self.waste_weight})'
+
+    def plan(self, meals: int, portions: int) -> MealPlan:
+        """
+        Plans the meals
+
+        :param meals:       How many meals to plan, every recipe is picked at most once
+        :param portions:    How many portions each meal should have
+        :return:            The plan with the shopping needed for it
+        """
+        self.__load()
+        scores: Dict[int, Tuple[float, float, float]] = {
+            recipe: self.__evaluate(recipe, portions) for recipe in self._recipes
+        }
+        planned: List[PlannedMeal] = list()
+        shopping: Dict[int, float] = defaultdict(float)
+        for _ in range(meals):
+            if not scores:
+                log.debug('Ran out of recipes to plan')
+                break
+            best = min(scores, key=lambda recipe: scores[recipe][0])
+            _, cost, rescued = scores.pop(best)
+            planned.append(PlannedMeal(best, self._recipes[best], portions, cost, rescued))
+            changed = set()
+            for ingredient, per_portion in self._needs[best]:
+                missing = self.__take(ingredient, per_portion * portions)
+                if missing > 0:
+                    shopping[ingredient] += missing
+                changed.add(ingredient)
+            for recipe in {recipe for ingredient in changed for recipe in self._used_by[ingredient]}:
+                if recipe in scores:
+                    scores[recipe] = self.__evaluate(recipe, portions)
+        log.debug('Planned %s meals, %s ingredients to buy', len(planned), len(shopping))
+        return MealPlan(planned, dict(shopping))
+
+    def __evaluate(self, recipe: int, portions: int) -> Tuple[float, float, float]:
+        """
+        Scores the recipe against the simulated stock, lower is better
+
+        :return:    The score, price of what would have to be bought and value of the rescued stock
+        """
+        cost = 0.0
+        rescued = 0.0
+        for ingredient, per_portion in self._needs[recipe]:
+            amount = per_portion * portions
+            price = self._prices.get(ingredient, self._default_price)
+            for days, left in self._lots.get(ingredient, ()):
+                if amount <= 0:
+                    break
+                used = min(amount, left)
+                amount -= used
+                if days <= self.expiry_days:
+                    # The sooner it expires, the more it is worth using it up
+                    rescued += used * price * (1.0 - days / (self.expiry_days + 1))
+            if amount > 0:
+                cost += amount * price
+        return cost - self.waste_weight * rescued, cost, rescued
+
+    def __take(self, ingredient: int, amount: float) -> float:
+        """Takes the amount out of the simulated stock, soonest to expire first, returns how much was missing"""
+        lots = self._lots.get(ingredient, [])
+        while amount > 0 and lots:
+            lot = lots[0]
+            used = min(amount, lot[1])
+            lot[1] -= used
+            amount -= used
+            if lot[1] <= 0:
+                lots.pop(0)
+        return amount
+
+    def __load(self, today: Optional[datetime.date] = None) -> None:
+        """Loads recipes, their ingredients, usable stock and prices"""
+        today = today or datetime.date.today()
+        self._needs.clear()
+        self._recipes.clear()
+        self._used_by.clear()
+        self._lots.clear()
+        query_recipes = """
+        SELECT id, name
+        FROM recipe
+        """
+        self._recipes.update((row.id, row.name) for row in db.select_all(query_recipes))
+        query_needs = """
+        SELECT ri.recipe, ri.ingredient, ri.amount / GREATEST(r.portions, 1) AS per_portion
+        FROM recipe_ingredients ri
+        JOIN recipe r ON r.id = ri.recipe
+        """
+        for row in db.select_all(query_needs):
+            self._needs[row.recipe].append((row.ingredient, row.per_portion))
+            self._used_by[row.ingredient].append(row.recipe)
+        query_lots = """
+        SELECT s.ingredient, s.amount_left,
+               COALESCE(s.expiration_date, s.time_bought::DATE + i.durability) AS expires
+        FROM stock s
+        JOIN ingredient i ON i.id = s.ingredient
+        WHERE s.amount_left > 0
+        AND COALESCE(s.expiration_date, s.time_bought::DATE + i.durability, CURRENT_DATE) >= CURRENT_DATE
+        ORDER BY s.ingredient, expires ASC NULLS LAST
+        """
+        for row in db.select_all(query_lots):
+            days = (row.expires - today).days if row.expires is not None else float('inf')
+            self._lots[row.ingredient].append([days, row.amount_left])
+        self._prices = Ingredient.average_prices()
+        # Ingredients that were never bought would look free to buy otherwise
+        self._default_price = sum(self._prices.values()) / len(self._prices) if self._prices else 1.0
+        log.debug('Loaded %s recipes, stock of %s ingredients', len(self._recipes), len(self._lots))
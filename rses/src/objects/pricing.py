@@ -0,0 +1,161 @@
+# coding=utf-8
+"""Telling good deals from bad ones against the history of prices"""
+import json
+import logging
+import math
+from collections import defaultdict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, entity_key
+from rses_quantiles import TDigest
+
+log = logging.getLogger(__name__)
+
+
+def record_prices(cur: TransactionCursor, prices: Dict[int, Sequence[float]]) -> None:
+    """
+    Adds unit prices of purchases into the sketches of their ingredients, run in the transaction adding the stock
+
+    Sketches are locked, so concurrent purchases of the same ingredient don't overwrite each other.
+
+    :param cur:     Cursor of the purchasing transaction
+    :param prices:  Unit prices (price / amount) of the purchases, by ingredient id
+    """
+    prices = {ingredient: values for ingredient, values in prices.items() if values}
+    if not prices:
+        return
+    query_select = """
+    SELECT ingredient, sketch
+    FROM price_sketch
+    WHERE ingredient = ANY(%s::INT[])
+    ORDER BY ingredient
+    FOR UPDATE
+    """
+    cur.execute(query_select, (list(prices),))
+    sketches = {row.ingredient: TDigest.from_json_dict(row.sketch) for row in cur.fetchall()}
+    ingredients = list(prices)
+    for ingredient in ingredients:
+        sketch = sketches.setdefault(ingredient, TDigest())
+        for price in prices[ingredient]:
+            sketch.add(price)
+    query_upsert = """
+    INSERT INTO price_sketch (ingredient, sketch)
+    SELECT * FROM unnest(%s::INT[], %s::JSONB[])
+    ON CONFLICT (ingredient) DO UPDATE SET
+      sketch = EXCLUDED.sketch,
+      updated = NOW()
+    """
+    cur.execute(query_upsert, (ingredients, [json.dumps(sketches[ingredient].json_dict) for ingredient in ingredients]))
+
+
+class DealCheck(NamedTuple):
+    """How a price compares to what the ingredient usually costs"""
+    ingredient_id: int
+    unit_price: float
+    purchases: int
+    percentile: Optional[float]
+    z_score: Optional[float]
+    median: Optional[float]
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, float, None]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(ingredient=self.ingredient_id, unit_price=self.unit_price, purchases=self.purchases,
+                    percentile=_rounded(self.percentile, 1), z_score=_rounded(self.z_score, 2),
+                    median=_rounded(self.median, 4))
+
+
+class DealDetector:
+    """
+    Compares prices to the distribution of prices an ingredient was bought for.
+
+    Every ingredient has a t-digest of its unit prices, updated with each purchase (see `record_prices`),
+    so a check is a lookup by primary key and a walk over a bounded number of centroids,
+    no matter how long the history is. A low percentile is a good deal.
+    """
+
+    def __str__(self):
+        return 'Deal detector'
+
+    def __repr__(self):
+        return 'DealDetector()'
+
+    def check(self, ingredient_id: int, price: float, amount: float = 1.0) -> DealCheck:
+        """
+        Rates the price against the history of the ingredient
+
+        :param ingredient_id:   What is offered
+        :param price:           For how much
+        :param amount:          How much of the ingredient for that price, in its units
+        """
+        return self.check_cart([(ingredient_id, price, amount)])[0]
+
+    def check_cart(self, items: Iterable[Tuple[int, float, float]]) -> List[DealCheck]:
+        """Rates (ingredient id, price, amount) of every item in a single query, in the order of the items"""
+        items = list(items)
+        sketches = self.sketches({ingredient for ingredient, _, _ in items})
+        return [_check(ingredient, price / amount, sketches.get(ingredient)) for ingredient, price, amount in items]
+
+    @staticmethod
+    def sketches(ingredients: Iterable[int]) -> Dict[int, TDigest]:
+        """Price sketches of the ingredients that were ever bought for a price, by id"""
+        query = """
+        SELECT ingredient, sketch
+        FROM price_sketch
+        WHERE ingredient = ANY(%s::INT[])
+        """
+        rows = db.select_all(query, sorted(ingredients), cache=True)
+        return {row.ingredient: TDigest.from_json_dict(row.sketch) for row in rows}
+
+    @staticmethod
+    def rebuild(batch: int = 200) -> int:
+        """
+        Builds the sketches of all ingredients from the whole history of stock, for history added before them
+
+        :param batch:   How many ingredients have their prices loaded at once
+        :return:        How many ingredients have a sketch
+        """
+        query_ingredients = """
+        SELECT DISTINCT ingredient
+        FROM stock
+        WHERE price IS NOT NULL
+        AND amount > 0
+        ORDER BY ingredient
+        """
+        query_prices = """
+        SELECT ingredient, price / amount AS unit_price
+        FROM stock
+        WHERE ingredient = ANY(%s::INT[])
+        AND price IS NOT NULL
+        AND amount > 0
+        ORDER BY ingredient, time_bought
+        """
+
+        def store(cur: TransactionCursor) -> int:
+            cur.execute('DELETE FROM price_sketch')
+            cur.execute(query_ingredients)
+            ingredients = [row.ingredient for row in cur.fetchall()]
+            for start in range(0, len(ingredients), batch):
+                cur.execute(query_prices, (ingredients[start:start + batch],))
+                prices: Dict[int, List[float]] = defaultdict(list)
+                for row in cur:
+                    prices[row.ingredient].append(row.unit_price)
+                record_prices(cur, prices)
+            return len(ingredients)
+        count = db.run_transaction(store)
+        bus.publish(entity_key('price_sketch'))
+        log.debug('Rebuilt price sketches of %s ingredients', count)
+        return count
+
+
+def _check(ingredient: int, unit_price: float, sketch: Optional[TDigest]) -> DealCheck:
+    if sketch is None or not sketch.count:
+        return DealCheck(ingredient, unit_price, 0, None, None, None)
+    z_score = (unit_price - sketch.mean) / sketch.std if sketch.std > 0 else 0.0
+    return DealCheck(ingredient, unit_price, len(sketch), sketch.cdf(unit_price) * 100, z_score,
+                     sketch.quantile(0.5))
+
+
+def _rounded(value: Optional[float], digits: int) -> Optional[float]:
+    return None if value is None or math.isnan(value) else round(value, digits)
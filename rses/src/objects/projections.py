@@ -0,0 +1,57 @@
+# coding=utf-8
+"""
+Read-only projections of rows, for listing and serving many items at once
+
+The active record classes (`Ingredient`, `Recipe`, ...) load themselves and write on every change, which is
+needed for editing one item, but too heavy for showing a page of them. Projections are plain tuples built
+straight from query rows, with no database access and no per-instance dictionary.
+"""
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Union
+
+
+class IngredientTypeRow(NamedTuple):
+    """Ingredient type as listed"""
+    id: int
+    name: str
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, str]]:
+        """Returns dictionary that can be jsonified and served by the api, same as `IngredientType.json_dict`"""
+        return dict(id=self.id, name=self.name)
+
+
+class IngredientRow(NamedTuple):
+    """Ingredient as listed, with its type resolved by a join"""
+    id: int
+    name: str
+    unit: str
+    type_id: int
+    type_name: str
+    suggestion_threshold: float
+    rebuy_threshold: float
+    durability: Optional[int]
+
+    @property
+    def json_dict(self) -> Dict[str, Any]:
+        """Returns dictionary that can be jsonified and served by the api, same as `Ingredient.json_dict`"""
+        return dict(id=self.id, name=self.name, unit=self.unit, type=dict(id=self.type_id, name=self.type_name),
+                    suggestion_threshold=self.suggestion_threshold, rebuy_threshold=self.rebuy_threshold,
+                    durability=self.durability)
+
+
+class RecipeMatch(NamedTuple):
+    """Recipe found by the full text search"""
+    id: int
+    name: str
+    rank: float
+    snippet: str
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, str, float]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(id=self.id, name=self.name, rank=self.rank, snippet=self.snippet)
+
+
+def json_dicts(rows: Iterable[NamedTuple]) -> List[Dict[str, Any]]:
+    """Serializes projections for the api"""
+    return [row.json_dict for row in rows]
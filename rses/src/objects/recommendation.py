@@ -0,0 +1,240 @@
+# coding=utf-8
+"""Recipe recommendations based on the history of cooking"""
+import datetime
+import heapq
+import logging
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Union
+
+from rses_config import RSES_RECOMMENDATION_HALF_LIFE_DAYS
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, entity_key, table_of, EVERYTHING
+
+log = logging.getLogger(__name__)
+
+FORGOTTEN: str = 'forgotten'
+FAVOURITES: str = 'favourites'
+MODES = (FORGOTTEN, FAVOURITES)
+
+# Changes of these make the loaded recipe profiles stale
+_PROFILE_TABLES = frozenset([
+    'recipe', 'recipe_ingredients', 'recipe_made', 'recipe_stats', 'stock', 'ingredient', 'ingredient_type'
+])
+
+
+def record_cooked(cur: TransactionCursor, recipe_id: int,
+                  half_life_days: float = RSES_RECOMMENDATION_HALF_LIFE_DAYS) -> None:
+    """
+    Updates the aggregated history of the recipe, run in the transaction that cooks it
+
+    :param cur:             Cursor of the cooking transaction
+    :param recipe_id:       The recipe that was cooked
+    :param half_life_days:  After how many days one time cooked counts as half towards the frequency
+    """
+    query = """
+    INSERT INTO recipe_stats (recipe, times_cooked, last_cooked, frequency)
+    VALUES (%s, 1, NOW(), 1.0)
+    ON CONFLICT (recipe) DO UPDATE SET
+      times_cooked = recipe_stats.times_cooked + 1,
+      frequency = recipe_stats.frequency
+                  * exp(-ln(2) * extract(EPOCH FROM NOW() - recipe_stats.last_cooked) / %s) + 1,
+      last_cooked = NOW()
+    """
+    cur.execute(query, (recipe_id, half_life_days * 86400))
+
+
+class RecipeProfile(NamedTuple):
+    """What the recommendations are computed from, one per recipe"""
+    id: int
+    name: str
+    times_cooked: int
+    last_cooked: Optional[datetime.datetime]
+    frequency: float
+    cookable: bool
+    portion_price: float
+
+
+class Recommendation(NamedTuple):
+    """A recommended recipe with the reasons"""
+    score: float
+    profile: RecipeProfile
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, str, float, bool, None]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        last_cooked = self.profile.last_cooked.isoformat() if self.profile.last_cooked else None
+        return dict(id=self.profile.id, name=self.profile.name, score=round(self.score, 4),
+                    times_cooked=self.profile.times_cooked, last_cooked=last_cooked,
+                    cookable=self.profile.cookable, portion_price=self.profile.portion_price)
+
+
+class RecipeRecommender:
+    """
+    Ranks recipes that haven't been made in a while, or favourites, preferring the cookable and cheap ones.
+
+    Profiles of all recipes (history aggregates, cookability, portion price) are loaded in a single query
+    and kept in memory until something they depend on changes (or they get too old, for writes that are not
+    published on the bus), ranking is then a heap selection over them.
+    """
+
+    def __init__(self, half_life_days: float = RSES_RECOMMENDATION_HALF_LIFE_DAYS, history_weight: float = 0.6,
+                 cookable_weight: float = 0.25, price_weight: float = 0.15, max_age: float = 300.0) -> None:
+        """
+        :param half_life_days:      After how many days one time cooked counts as half, also scales "a while"
+        :param history_weight:      How much "not made in a while" or "favourite" counts
+        :param cookable_weight:     How much being able to cook it without shopping counts
+        :param price_weight:        How much a cheap portion counts
+        :param max_age:             After how many seconds are the profiles loaded again anyway
+        """
+        self.half_life_days: float = half_life_days
+        self.history_weight: float = history_weight
+        self.cookable_weight: float = cookable_weight
+        self.price_weight: float = price_weight
+        self.max_age: float = max_age
+        self._profiles: Optional[List[RecipeProfile]] = None
+        self._loaded_at: float = 0.0
+        # Bumped on every invalidation, so profiles loaded during a write are not kept stale
+        self._generation: int = 0
+        # Loads run one at a time under the first; the second guards the state above without waiting for a load
+        self._lock = threading.Lock()
+        self._state_lock = threading.Lock()
+
+    def __str__(self):
+        return 'Recipe recommender'
+
+    def __repr__(self):
+        return f'RecipeRecommender(half_life_days={self.half_life_days}, history_weight={self.history_weight}, ' \
+               f'cookable_weight={self.cookable_weight}, price_weight={self.price_weight})'
+
+    def invalidate(self, key: str) -> None:
+        """Forgets the loaded profiles if the key is of something they depend on, subscribed to the bus"""
+        if key == EVERYTHING or table_of(key) in _PROFILE_TABLES:
+            with self._state_lock:
+                self._generation += 1
+                self._profiles = None
+
+    @property
+    def profiles(self) -> List[RecipeProfile]:
+        """Profiles of all the recipes, loaded if stale"""
+        profiles = self._profiles
+        if profiles is None or time.monotonic() - self._loaded_at > self.max_age:
+            with self._lock:
+                with self._state_lock:
+                    profiles = self._profiles
+                    if profiles is not None and time.monotonic() - self._loaded_at <= self.max_age:
+                        return profiles
+                    generation = self._generation
+                profiles = self.__load_profiles()
+                with self._state_lock:
+                    if generation == self._generation:
+                        self._profiles = profiles
+                        self._loaded_at = time.monotonic()
+        return profiles
+
+    def recommend(self, mode: str = FORGOTTEN, limit: int = 10, cookable_only: bool = False,
+                  now: Optional[datetime.datetime] = None) -> List[Recommendation]:
+        """
+        Best recipes for the mode
+
+        :param mode:            FORGOTTEN for recipes that haven't been made in a while, FAVOURITES for the most cooked
+        :param limit:           How many to recommend
+        :param cookable_only:   Leave out what can't be cooked from stock
+        :param now:             Time to rank for, now by default
+        :return:                Recommendations, best first
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown recommendation mode {mode}, use one of {", ".join(MODES)}')
+        now = now or datetime.datetime.now()
+        profiles = self.profiles
+        if cookable_only:
+            profiles = [profile for profile in profiles if profile.cookable]
+        most_expensive = max((profile.portion_price for profile in profiles), default=0.0)
+        history = self.__forgotten if mode == FORGOTTEN else self.__favourite
+        scored = (
+            Recommendation(
+                self.history_weight * history(profile, now)
+                + self.cookable_weight * profile.cookable
+                + self.price_weight * (1.0 - profile.portion_price / most_expensive if most_expensive else 1.0),
+                profile
+            ) for profile in profiles
+        )
+        return heapq.nlargest(limit, scored, key=lambda recommendation: recommendation.score)
+
+    def rebuild_stats(self) -> None:
+        """Recomputes the aggregates of all recipes from the whole recipe_made history"""
+        query = """
+        INSERT INTO recipe_stats (recipe, times_cooked, last_cooked, frequency)
+        SELECT recipe, count(*), max(time_made),
+               sum(exp(-ln(2) * extract(EPOCH FROM last_made - time_made) / %s))
+        FROM (
+          SELECT recipe, time_made, max(time_made) OVER (PARTITION BY recipe) AS last_made
+          FROM recipe_made
+        ) AS history
+        GROUP BY recipe
+        ON CONFLICT (recipe) DO UPDATE SET
+          times_cooked = EXCLUDED.times_cooked,
+          last_cooked = EXCLUDED.last_cooked,
+          frequency = EXCLUDED.frequency
+        """
+        log.debug('Rebuilding recipe stats from history')
+        db.insert(query, self.half_life_days * 86400)
+        bus.publish(entity_key('recipe_stats'))
+
+    def __forgotten(self, profile: RecipeProfile, now: datetime.datetime) -> float:
+        """0 for just cooked, approaching 1 the longer it was not, 1 for never cooked"""
+        if profile.last_cooked is None:
+            return 1.0
+        days = max((now - profile.last_cooked).total_seconds() / 86400, 0.0)
+        return 1.0 - 0.5 ** (days / self.half_life_days)
+
+    def __favourite(self, profile: RecipeProfile, now: datetime.datetime) -> float:
+        """Recency weighted frequency of cooking squashed between 0 and 1"""
+        if profile.last_cooked is None:
+            return 0.0
+        days = max((now - profile.last_cooked).total_seconds() / 86400, 0.0)
+        frequency = profile.frequency * 0.5 ** (days / self.half_life_days)
+        return frequency / (1.0 + frequency)
+
+    @staticmethod
+    def __load_profiles() -> List[RecipeProfile]:
+        """Loads everything needed for ranking of all recipes"""
+        log.debug('Loading recipe profiles for recommendations')
+        query = """
+        WITH in_stock AS (
+          SELECT ingredient, sum(amount_left) AS amount
+          FROM stock
+          WHERE amount_left > 0
+          GROUP BY ingredient
+        ), latest_prices AS (
+          SELECT ingredient, price / amount AS unit_price,
+                 row_number() OVER (PARTITION BY ingredient ORDER BY time_bought DESC) AS age
+          FROM stock
+          WHERE price IS NOT NULL
+          AND amount > 0
+        ), unit_prices AS (
+          SELECT ingredient, avg(unit_price) AS price
+          FROM latest_prices
+          WHERE age <= 30
+          GROUP BY ingredient
+        ), needs AS (
+          SELECT ri.recipe,
+                 bool_and(COALESCE(s.amount, 0) >= ri.amount) AS cookable,
+                 sum(ri.amount * COALESCE(p.price, 0)) AS price
+          FROM recipe_ingredients ri
+          LEFT JOIN in_stock s ON s.ingredient = ri.ingredient
+          LEFT JOIN unit_prices p ON p.ingredient = ri.ingredient
+          GROUP BY ri.recipe
+        )
+        SELECT r.id, r.name, COALESCE(rs.times_cooked, 0) AS times_cooked, rs.last_cooked,
+               COALESCE(rs.frequency, 0) AS frequency, COALESCE(n.cookable, TRUE) AS cookable,
+               COALESCE(n.price, 0) / GREATEST(r.portions, 1) AS portion_price
+        FROM recipe r
+        LEFT JOIN recipe_stats rs ON rs.recipe = r.id
+        LEFT JOIN needs n ON n.recipe = r.id
+        """
+        return [RecipeProfile(*row) for row in db.select_all(query)]
+
+
+recommender: RecipeRecommender = RecipeRecommender()
+bus.subscribe(recommender.invalidate)
@@ -4,7 +4,12 @@ from typing import Optional, List
 import datetime
 import logging
 
-from rses_connections import db
+from rses_config import RSES_FORECAST_HORIZON_DAYS
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, entity_key
+from objects.forecasting import ConsumptionForecaster
+from objects.ledger import record_movements, PURCHASE
+from objects.pricing import record_prices
 from objects.stock import Ingredient
 
 log = logging.getLogger(__name__)
@@ -17,6 +22,8 @@ class ShoppingItem(Ingredient):
         self._amount: Optional[float] = amount
         self.current_price: Optional[float] = None
         self.expiration_date: Optional[datetime.date] = None
+        # Days until it is forecast to run below a threshold, for suggestions made from the forecast
+        self.buy_within: Optional[float] = None
 
     @property
     def status(self) -> str:
@@ -79,13 +86,22 @@ class ShoppingItem(Ingredient):
         query_insert = """
         INSERT INTO stock (ingredient, amount, amount_left, expiration_date, price)
         VALUES (%s, %s, %s, %s, %s)
+        RETURNING id
         """
-        db.insert(query_insert, self._id, self.amount, self.amount, self.expiration_date, self.current_price)
         query_delete = """
         DELETE FROM shopping_list
         WHERE ingredient = %s
         """
-        db.delete(query_delete, self._id)
+        amount = self.amount
+
+        def buy(cur: TransactionCursor) -> None:
+            cur.execute(query_insert, (self._id, amount, amount, self.expiration_date, self.current_price))
+            record_movements(cur, PURCHASE, [self._id], [cur.fetchone().id], [amount])
+            cur.execute(query_delete, (self._id,))
+            if self.current_price is not None and amount > 0:
+                record_prices(cur, {self._id: [self.current_price / amount]})
+        db.run_transaction(buy)
+        bus.publish(entity_key('stock'), entity_key('shopping_list', self._id), entity_key('price_sketch', self._id))
 
     def __eq__(self, other):
         return self._name == other.name
@@ -93,27 +109,54 @@ class ShoppingItem(Ingredient):
 
 class ShoppingList:
     """Shopping list that fills itself and is ready for serving"""
-    def __init__(self) -> None:
+    # Shared with the async routes
+    QUERY_WANTED = """
+    SELECT ingredient, wanted_amount
+    FROM shopping_list
+    """
+    QUERY_BELOW_REBUY = """
+    SELECT i.id
+    FROM ingredient i
+    LEFT JOIN stock s 
+      ON i.id = s.ingredient
+    WHERE i.rebuy_threshold > 0
+    GROUP BY i.id, i.rebuy_threshold
+    HAVING COALESCE(sum(s.amount_left), 0) < i.rebuy_threshold
+    """
+    QUERY_BELOW_SUGGESTION = """
+    SELECT i.id
+    FROM ingredient i
+    LEFT JOIN stock s 
+      ON i.id = s.ingredient
+    WHERE i.suggestion_threshold > 0
+    GROUP BY i.id, i.suggestion_threshold
+    HAVING COALESCE(sum(s.amount_left), 0) < i.suggestion_threshold
+    """
+
+    def __init__(self, horizon_days: float = RSES_FORECAST_HORIZON_DAYS) -> None:
+        """
+        :param horizon_days:    Suggest what is forecast to cross a threshold within this many days
+        """
         self.list: List[ShoppingItem] = list()
         self.suggested_list: List[ShoppingItem] = list()
+        self.forecast_list: List[ShoppingItem] = list()
         log.debug('Filling shopping list')
         self.__add_from_db_list()
         self.__add_critical()
         log.debug('Filling suggestion list')
         self.__add_suggested()
+        log.debug('Filling forecast suggestions')
+        self.__add_forecast(horizon_days)
 
     def __str__(self):
-        return f'Shopping list: {self.list}, suggestions: {self.suggested_list}'
+        return f'Shopping list: {self.list}, suggestions: {self.suggested_list}, forecast: {self.forecast_list}'
 
     def __repr__(self):
-        return f'ShoppingList(list:{repr(self.list)}, suggested_list:{repr(self.suggested_list)})'
+        return f'ShoppingList(list:{repr(self.list)}, suggested_list:{repr(self.suggested_list)}, ' \
+               f'forecast_list:{repr(self.forecast_list)})'
 
     def __add_from_db_list(self) -> None:
-        query = """
-        SELECT ingredient, wanted_amount
-        FROM shopping_list
-        """
-        res = db.select_all(query)
+        res = db.select_all(self.QUERY_WANTED)
         for item in res:
             item = ShoppingItem(item.ingredient, item.wanted_amount)
             log.debug('Adding %s from database', item)
@@ -125,15 +168,7 @@ class ShoppingList:
         
         If the threshold is 0, it means it shouldn't be re-bought
         """
-        query = """
-        SELECT i.id
-        FROM ingredient i
-        LEFT JOIN stock s 
-          ON i.id = s.ingredient
-        WHERE count(s.amount_left) < i.rebuy_threshold
-        AND i.rebuy_threshold > 0
-        """
-        res = db.select_all(query)
+        res = db.select_all(self.QUERY_BELOW_REBUY)
         for item in res:
             item = ShoppingItem(item.id)
             if item not in self.list:
@@ -145,17 +180,22 @@ class ShoppingList:
         """
         Suggests items for purchase, but does not add them to things to buy - this has to be done manually
         """
-        query = """
-        SELECT i.id
-        FROM ingredient i
-        LEFT JOIN stock s 
-          ON i.id = s.ingredient
-        WHERE count(s.amount_left) < i.suggestion_threshold
-        AND i.suggestion_threshold > 0
-        """
-        res = db.select_all(query)
+        res = db.select_all(self.QUERY_BELOW_SUGGESTION)
         for item in res:
             item = ShoppingItem(item.id)
             if item not in self.list:
                 log.debug('Suggesting %s from items below suggestion threshold', item)
                 self.suggested_list.append(item)
+
+    def __add_forecast(self, horizon_days: float) -> None:
+        """
+        Suggests items that are not below their thresholds yet, but are forecast to get there soon
+
+        Uses the forecast refreshed in a batch by `ConsumptionForecaster.refresh`, nothing is forecast here.
+        """
+        for forecast in ConsumptionForecaster.due(horizon_days):
+            item = ShoppingItem(forecast.ingredient_id)
+            if item not in self.list and item not in self.suggested_list:
+                item.buy_within = forecast.buy_within
+                log.debug('Suggesting %s to buy within %.1f days', item, item.buy_within)
+                self.forecast_list.append(item)
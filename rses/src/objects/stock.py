@@ -1,12 +1,15 @@
 # coding=utf-8
 """Objects related to ingredients and stock"""
 import logging
-from typing import Optional, List, Any, Dict, Union
-
-from psycopg2 import sql
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Optional, List, Any, Dict, Tuple, Union, Iterator
 
 import rses_errors
-from rses_connections import db
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, entity_key
+from objects.ledger import record_movements, ADJUST
+from objects.projections import IngredientTypeRow, IngredientRow, json_dicts
 
 log = logging.getLogger(__name__)
 
@@ -50,6 +53,7 @@ class IngredientType:
         """
         db.update(query, new_name, self._id)
         self._name = new_name
+        bus.publish(entity_key('ingredient_type', self._id))
 
     def exists(self) -> bool:
         """Whether the ingredient type exists"""
@@ -66,19 +70,24 @@ class IngredientType:
         return bool(res)
 
     def create(self):
-        """Creates an ingredient type"""
+        """Creates an ingredient type, raises AlreadyExists if there is one with the same name"""
         log.debug('Trying to create new %s', str(self))
-        if self.exists() or self._id:
+        if self._id:
             raise rses_errors.AlreadyExists(self)
         if self._name is None:
             raise rses_errors.MissingParameter('name')
         query = """
-        INSERT INTO ingredient_type (id, name)
-        VALUES (DEFAULT, %s)
-        RETURNING *
+        INSERT INTO ingredient_type (name)
+        VALUES (%s)
+        ON CONFLICT DO NOTHING
+        RETURNING id
         """
-        self._id = db.insert(query, self._name).id
+        res = db.insert(query, self._name)
+        if res is None:
+            raise rses_errors.AlreadyExists(self)
+        self._id = res.id
         log.debug('Created, new id: %s', self.id)
+        bus.publish(entity_key('ingredient_type', self._id))
 
     def delete(self):
         """Deletes an ingredient type"""
@@ -90,6 +99,7 @@ class IngredientType:
         WHERE id = %s
         """
         db.delete(query, self._id)
+        bus.publish(entity_key('ingredient_type', self._id))
 
     def items(self) -> List['Ingredient']:
         """All ingredients of this type"""
@@ -128,6 +138,26 @@ class IngredientType:
             raise rses_errors.DoesNotExist(IngredientType, name)
         return cls(ingredient_type_id=res.id)
 
+    @classmethod
+    def get_or_create(cls, name: str) -> 'IngredientType':
+        """Loads ingredient type by name, creating it if it does not exist yet, in a single query"""
+        query = """
+        WITH created AS (
+          INSERT INTO ingredient_type (name)
+          VALUES (%s)
+          ON CONFLICT DO NOTHING
+          RETURNING id
+        )
+        SELECT id FROM created
+        UNION ALL
+        SELECT id FROM ingredient_type WHERE name = %s
+        """
+        res = db.insert(query, name, name)
+        if res is None:  # Created concurrently after our query started, so it could not see it
+            return cls.load_by_name(name)
+        bus.publish(entity_key('ingredient_type', res.id))
+        return cls(ingredient_type_id=res.id, name=name)
+
     @property
     def json_dict(self) -> Dict[str, Union[int, str]]:
         """Returns dictionary that can be jsonified and served by the api"""
@@ -136,6 +166,27 @@ class IngredientType:
 
 class Ingredient:
     """An ingredient to buy and use in recipes"""
+    # Columns the setters update, nothing else is ever put into an update
+    COLUMNS = ('name', 'unit', 'ingredient_type', 'suggestion_threshold', 'rebuy_threshold', 'durability')
+    # Hot queries, tests/test_query_plans.py checks they are planned with an index
+    QUERY_AVERAGE_PRICE = """
+    SELECT COALESCE(avg(price / amount), 0) AS average
+    FROM (
+      SELECT price, amount
+      FROM stock
+      WHERE ingredient = %s
+      AND price IS NOT NULL
+      AND amount > 0
+      ORDER BY time_bought DESC
+      LIMIT 30
+    ) AS latest
+    """
+    QUERY_IN_STOCK = """
+    SELECT COALESCE(sum(amount_left), 0) AS amount
+    FROM stock
+    WHERE ingredient = %s
+    """
+
     def __init__(
             self, *,
             ingredient_id: Optional[int]=None,
@@ -162,6 +213,9 @@ class Ingredient:
         self._suggestion_threshold: Optional[float] = suggestion_threshold
         self._rebuy_threshold: Optional[float] = rebuy_threshold
         self._durability: Optional[int] = durability
+        # Columns changed while writes are deferred, saved all at once by `save`
+        self._deferred: bool = False
+        self._dirty: Dict[str, Any] = dict()
         if not self._id:
             self.create()
         elif not any(
@@ -200,7 +254,7 @@ class Ingredient:
 
     @type.setter
     def type(self, new_type: IngredientType):
-        self.__updater('type', new_type.id)
+        self.__updater('ingredient_type', new_type.id)
         self._type = new_type
 
     @property
@@ -232,15 +286,8 @@ class Ingredient:
 
     @property
     def average_price(self) -> float:
-        """Average price of the ingredient"""
-        query = """
-        SELECT avg(price) as average
-        FROM stock
-        WHERE ingredient = %s 
-        ORDER BY time_bought DESC 
-        LIMIT 30
-        """
-        return db.select(query, self._name).average
+        """Average price of a unit of the ingredient over the last 30 purchases, 0 if it was never bought"""
+        return db.select(self.QUERY_AVERAGE_PRICE, self._id).average
 
     @property
     def in_stock(self) -> float:
@@ -249,13 +296,25 @@ class Ingredient:
         
         :return:    How much is left in stock
         """
+        res = db.select(self.QUERY_IN_STOCK, self._id)
+        return res.amount
+
+    @staticmethod
+    def average_prices() -> Dict[int, float]:
+        """Average price of a unit over the last 30 purchases of every ingredient that was bought, by its id"""
         query = """
-        SELECT count(amount_left) AS amount
-        FROM stock
-        WHERE ingredient = %s
+        SELECT ingredient, avg(unit_price) AS average
+        FROM (
+          SELECT ingredient, price / amount AS unit_price,
+                 row_number() OVER (PARTITION BY ingredient ORDER BY time_bought DESC) AS age
+          FROM stock
+          WHERE price IS NOT NULL
+          AND amount > 0
+        ) AS latest
+        WHERE age <= 30
+        GROUP BY ingredient
         """
-        res = db.select(query, self._id)
-        return res.amount
+        return {row.ingredient: row.average for row in db.select_all(query)}
 
     def __str__(self):
         return f'Ingredient {self._name}'
@@ -284,46 +343,31 @@ class Ingredient:
         """
         Creates the ingredient, requires to have type and unit specified.
         
-        Default thresholds are 0 and no durability is set.
+        Default thresholds are 0 and no durability is set. Raises AlreadyExists if there is one with the same name.
         """
         log.debug('Trying to create new %s', str(self))
         required_params = dict(type=self._type, unit=self._unit, ingredient_type=self._type)
         for name, param in required_params.items():
             if param is None:
-                rses_errors.MissingParameter(name)
-        if self.exists():
-            raise rses_errors.AlreadyExists(self)
+                raise rses_errors.MissingParameter(name)
         query = """
         INSERT INTO ingredient (name, unit, ingredient_type, suggestion_threshold, rebuy_threshold, durability)
         VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT DO NOTHING
         RETURNING id"""
-        self._id = db.insert(query, self._name, self._unit, self._type.id, self._suggestion_threshold,
-                             self._rebuy_threshold, self._durability).id
+        res = db.insert(query, self._name, self._unit, self._type.id, self._suggestion_threshold,
+                        self._rebuy_threshold, self._durability)
+        if res is None:
+            raise rses_errors.AlreadyExists(self)
+        self._id = res.id
         log.debug('Created, new id: %s', self._id)
+        bus.publish(entity_key('ingredient', self._id))
 
     def remove_stock(self, amount: float) -> None:
-        """Removes amount of ingredient from the stock, from the oldest"""
+        """Removes amount of ingredient from the stock, from the oldest, raises NotEnoughIngredients if short"""
         log.debug('Removing %s%s of %s from stock', amount, self._unit, str(self))
-        query_select = """
-        SELECT id, amount_left
-        FROM stock
-        WHERE amount_left > 0
-        ORDER BY time_bought DESC
-        LIMIT 1
-        """
-        res = db.select(query_select)
-        can_remove = res.amount_left if res.amount_left >= amount else amount
-        query_update = """
-        UPDATE stock
-        SET amount_left = amount_left - %s
-        WHERE id = %s
-        """
-        db.delete(query_update, res.id)
-        amount -= can_remove
-        # FIXME > instead of != in case an error happened somewhere, after testing this, it can be replaced
-        if amount > 0:
-            log.debug('There is still %s%s left to remove, calling recursively', amount, self._unit)
-            self.remove_stock(amount)
+        db.run_transaction(StockReservation({self._id: amount}).take)
+        bus.publish(entity_key('stock'))
 
     def delete(self):
         """Deletes an ingredient type"""
@@ -335,18 +379,65 @@ class Ingredient:
         WHERE id = %s
         """
         db.delete(query, self._id)
+        bus.publish(entity_key('ingredient', self._id))
+
+    @property
+    def dirty(self) -> Dict[str, Any]:
+        """Columns with their new values that were changed while deferred and not saved yet"""
+        return dict(self._dirty)
+
+    @contextmanager
+    def deferred(self) -> Iterator['Ingredient']:
+        """
+        Setters within the block only mark the columns as changed, which are then saved in a single update
+
+        If the block raises, nothing is saved and the changes stay in `dirty`
+        """
+        self._deferred = True
+        try:
+            yield self
+        finally:
+            self._deferred = False
+        self.save()
+
+    def save(self) -> None:
+        """Writes all the changed columns in a single update"""
+        if not self._dirty:
+            return
+        log.debug('Saving changed columns %s of %s', ', '.join(self._dirty), str(self))
+        self.__check_columns(*self._dirty)
+        query = f"""
+        UPDATE ingredient
+        SET {', '.join(f'{column} = %s' for column in self._dirty)}
+        WHERE id = %s
+        """
+        db.update(query, *self._dirty.values(), self._id)
+        self._dirty.clear()
+        bus.publish(entity_key('ingredient', self._id))
 
     def __updater(self, column: str, new_value: Any) -> Any:
-        """Updates the Ingredient entry's value for specified column"""
-        log.debug('Updating ingredient column %s from %s to %s', column, getattr(self, 'column'), new_value)
-        query = sql.SQL("""
+        """Updates the Ingredient entry's value for specified column, or marks it as changed if deferred"""
+        self.__check_columns(column)
+        if self._deferred:
+            log.debug('Deferring update of ingredient column %s to %s', column, new_value)
+            self._dirty[column] = new_value
+            return new_value
+        log.debug('Updating ingredient column %s from %s to %s', column, getattr(self, column, None), new_value)
+        query = f"""
         UPDATE ingredient
-        SET {} = %s
+        SET {column} = %s
         WHERE id = %s
-        """).format(sql.Identifier(column))
+        """
         db.update(query, new_value, self._id)
+        bus.publish(entity_key('ingredient', self._id))
         return new_value
 
+    def __check_columns(self, *columns: str) -> None:
+        """Refuses columns that are not in `COLUMNS`, they are put into the update query as they are"""
+        unknown = set(columns).difference(self.COLUMNS)
+        if unknown:
+            raise ValueError(f'Columns {", ".join(sorted(unknown))} of ingredient can not be updated')
+
     def __load_from_db(self):
         """Loads the ingredient from the database"""
         query = """
@@ -373,25 +464,143 @@ class Ingredient:
         res = db.select(query, name)
         return cls(ingredient_id=res.id)
 
+    @classmethod
+    def get_or_create(cls, name: str, unit: str, ingredient_type: IngredientType,
+                      suggestion_threshold: float = 0.0, rebuy_threshold: float = 0.0,
+                      durability: Optional[int] = None) -> 'Ingredient':
+        """
+        Loads the ingredient by name, creating it if it does not exist yet, in a single query
+
+        An existing ingredient is returned as it is in the database, the other parameters are only used for creation
+        """
+        query = """
+        WITH created AS (
+          INSERT INTO ingredient (name, unit, ingredient_type, suggestion_threshold, rebuy_threshold, durability)
+          VALUES (%s, %s, %s, %s, %s, %s)
+          ON CONFLICT DO NOTHING
+          RETURNING id, name, unit, ingredient_type, suggestion_threshold, rebuy_threshold, durability
+        )
+        SELECT * FROM created
+        UNION ALL
+        SELECT id, name, unit, ingredient_type, suggestion_threshold, rebuy_threshold, durability
+        FROM ingredient
+        WHERE name = %s
+        """
+        res = db.insert(query, name, unit, ingredient_type.id, suggestion_threshold, rebuy_threshold, durability, name)
+        if res is None:  # Created concurrently after our query started, so it could not see it
+            return cls.load_by_name(name)
+        bus.publish(entity_key('ingredient', res.id))
+        if res.ingredient_type != ingredient_type.id:
+            ingredient_type = IngredientType(ingredient_type_id=res.ingredient_type)
+        return cls(ingredient_id=res.id, name=res.name, unit=res.unit, ingredient_type=ingredient_type,
+                   suggestion_threshold=res.suggestion_threshold, rebuy_threshold=res.rebuy_threshold,
+                   durability=res.durability)
+
     @property
     def json_dict(self) -> Dict[str, Union[int, str]]:
         """Returns dictionary that can be jsonified and served by the api"""
-        return dict(id=self.id, name=self.name, unit=self.unit, type=self.type,
+        return dict(id=self.id, name=self.name, unit=self.unit, type=self.type.json_dict,
                     suggestion_threshold=self.suggestion_threshold, rebuy_threshold=self.rebuy_threshold,
                     durability=self.durability)
 
 
+class StockReservation:
+    """
+    Takes amounts of ingredients out of stock atomically, from the oldest lots.
+
+    The lots are locked in the same order (by ingredient, then age) by everyone, so concurrent reservations
+    queue up instead of deadlocking, and the check whether there is enough runs on the locked rows,
+    so two people cooking at once can't both take the last egg. Purchases only insert new lots,
+    which doesn't conflict with the locks. What was taken from which lot is recorded in the stock ledger.
+    """
+    # Hot queries, tests/test_query_plans.py checks they are planned with an index
+    QUERY_LOCK = """
+    SELECT id, ingredient, amount_left
+    FROM stock
+    WHERE ingredient = ANY(%s)
+    AND amount_left > 0
+    ORDER BY ingredient, time_bought, id
+    FOR UPDATE
+    """
+
+    def __init__(self, amounts: Dict[int, float], movement: str = ADJUST, recipe_id: Optional[int] = None) -> None:
+        """
+        :param amounts:     How much to take of which ingredient, by ingredient id
+        :param movement:    Why is it taken, for the ledger
+        :param recipe_id:   Recipe it is taken for, for the ledger
+        """
+        self.amounts: Dict[int, float] = {ingredient: amount for ingredient, amount in amounts.items() if amount > 0}
+        self.movement: str = movement
+        self.recipe_id: Optional[int] = recipe_id
+
+    def __str__(self):
+        return f'Stock reservation of {len(self.amounts)} ingredients'
+
+    def __repr__(self):
+        return f'StockReservation(amounts={self.amounts}, movement={self.movement}, recipe_id={self.recipe_id})'
+
+    def take(self, cur: TransactionCursor) -> None:
+        """
+        Locks the lots, checks there is enough and subtracts the amounts, has to run in a transaction
+
+        :param cur:     Cursor of the transaction, see `DatabaseAdapter.run_transaction`
+        :raises NotEnoughIngredients:   With what is missing, nothing is subtracted
+        """
+        if not self.amounts:
+            return
+        cur.execute(self.QUERY_LOCK, (sorted(self.amounts),))
+        lots = cur.fetchall()
+        available: Dict[int, float] = defaultdict(float)
+        for lot in lots:
+            available[lot.ingredient] += lot.amount_left
+        missing = {ingredient: amount - available[ingredient] for ingredient, amount in self.amounts.items()
+                   if available[ingredient] < amount}
+        if missing:
+            raise rses_errors.NotEnoughIngredients(missing)
+        remaining = dict(self.amounts)
+        lot_ids: List[int] = list()
+        ingredients: List[int] = list()
+        taken: List[float] = list()
+        for lot in lots:
+            if remaining[lot.ingredient] <= 0:
+                continue
+            amount = min(remaining[lot.ingredient], lot.amount_left)
+            remaining[lot.ingredient] -= amount
+            lot_ids.append(lot.id)
+            ingredients.append(lot.ingredient)
+            taken.append(amount)
+        query_update = """
+        UPDATE stock
+        SET amount_left = stock.amount_left - taken.amount
+        FROM unnest(%s::INT[], %s::FLOAT[]) AS taken (id, amount)
+        WHERE stock.id = taken.id
+        """
+        cur.execute(query_update, (lot_ids, taken))
+        record_movements(cur, self.movement, ingredients, lot_ids, [-amount for amount in taken],
+                         recipe_id=self.recipe_id)
+        log.debug('Took %s from %s stock lots', self.amounts, len(lot_ids))
+
+
 class IngredientTypeListing:
     """class for total and individual items of Ingredient Type table"""
+    # Shared with the async routes
+    QUERY_TOTAL = """
+    SELECT COUNT(*) AS total
+    FROM ingredient_type
+    """
+    QUERY_SHOW = """
+    SELECT id, name
+    FROM ingredient_type
+    WHERE NAME LIKE %s
+    ORDER BY name ASC
+    LIMIT %s
+    OFFSET %s
+    """
 
     @property
     def total(self) -> int:
         """How many ingredient types there are in the database"""
-        query = """
-        SELECT COUNT(*) AS total
-        FROM ingredient_type
-        """
-        return db.select(query).total
+        return db.select(self.QUERY_TOTAL, cache=True).total
 
     @staticmethod
     def show(limit: int=50, offset: int=0, name_filter: str= '') -> List[Dict[str, Union[int, str]]]:
@@ -403,43 +612,55 @@ class IngredientTypeListing:
         :param name_filter:     If the name should be filtered at all, will be lowered automatically
         :return:                Filtered and limited ingredient types as dictionaries
         """
-        name_filter = name_filter.lower()
-        query = """
-        SELECT id, name
-        FROM ingredient_type
-        WHERE NAME LIKE %s
-        ORDER BY name ASC
-        LIMIT %s
-        OFFSET %s
-        """
         name_filter = f'%{name_filter}%'.lower()
-        res = db.select_all(query, name_filter, limit, offset)
-        return [IngredientType(ingredient_type_id=item.id, name=item.name).json_dict for item in res]
+        res = db.select_all(IngredientTypeListing.QUERY_SHOW, name_filter, limit, offset, cache=True)
+        return json_dicts(IngredientTypeRow(*item) for item in res)
 
 
 class IngredientListing:
     """class for total and individual items of Ingredient Type table"""
+    # Shared with the async routes
+    QUERY_TOTAL = """
+    SELECT COUNT(*) AS total
+    FROM ingredient
+    """
+    QUERY_SHOW = """
+    SELECT i.id, i.name, i.unit, t.id AS type_id, t.name AS type_name,
+           i.suggestion_threshold, i.rebuy_threshold, i.durability
+    FROM ingredient i
+    JOIN ingredient_type t ON t.id = i.ingredient_type
+    WHERE 
+      lower(i.name) LIKE %s
+      AND lower(i.unit) LIKE %s
+      AND lower(t.name) LIKE %s
+    ORDER BY i.name ASC
+    LIMIT %s
+    OFFSET %s
+    """
 
     @property
     def total(self) -> int:
         """How many ingredient types there are in the database"""
-        query = """
-        SELECT COUNT(*) AS total
-        FROM ingredient
-        """
-        return db.select(query).total
+        return db.select(self.QUERY_TOTAL, cache=True).total
 
     @staticmethod
     def show(limit: int = 50, offset: int = 0,
              wanted_filters: Optional[dict] = None) -> List[Dict[str, Union[int, str]]]:
         """
-        Lists ingredient types
+        Lists ingredients
 
         :param limit:           How many to list
         :param offset:          Select offset
-        :param wanted_filters:  Dictionary of items to be filtered
-        :return:                Filtered and limited ingredient types as dictionaries
+        :param wanted_filters:  Dictionary of items to be filtered - name, unit and name of ingredient_type
+        :return:                Filtered and limited ingredients as dictionaries
         """
+        filters = IngredientListing.filter_args(wanted_filters)
+        res = db.select_all(IngredientListing.QUERY_SHOW, *filters, limit, offset, cache=True)
+        return json_dicts(IngredientRow(*item) for item in res)
+
+    @staticmethod
+    def filter_args(wanted_filters: Optional[dict] = None) -> Tuple[str, str, str]:
+        """Patterns of name, unit and name of ingredient_type for `QUERY_SHOW`, anything for the missing ones"""
         filters = dict(
             name='',
             unit='',
@@ -447,23 +668,7 @@ class IngredientListing:
         )
         if wanted_filters is not None:
             filters.update(wanted_filters)
-        query = """
-        SELECT id, name, unit, ingredient_type, suggestion_threshold, rebuy_threshold, durability
-        FROM ingredient
-        WHERE 
-          name LIKE %s
-          AND unit like %s
-          AND ingredient_type LIKE %s
-        ORDER BY name ASC
-        LIMIT %s
-        OFFSET %s
-        """
         name_filter = f'%{filters["name"]}%'.lower()
         unit_filter = f'%{filters["unit"]}%'.lower()
         ingredient_type_filter = f'%{filters["ingredient_type"]}%'.lower()
-        res = db.select_all(query, name_filter, unit_filter, ingredient_type_filter, limit, offset)
-        return [Ingredient(
-            ingredient_id=item.id, name=item.name, unit=item.unit, ingredient_type=item.ingredient_type,
-            suggestion_threshold=item.suggestion_threshold, rebuy_threshold=item.rebuy_threshold,
-            durability=item.durability
-        ).json_dict for item in res]
+        return name_filter, unit_filter, ingredient_type_filter
@@ -0,0 +1,259 @@
+# coding=utf-8
+"""Export of the whole kitchen into a compressed archive and restore from it"""
+import datetime
+import io
+import json
+import logging
+import tarfile
+import tempfile
+from typing import BinaryIO, Dict, List, Optional
+
+from psycopg2 import sql
+
+from rses_connections import db, TransactionCursor
+from rses_invalidation import bus, EVERYTHING
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION: int = 1
+MANIFEST: str = 'manifest.json'
+TRAILER: str = 'trailer.json'
+# Referenced tables come before the tables referencing them
+TABLES = (
+    'ingredient_type', 'ingredient', 'stock', 'recipe', 'recipe_category', 'categorized_recipes',
+    'recipe_ingredients', 'recipe_made', 'recipe_stats', 'shopping_list', 'consumption_forecast',
+    'price_sketch', 'stock_ledger', 'stock_snapshot', 'stock_snapshot_amount',
+)
+
+
+class ArchiveError(Exception):
+    """The archive is damaged or was not written by a compatible version"""
+
+
+class KitchenArchive:
+    """
+    Dumps every table into a tar.gz stream and loads it back, with memory bounded by the chunk size.
+
+    The archive starts with a manifest (format version, tables and their columns), followed by the rows of every
+    table in `COPY` text format split into chunks of at most `chunk_bytes`, and ends with a trailer holding row
+    counts for verification. Both directions stream, so the archive can be piped between hosts.
+    """
+
+    def __init__(self, chunk_bytes: int = 64 * 1024 * 1024) -> None:
+        """
+        :param chunk_bytes:     Size of one archive member, also how much of a table is held in memory at once
+        """
+        self.chunk_bytes: int = chunk_bytes
+
+    def __str__(self):
+        return f'Kitchen archive in chunks of {self.chunk_bytes}B'
+
+    def __repr__(self):
+        return f'KitchenArchive(chunk_bytes={self.chunk_bytes})'
+
+    def export(self, stream: BinaryIO) -> Dict[str, int]:
+        """
+        Writes all tables into the stream, from a single consistent snapshot
+
+        :param stream:  Binary stream to write the archive into, does not have to be seekable
+        :return:        How many rows of each table were written
+        """
+        return db.run_transaction(lambda cur: self.__export(cur, stream), retries=0)
+
+    def restore(self, stream: BinaryIO) -> Dict[str, int]:
+        """
+        Replaces everything in the database with the contents of the archive, all or nothing
+
+        Foreign keys and secondary indexes are dropped for the load and built once at the end,
+        which is much faster than checking and indexing every row as it comes.
+
+        :param stream:  Binary stream to read the archive from, does not have to be seekable
+        :return:        How many rows of each table were loaded
+        """
+        counts = db.run_transaction(lambda cur: self.__restore(cur, stream), retries=0)
+        if db.cache is not None:
+            db.cache.clear()
+        bus.publish(EVERYTHING)
+        return counts
+
+    def __export(self, cur: TransactionCursor, stream: BinaryIO) -> Dict[str, int]:
+        cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        columns = _columns(cur)
+        manifest = dict(version=FORMAT_VERSION, created=datetime.datetime.now().isoformat(),
+                        tables=[dict(name=table, columns=columns[table]) for table in TABLES])
+        counts: Dict[str, int] = dict()
+        chunks: Dict[str, int] = dict()
+        with tarfile.open(fileobj=stream, mode='w|gz') as archive:
+            _add_member(archive, MANIFEST, json.dumps(manifest).encode())
+            for table in TABLES:
+                writer = _ChunkWriter(archive, table, self.chunk_bytes)
+                query = sql.SQL('COPY {} ({}) TO STDOUT').format(
+                    sql.Identifier(table), sql.SQL(', ').join(sql.Identifier(column) for column in columns[table])
+                )
+                cur.copy_expert(query, writer)
+                writer.close()
+                counts[table] = writer.rows
+                chunks[table] = writer.chunks
+                log.debug('Exported %s rows of %s in %s chunks', writer.rows, table, writer.chunks)
+            _add_member(archive, TRAILER, json.dumps(dict(rows=counts, chunks=chunks)).encode())
+        return counts
+
+    @staticmethod
+    def __restore(cur: TransactionCursor, stream: BinaryIO) -> Dict[str, int]:
+        counts: Dict[str, int] = dict()
+        with tarfile.open(fileobj=stream, mode='r|gz') as archive:
+            members = iter(archive)
+            manifest = _read_json(archive, next(members, None), MANIFEST)
+            if manifest.get('version') != FORMAT_VERSION:
+                raise ArchiveError(f'Unsupported archive version {manifest.get("version")}')
+            columns = {table['name']: table['columns'] for table in manifest['tables']}
+            unknown = set(columns) - set(TABLES)
+            if unknown:
+                raise ArchiveError(f'Archive has unknown tables {", ".join(sorted(unknown))}')
+            deferred = _drop_constraints_and_indexes(cur)
+            cur.execute(sql.SQL('TRUNCATE {} RESTART IDENTITY').format(
+                sql.SQL(', ').join(sql.Identifier(table) for table in TABLES)
+            ))
+            trailer: Optional[dict] = None
+            for member in members:
+                if member.name == TRAILER:
+                    trailer = _read_json(archive, member, TRAILER)
+                    break
+                table = member.name.split('/')[1]
+                if table not in columns:
+                    raise ArchiveError(f'Unexpected archive member {member.name}')
+                query = sql.SQL('COPY {} ({}) FROM STDIN').format(
+                    sql.Identifier(table), sql.SQL(', ').join(sql.Identifier(column) for column in columns[table])
+                )
+                cur.copy_expert(query, archive.extractfile(member))
+                counts[table] = counts.get(table, 0) + cur.rowcount
+                log.debug('Restored %s rows into %s from %s', cur.rowcount, table, member.name)
+            if trailer is None:
+                raise ArchiveError('Archive is truncated, the trailer is missing')
+            expected = {table: rows for table, rows in trailer['rows'].items() if rows}
+            if expected != {table: rows for table, rows in counts.items() if rows}:
+                raise ArchiveError(f'Archive is damaged, expected rows {expected} but loaded {counts}')
+        log.debug('Rebuilding %s constraints and indexes', len(deferred))
+        for statement in deferred:
+            cur.execute(statement)
+        _reset_sequences(cur, [table for table in TABLES if 'id' in columns.get(table, ())])
+        return counts
+
+
+class _ChunkWriter:
+    """File-like target of COPY TO, spills the data into archive members of bounded size"""
+
+    def __init__(self, archive: tarfile.TarFile, table: str, chunk_bytes: int) -> None:
+        self.archive: tarfile.TarFile = archive
+        self.table: str = table
+        self.chunk_bytes: int = chunk_bytes
+        self.rows: int = 0
+        self.chunks: int = 0
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=chunk_bytes)
+        self._size: int = 0
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer.write(data)
+        self._size += len(data)
+        self.rows += data.count(b'\n')
+        # Rows come one per write and escape their newlines, so a chunk always ends on a row boundary
+        if self._size >= self.chunk_bytes and data.endswith(b'\n'):
+            self.__flush()
+        return len(data)
+
+    def close(self) -> None:
+        if self._size:
+            self.__flush()
+        self._buffer.close()
+
+    def __flush(self) -> None:
+        info = tarfile.TarInfo(f'data/{self.table}/{self.chunks:06d}.copy')
+        info.size = self._size
+        info.mtime = int(datetime.datetime.now().timestamp())
+        self._buffer.seek(0)
+        self.archive.addfile(info, self._buffer)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._size = 0
+        self.chunks += 1
+
+
+def _add_member(archive: tarfile.TarFile, name: str, data: bytes) -> None:
+    """Adds a small member from memory"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(datetime.datetime.now().timestamp())
+    archive.addfile(info, io.BytesIO(data))
+
+
+def _read_json(archive: tarfile.TarFile, member: Optional[tarfile.TarInfo], name: str) -> dict:
+    """Reads the member, which has to be the named JSON document"""
+    if member is None or member.name != name:
+        raise ArchiveError(f'Expected {name} in the archive, found {member.name if member else "nothing"}')
+    return json.loads(archive.extractfile(member).read().decode())
+
+
+def _columns(cur: TransactionCursor) -> Dict[str, List[str]]:
+    """Columns of the tables that hold data, generated columns are computed again on restore"""
+    query = """
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE table_schema = current_schema()
+    AND table_name = ANY(%s)
+    AND is_generated = 'NEVER'
+    ORDER BY table_name, ordinal_position
+    """
+    cur.execute(query, (list(TABLES),))
+    columns: Dict[str, List[str]] = {table: list() for table in TABLES}
+    for row in cur.fetchall():
+        columns[row.table_name].append(row.column_name)
+    return columns
+
+
+def _drop_constraints_and_indexes(cur: TransactionCursor) -> List[str]:
+    """
+    Drops foreign keys and indexes that don't back a constraint on the tables
+
+    :return:    Statements creating them again, in the order they should run
+    """
+    query_constraints = """
+    SELECT c.conrelid::REGCLASS::TEXT AS table_name, c.conname AS name, pg_get_constraintdef(c.oid) AS definition
+    FROM pg_constraint c
+    WHERE c.contype = 'f'
+    AND c.conrelid = ANY(%s::REGCLASS[])
+    """
+    cur.execute(query_constraints, (list(TABLES),))
+    constraints = cur.fetchall()
+    query_indexes = """
+    SELECT i.indexrelid::REGCLASS::TEXT AS name, pg_get_indexdef(i.indexrelid) AS definition
+    FROM pg_index i
+    WHERE i.indrelid = ANY(%s::REGCLASS[])
+    AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+    """
+    cur.execute(query_indexes, (list(TABLES),))
+    indexes = cur.fetchall()
+    for constraint in constraints:
+        cur.execute(sql.SQL('ALTER TABLE {} DROP CONSTRAINT {}').format(
+            sql.Identifier(constraint.table_name), sql.Identifier(constraint.name)
+        ))
+    for index in indexes:
+        cur.execute(sql.SQL('DROP INDEX {}').format(sql.Identifier(index.name)))
+    # Indexes first, so the foreign key checks can use them
+    return [index.definition for index in indexes] + [
+        sql.SQL('ALTER TABLE {} ADD CONSTRAINT {} {}').format(
+            sql.Identifier(constraint.table_name), sql.Identifier(constraint.name), sql.SQL(constraint.definition)
+        ) for constraint in constraints
+    ]
+
+
+def _reset_sequences(cur: TransactionCursor, tables: List[str]) -> None:
+    """Moves the id sequences of the tables past the restored ids, so new rows don't collide with them"""
+    for table in tables:
+        cur.execute('SELECT pg_get_serial_sequence(%s, %s) AS sequence', (table, 'id'))
+        sequence = cur.fetchone().sequence
+        if sequence is not None:
+            cur.execute(sql.SQL('SELECT setval(%s, COALESCE(max(id), 1), max(id) IS NOT NULL) FROM {}').format(
+                sql.Identifier(table)
+            ), (sequence,))
@@ -0,0 +1,248 @@
+# coding=utf-8
+"""
+Asyncio counterpart of `rses_connections.DatabaseAdapter`, for fanning out independent queries concurrently
+
+Queries run on one event loop per process, in a background thread that owns a pool of psycopg 3 async
+connections. Request handlers hand it a coroutine with `loop.run`, their thread waits while any number of
+queries of the coroutine (gathered with `asyncio.gather`) run at once, each on its own pooled connection.
+psycopg and its pool are imported when the loop starts, the rest of RSES keeps using psycopg2.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, List, Optional, TypeVar
+
+from rses_config import DATABASE_URL, RSES_ASYNC_POOL_SIZE, RSES_DB_POOL_TIMEOUT, RSES_STATEMENT_TIMEOUT
+from rses_config import RSES_TRANSACTION_RETRIES, RSES_TRANSACTION_BACKOFF
+from rses_connections import queries
+from rses_deadlines import deadlines, timeouts
+from rses_errors import QueryTimeout
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Queries run by the coroutine handed to `BackgroundLoop.run`, shared by the tasks it gathers
+_query_count: 'contextvars.ContextVar[List[int]]' = contextvars.ContextVar('rses_async_query_count')
+
+
+class AsyncDatabaseAdapter:
+    """
+    Adapter with the methods of `DatabaseAdapter` as coroutines, over a pool of async connections.
+
+    There is no result cache, the async routes are for fanning out queries that would otherwise run one by one.
+    """
+
+    def __init__(self, url: str = DATABASE_URL, pool_size: int = RSES_ASYNC_POOL_SIZE,
+                 pool_timeout: float = RSES_DB_POOL_TIMEOUT, statement_timeout: float = RSES_STATEMENT_TIMEOUT) -> None:
+        """
+        :param url:                 Url of the database
+        :param pool_size:           Most connections open at once, the concurrent queries of all requests of the process
+        :param pool_timeout:        Seconds to wait for a free pooled connection
+        :param statement_timeout:   Seconds the server lets a statement run, 0 for no limit
+        """
+        self.url: str = url
+        self.pool_size: int = pool_size
+        self.pool_timeout: float = pool_timeout
+        self.statement_timeout: float = statement_timeout
+        self._pool = None
+
+    def __str__(self):
+        return 'Async database adapter'
+
+    def __repr__(self):
+        return f'AsyncDatabaseAdapter(pool_size={self.pool_size}, pool_timeout={self.pool_timeout})'
+
+    async def pool(self):
+        """The pool, opened on first use on the running loop, which it then belongs to"""
+        if self._pool is None:
+            from psycopg.rows import namedtuple_row
+            from psycopg_pool import AsyncConnectionPool
+            kwargs = dict(autocommit=True, row_factory=namedtuple_row)
+            if self.statement_timeout:
+                kwargs['options'] = f'-c statement_timeout={round(self.statement_timeout * 1000)}'
+            pool = AsyncConnectionPool(self.url, min_size=1, max_size=self.pool_size, timeout=self.pool_timeout,
+                                       kwargs=kwargs, open=False)
+            await pool.open()
+            self._pool = pool
+            log.debug('Opened async connection pool of %s', self.pool_size)
+        return self._pool
+
+    async def select(self, query: str, *args) -> Any:
+        """Wrapped execute around select statement for single result"""
+        return await self.__run(query, args, lambda cur: cur.fetchone())
+
+    async def select_all(self, query: str, *args) -> List[Any]:
+        """Wrapped execute around select statement for multiple results"""
+        return await self.__run(query, args, lambda cur: cur.fetchall())
+
+    async def delete(self, query: str, *args) -> int:
+        """Wrapped execute around delete statement"""
+        return await self.__run(query, args, _rowcount)
+
+    async def insert(self, query: str, *args) -> Optional[Any]:
+        """Wrapped execute around insert statement, returns the first returned row, if any"""
+        return await self.__run(query, args, lambda cur: cur.fetchone() if cur.description is not None else _none())
+
+    async def update(self, query: str, *args) -> int:
+        """Wrapped execute around update statement"""
+        return await self.__run(query, args, _rowcount)
+
+    async def run_transaction(self, work: Callable[[Any], Awaitable[T]], retries: int = RSES_TRANSACTION_RETRIES,
+                              backoff: float = RSES_TRANSACTION_BACKOFF) -> T:
+        """
+        Runs the work in a single transaction, see `DatabaseAdapter.run_transaction`
+
+        :param work:        Coroutine function doing the queries with the async cursor it gets
+        :param retries:     How many times to try again after a serialization failure or deadlock
+        :param backoff:     Base of the wait between attempts in seconds, doubled with every attempt
+        :return:            What the work returned
+        """
+        from psycopg.errors import TransactionRollback
+        pool = await self.pool()
+        attempt = 0
+        while True:
+            try:
+                async with pool.connection() as conn:
+                    async with conn.transaction():
+                        async with conn.cursor() as cur:
+                            return await work(_CountingCursor(cur))
+            except TransactionRollback as e:
+                if attempt >= retries:
+                    raise
+                wait = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                attempt += 1
+                log.debug('Transaction conflict (%s), retrying in %.3fs, attempt %s', e.sqlstate, wait, attempt)
+                await asyncio.sleep(wait)
+
+    async def close(self) -> None:
+        """Closes the pool, the next query opens a new one"""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
+
+    async def __run(self, query: str, args: tuple, fetch: Callable[[Any], Awaitable[T]]) -> T:
+        pool = await self.pool()
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await _CountingCursor(cur).execute(query, args)
+                result = await fetch(cur)
+        log.debug("Ran async query\n'%s'\nResult: %s", ' '.join(query.split()), result)
+        return result
+
+
+class _CountingCursor:
+    """Async cursor counting its queries into the coroutine run by `BackgroundLoop.run`"""
+
+    def __init__(self, cursor) -> None:
+        self._cursor = cursor
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    async def execute(self, query, vars=None):
+        count = _query_count.get(None)
+        if count is not None:
+            count[0] += 1
+        try:
+            return await self._cursor.execute(query, vars)
+        except Exception as e:
+            from psycopg.errors import QueryCanceled
+            if not isinstance(e, QueryCanceled):
+                raise
+            timeouts['statement_timeout'] += 1
+            raise QueryTimeout() from e
+
+
+async def _rowcount(cur) -> int:
+    return cur.rowcount
+
+
+async def _none() -> None:
+    return None
+
+
+class BackgroundLoop:
+    """
+    Event loop running in a daemon thread, started on first use in every process.
+
+    Async connections belong to the loop they were opened on, so all coroutines of the process run on this one
+    and the pool is shared between requests no matter which thread serves them.
+    """
+
+    def __init__(self, adapter: AsyncDatabaseAdapter) -> None:
+        """
+        :param adapter: Adapter whose pool lives on the loop, forgotten in a forked process
+        """
+        self.adapter: AsyncDatabaseAdapter = adapter
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'Background event loop of process {self._pid}' if self._loop else 'Background event loop, not started'
+
+    def __repr__(self):
+        return f'BackgroundLoop(pid={self._pid}, running={self._loop is not None})'
+
+    def run(self, coroutine: Awaitable[T], timeout: Optional[float] = None) -> T:
+        """
+        Runs the coroutine on the loop and waits for its result, the queries it ran are added to `queries`
+
+        The coroutine is cancelled, with the queries it awaits, when it runs out of time. Without a timeout, the
+        tightest of `rses_deadlines.deadlines` of the calling thread applies.
+
+        :param coroutine:   What to run, usually gathering queries of `adb`
+        :param timeout:     Seconds to wait for the result, raises `QueryTimeout` after
+        :return:            What the coroutine returned
+        """
+        budget = None if timeout is None else (timeout, 'call')
+        tightest = deadlines.tightest()
+        if budget is None and tightest is not None:
+            budget = (tightest.seconds, tightest.name)
+            timeout = max(tightest.at - time.monotonic(), 0)
+        count = [0]
+        future = asyncio.run_coroutine_threadsafe(_counted(coroutine, count), self.__started())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError as e:
+            future.cancel()
+            timeouts[budget[1]] += 1
+            raise QueryTimeout(*budget) from e
+        finally:
+            queries.count += count[0]
+
+    def stop(self) -> None:
+        """Closes the pool and stops the loop"""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is not None and self._pid == os.getpid():
+            asyncio.run_coroutine_threadsafe(self.adapter.close(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+
+    def __started(self) -> asyncio.AbstractEventLoop:
+        if self._loop is not None and self._pid == os.getpid():
+            return self._loop
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                # The loop thread and connections of the parent don't exist in a forked child
+                self.adapter._pool = None
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name='rses-async', daemon=True).start()
+                log.debug('Started background event loop in process %s', self._pid)
+        return self._loop
+
+
+async def _counted(coroutine: Awaitable[T], count: List[int]) -> T:
+    _query_count.set(count)
+    return await coroutine
+
+
+adb: AsyncDatabaseAdapter = AsyncDatabaseAdapter()
+loop: BackgroundLoop = BackgroundLoop(adb)
@@ -0,0 +1,177 @@
+# coding=utf-8
+"""In-process cache of query results, invalidated per table"""
+import logging
+import re
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Iterable, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+# Tables whose rows can change when a table they reference changes (ON DELETE CASCADE in database/create.sql)
+CASCADES: Dict[str, Tuple[str, ...]] = {
+    'ingredient_type': ('ingredient',),
+    'ingredient': ('stock', 'recipe_ingredients', 'shopping_list', 'consumption_forecast', 'price_sketch',
+                   'stock_ledger', 'stock_snapshot_amount'),
+    'recipe': ('categorized_recipes', 'recipe_ingredients', 'recipe_made', 'recipe_stats', 'stock_ledger'),
+    'recipe_category': ('categorized_recipes',),
+}
+
+_READ_TABLES = re.compile(r'\b(?:FROM|JOIN)\s+([a-z_][a-z0-9_]*)', re.IGNORECASE)
+# Found anywhere, so data modifying CTEs are covered too - a false match only invalidates more than needed
+_WRITTEN_TABLES = re.compile(r'\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+([a-z_][a-z0-9_]*)', re.IGNORECASE)
+
+
+class QueryCache:
+    """
+    Read-through LRU cache of query results with a memory budget.
+
+    Entries are keyed on the normalized query and its parameters and tagged with the tables the query reads,
+    writing into a table drops every entry tagged with it (and with the tables depending on it).
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        """
+        :param max_bytes:   Budget for the estimated size of all cached results, least recently used go first
+        """
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, FrozenSet[str], int]]' = OrderedDict()
+        self._by_table: Dict[str, Set[Hashable]] = dict()
+        # Bumped on every invalidation, so a result loaded during a write is not stored stale
+        self._generations: Dict[str, int] = dict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f'Query cache {self.size}/{self.max_bytes}B, {len(self._entries)} entries'
+
+    def __repr__(self):
+        return f'QueryCache(max_bytes={self.max_bytes}, size={self.size}, entries={len(self._entries)}, ' \
+               f'hits={self.hits}, misses={self.misses})'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_load(self, query: str, args: tuple, loader: Callable[[], Any]) -> Any:
+        """
+        Returns cached result of the query, or runs the loader and caches what it returns
+
+        :param query:   The query, used for the key and to find out which tables it reads
+        :param args:    Parameters of the query
+        :param loader:  Runs the query when the result is not cached
+        :return:        Result of the query
+        """
+        normalized = normalize(query)
+        key = (normalized, _hashable(args))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            tables = tables_read(normalized)
+            generations = self.__generations(tables)
+        result = loader()
+        size = _estimate_size(result)
+        with self._lock:
+            if size <= self.max_bytes and generations == self.__generations(tables):
+                self.__store(key, result, tables, size)
+        return result
+
+    def invalidate(self, tables: Iterable[str]) -> None:
+        """Drops all entries reading from the tables, or from tables that cascade from them"""
+        affected = _with_cascades(tables)
+        with self._lock:
+            for table in affected:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                for key in self._by_table.pop(table, set()):
+                    self.__discard(key)
+        log.debug('Invalidated cached results of tables %s', ', '.join(sorted(affected)))
+
+    def invalidate_query(self, query: str) -> None:
+        """Invalidates the tables a data modifying query writes into"""
+        tables = tables_written(query)
+        if tables:
+            self.invalidate(tables)
+
+    def clear(self) -> None:
+        """Drops everything"""
+        with self._lock:
+            for table in self._by_table:
+                self._generations[table] = self._generations.get(table, 0) + 1
+            self._entries.clear()
+            self._by_table.clear()
+            self.size = 0
+
+    def __generations(self, tables: FrozenSet[str]) -> Tuple[int, ...]:
+        return tuple(self._generations.get(table, 0) for table in sorted(tables))
+
+    def __store(self, key: Hashable, result: Any, tables: FrozenSet[str], size: int) -> None:
+        self.__discard(key)
+        self._entries[key] = (result, tables, size)
+        self.size += size
+        for table in tables:
+            self._by_table.setdefault(table, set()).add(key)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            log.debug('Evicting cached result of %s', oldest[0])
+            self.__discard(oldest)
+
+    def __discard(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, tables, size = entry
+        self.size -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+
+
+def normalize(query: str) -> str:
+    """Collapses whitespace, so the same query written differently shares one entry"""
+    return ' '.join(query.split())
+
+
+def tables_read(query: str) -> FrozenSet[str]:
+    """Tables the query selects from"""
+    return frozenset(table.lower() for table in _READ_TABLES.findall(query))
+
+
+def tables_written(query: str) -> FrozenSet[str]:
+    """Tables the query inserts into, updates or deletes from"""
+    return frozenset(table.lower() for table in _WRITTEN_TABLES.findall(query))
+
+
+def _with_cascades(tables: Iterable[str]) -> Set[str]:
+    """The tables including all the tables depending on them"""
+    affected: Set[str] = set()
+    pending = list(tables)
+    while pending:
+        table = pending.pop()
+        if table not in affected:
+            affected.add(table)
+            pending.extend(CASCADES.get(table, ()))
+    return affected
+
+
+def _hashable(value: Any) -> Hashable:
+    """Parameters can be lists (ANY(%s)) or dicts, which have to be frozen for the key"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    return value
+
+
+def _estimate_size(value: Any) -> int:
+    """Rough size of a result in bytes, rows are tuples of simple values"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_estimate_size(item) for item in value)
+    return size
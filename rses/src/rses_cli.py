@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""Command line tools for bulk work with the kitchen, run `python rses_cli.py --help`"""
+import argparse
+import datetime
+import logging
+import sys
+import time
+from typing import List, Optional
+
+from rses_config import RSES_FORECAST_HORIZON_DAYS
+from rses_connections import db
+from objects.forecasting import ConsumptionForecaster
+from objects.ledger import StockLedger
+from objects.importing import RecipeImporter, StockIngester, FORMATS, CSV, JSONL
+from objects.pricing import DealDetector
+
+log = logging.getLogger(__name__)
+
+
+def _guess_format(file_name: str) -> str:
+    """Format of a file from its extension, JSON lines unless it's a CSV"""
+    return CSV if file_name.lower().endswith('.csv') else JSONL
+
+
+def import_recipes(args: argparse.Namespace) -> int:
+    """Imports recipes from a JSON lines or CSV file"""
+    file_format = args.format or _guess_format(args.file.name)
+    report = RecipeImporter(chunk_size=args.chunk_size).import_stream(args.file, file_format)
+    log.info('%s, %s already existed', report, report.skipped)
+    if report.missing_ingredients:
+        log.warning('Ingredients that do not exist were left out: %s', ', '.join(sorted(report.missing_ingredients)))
+    return 0
+
+
+def ingest_stock(args: argparse.Namespace) -> int:
+    """Adds purchased stock from a JSON lines or CSV file of receipt lines"""
+    file_format = args.format or _guess_format(args.file.name)
+    report = StockIngester(chunk_size=args.chunk_size).ingest_stream(args.file, file_format)
+    log.info('Added %s of %s lines to stock, %s invalid', report.created, report.read, report.invalid)
+    if report.missing_ingredients:
+        log.warning('Lines of ingredients that do not exist were left out: %s',
+                    ', '.join(sorted(report.missing_ingredients)))
+    return 0
+
+
+def export_kitchen(args: argparse.Namespace) -> int:
+    """Dumps all tables into a compressed archive"""
+    from rses_archive import KitchenArchive
+    counts = KitchenArchive(chunk_bytes=args.chunk_mb * 1024 * 1024).export(args.file)
+    log.info('Exported %s rows of %s tables', sum(counts.values()), len(counts))
+    return 0
+
+
+def import_kitchen(args: argparse.Namespace) -> int:
+    """Replaces the contents of all tables with an archive made by export"""
+    from rses_archive import KitchenArchive
+    counts = KitchenArchive().restore(args.file)
+    log.info('Restored %s rows of %s tables', sum(counts.values()), len(counts))
+    return 0
+
+
+def forecast(args: argparse.Namespace) -> int:
+    """Refreshes the forecast consumption of all ingredients and lists what should be bought soon"""
+    count = ConsumptionForecaster(alpha=args.alpha, history_days=args.history_days).refresh()
+    log.info('Forecast consumption of %s ingredients', count)
+    for due in ConsumptionForecaster.due(args.horizon_days):
+        log.info('%s: buy within %.1f days, %s left, using %.2f a day', due.name, due.buy_within, due.in_stock,
+                 due.daily_rate)
+    return 0
+
+
+def rebuild_price_sketches(args: argparse.Namespace) -> int:
+    """Builds the price sketches again from the whole history of stock"""
+    log.info('Rebuilt price sketches of %s ingredients', DealDetector.rebuild())
+    return 0
+
+
+def snapshot_stock(args: argparse.Namespace) -> int:
+    """Maintains the stock ledger, snapshots the amounts in stock and optionally expires lots and prunes snapshots"""
+    if args.backfill:
+        log.info('Recorded %s lots that predate the ledger', StockLedger.backfill())
+    if args.expire:
+        log.info('%s lots expired', StockLedger.expire())
+    log.info('Took a stock snapshot at %s', StockLedger.snapshot())
+    if args.keep_days is not None:
+        log.info('Pruned %s old snapshots', StockLedger.prune(datetime.timedelta(days=args.keep_days)))
+    return 0
+
+
+def migrate(args: argparse.Namespace) -> int:
+    """Applies the schema migrations the database does not have yet, or lists them"""
+    from rses_migrations import Migrator
+    migrator = Migrator()
+    if args.list:
+        applied = migrator.applied()
+        for migration in migrator.migrations:
+            when = applied.get(migration.version)
+            log.info('%04d %s: %s', migration.version, migration.name,
+                     'pending' if when is None else f'applied at {when:%Y-%m-%d %H:%M}')
+        return 0
+    done = migrator.migrate(args.to)
+    log.info('Applied %s migrations', len(done) if done else 'no')
+    return 0
+
+
+def run_scheduler(args: argparse.Namespace) -> int:
+    """Runs the background jobs on their schedules until interrupted, or one job right away"""
+    from rses_jobs import scheduler
+    if args.run:
+        if args.run not in scheduler.jobs:
+            log.error('No job %s, pick from %s', args.run, ', '.join(sorted(scheduler.jobs)))
+            return 1
+        scheduler.run(args.run)
+        return 1 if scheduler.jobs[args.run].stats.last_error else 0
+    scheduler.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        log.info('Waiting for the running jobs to finish')
+        scheduler.stop()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Parses the arguments and runs the command"""
+    parser = argparse.ArgumentParser(prog='rses', description='Bulk work with the RSES kitchen')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log debug messages')
+    parser.add_argument('--statement-timeout', type=float, default=0,
+                        help='Seconds the server lets a statement run, no limit by default for bulk work')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    recipes = commands.add_parser('import-recipes', help='Import recipes with ingredients and categories')
+    recipes.add_argument('file', type=argparse.FileType('r', encoding='utf-8'),
+                         help='JSON lines or CSV file, - for standard input')
+    recipes.add_argument('--format', choices=FORMATS, help='Format of the file, guessed from extension by default')
+    recipes.add_argument('--chunk-size', type=int, default=1000, help='Recipes merged in one transaction')
+    recipes.set_defaults(handler=import_recipes)
+
+    receipts = commands.add_parser('ingest-stock', help='Add purchased stock from receipts or history')
+    receipts.add_argument('file', type=argparse.FileType('r', encoding='utf-8'),
+                          help='JSON lines or CSV file, - for standard input')
+    receipts.add_argument('--format', choices=FORMATS, help='Format of the file, guessed from extension by default')
+    receipts.add_argument('--chunk-size', type=int, default=5000, help='Lines merged in one transaction')
+    receipts.set_defaults(handler=ingest_stock)
+
+    export = commands.add_parser('export', help='Dump the whole kitchen into a compressed archive')
+    export.add_argument('file', type=argparse.FileType('wb'), help='Archive (.tar.gz) to write, - for standard output')
+    export.add_argument('--chunk-mb', type=int, default=64, help='Size of the chunks tables are split into')
+    export.set_defaults(handler=export_kitchen)
+
+    restore = commands.add_parser('import', help='Replace the whole kitchen with an exported archive')
+    restore.add_argument('file', type=argparse.FileType('rb'), help='Archive to read, - for standard input')
+    restore.set_defaults(handler=import_kitchen)
+
+    forecasts = commands.add_parser('forecast', help='Refresh the forecast consumption of ingredients, run daily')
+    forecasts.add_argument('--alpha', type=float, default=0.1, help='Smoothing factor, higher reacts faster')
+    forecasts.add_argument('--history-days', type=int, default=90, help='How far into the history to look')
+    forecasts.add_argument('--horizon-days', type=float, default=RSES_FORECAST_HORIZON_DAYS,
+                           help='List what should be bought within this many days')
+    forecasts.set_defaults(handler=forecast)
+
+    prices = commands.add_parser('rebuild-prices', help='Build price sketches from the whole history of stock')
+    prices.set_defaults(handler=rebuild_price_sketches)
+
+    snapshot = commands.add_parser('snapshot-stock', help='Snapshot the amounts in stock for the ledger, run daily')
+    snapshot.add_argument('--expire', action='store_true', help='Throw out expired lots first')
+    snapshot.add_argument('--backfill', action='store_true', help='Record stock that predates the ledger first')
+    snapshot.add_argument('--keep-days', type=int, help='Drop snapshots older than this, except the newest of them')
+    snapshot.set_defaults(handler=snapshot_stock)
+
+    migrations = commands.add_parser('migrate', help='Apply the schema migrations the database does not have yet')
+    migrations.add_argument('--to', type=int, help='Last version to apply, all of them by default')
+    migrations.add_argument('--list', action='store_true', help='Only list the migrations and which were applied')
+    migrations.set_defaults(handler=migrate)
+
+    jobs = commands.add_parser('scheduler', help='Run the background jobs on their schedules, apart from the app')
+    jobs.add_argument('--run', metavar='JOB', help='Run the job once right away instead')
+    jobs.set_defaults(handler=run_scheduler)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    db.configure(statement_timeout=args.statement_timeout)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
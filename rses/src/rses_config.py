@@ -1,9 +1,74 @@
 # coding=utf-8
 """Configuration"""
 import os
+from typing import Dict, List
 
 SECRET_KEY: str = os.environ.get('SECRET_KEY', 'SUPER_SECRET')
 PORT: int = int(os.environ.get('PORT', 5000))
 DATABASE_URL: str = os.environ.get('RSES_DB_URL') or os.environ.get('DATABASE_URL')
 # Do you want a flask client
 RSES_WEB_CLIENT: bool = True
+# Budget in bytes for caching results of hot read queries in memory, 0 turns the cache off
+RSES_QUERY_CACHE_BYTES: int = int(os.environ.get('RSES_QUERY_CACHE_BYTES', 0))
+# Notify other workers about writes over LISTEN/NOTIFY, so their in-process caches don't go stale
+RSES_INVALIDATION_BUS: bool = os.environ.get('RSES_INVALIDATION_BUS', 'false').lower() == 'true'
+# How many times a transaction is retried on serialization failures or deadlocks, and base backoff in seconds
+RSES_TRANSACTION_RETRIES: int = int(os.environ.get('RSES_TRANSACTION_RETRIES', 5))
+RSES_TRANSACTION_BACKOFF: float = float(os.environ.get('RSES_TRANSACTION_BACKOFF', 0.05))
+# After how many days a cooked recipe counts as half as much towards favourites
+RSES_RECOMMENDATION_HALF_LIFE_DAYS: float = float(os.environ.get('RSES_RECOMMENDATION_HALF_LIFE_DAYS', 30))
+# Stock expiring within this many days is preferably used up by the meal planner
+RSES_PLANNER_EXPIRY_DAYS: int = int(os.environ.get('RSES_PLANNER_EXPIRY_DAYS', 7))
+# Text search configurations recipes are written in, the first is the default for new recipes.
+# Postgres has no Czech stemmer, 'simple' matches whole words of any language
+RSES_SEARCH_LANGUAGES: List[str] = [language.strip() for language in
+                                     os.environ.get('RSES_SEARCH_LANGUAGES', 'simple,english').split(',')
+                                     if language.strip()] or ['simple']
+# Shopping list suggests buying what is forecast to cross its threshold within this many days
+RSES_FORECAST_HORIZON_DAYS: float = float(os.environ.get('RSES_FORECAST_HORIZON_DAYS', 7))
+# Connections kept open per process for reuse, a query waits for a free one when all are taken, 0 opens one per query
+RSES_DB_POOL_SIZE: int = int(os.environ.get('RSES_DB_POOL_SIZE', 8))
+# Seconds a query waits for a free pooled connection before giving up
+RSES_DB_POOL_TIMEOUT: float = float(os.environ.get('RSES_DB_POOL_TIMEOUT', 10))
+# Queries prepared on every pooled connection once they run the second time, least recently used are deallocated
+RSES_PREPARED_STATEMENTS: int = int(os.environ.get('RSES_PREPARED_STATEMENTS', 100))
+# Production server (rses_serve.py): worker processes, 0 for twice the CPU count plus one
+RSES_WORKERS: int = int(os.environ.get('RSES_WORKERS', 0))
+# Gunicorn worker class - gthread, sync or gevent (needs gevent and psycogreen installed)
+RSES_WORKER_CLASS: str = os.environ.get('RSES_WORKER_CLASS', 'gthread')
+# Threads of a gthread worker, or concurrent requests of a gevent worker
+RSES_THREADS: int = int(os.environ.get('RSES_THREADS', 4))
+# Seconds a request may take before its worker is restarted, and a worker is given to finish when reloading
+RSES_TIMEOUT: int = int(os.environ.get('RSES_TIMEOUT', 30))
+RSES_GRACEFUL_TIMEOUT: int = int(os.environ.get('RSES_GRACEFUL_TIMEOUT', 30))
+# Seconds an idle client connection is kept open
+RSES_KEEPALIVE: int = int(os.environ.get('RSES_KEEPALIVE', 5))
+# Load the app once before forking workers, faster start and shared memory, but reloading (HUP) keeps the old code
+RSES_PRELOAD: bool = os.environ.get('RSES_PRELOAD', 'true').lower() == 'true'
+# Serve the async routes (/rses/api/async), which run their queries concurrently - needs psycopg and psycopg_pool
+RSES_ASYNC_API: bool = os.environ.get('RSES_ASYNC_API', 'false').lower() == 'true'
+# Async connections per process, shared by the concurrent queries of all requests served by the async routes
+RSES_ASYNC_POOL_SIZE: int = int(os.environ.get('RSES_ASYNC_POOL_SIZE', 20))
+# Seconds the server lets a statement run before cancelling it, 0 for no limit
+RSES_STATEMENT_TIMEOUT: float = float(os.environ.get('RSES_STATEMENT_TIMEOUT', 30))
+# Seconds all queries of an API request may take together, queries running past it are cancelled, 0 for no limit
+RSES_REQUEST_BUDGET: float = float(os.environ.get('RSES_REQUEST_BUDGET', 10))
+# Budgets of routes that need another one than RSES_REQUEST_BUDGET, e.g. 'import_recipes=120,get_shopping_list=2'.
+# The bulk imports (import_recipes, ingest_stock) have none by default, each of their statements still has
+# RSES_STATEMENT_TIMEOUT and the request RSES_TIMEOUT
+RSES_ROUTE_BUDGETS: Dict[str, float] = {
+    'import_recipes': 0, 'ingest_stock': 0,
+    **{route.strip(): float(seconds) for route, _, seconds in
+       (budget.partition('=') for budget in os.environ.get('RSES_ROUTE_BUDGETS', '').split(',') if budget.strip())}
+}
+# Seconds a client is told to wait before retrying a request that timed out or found no free connection
+RSES_RETRY_AFTER: int = int(os.environ.get('RSES_RETRY_AFTER', 1))
+# Run background jobs (rses_jobs.py) in a thread of every web worker, or run `rses_cli.py scheduler` on its own
+RSES_SCHEDULER: bool = os.environ.get('RSES_SCHEDULER', 'false').lower() == 'true'
+# Jobs running at once in a process
+RSES_SCHEDULER_WORKERS: int = int(os.environ.get('RSES_SCHEDULER_WORKERS', 2))
+# Schedules of jobs replacing their defaults, cron or interval, empty turns one off: 'forecast=0 4 * * *;warm-cache=10m'
+RSES_JOB_SCHEDULES: Dict[str, str] = {
+    job.strip(): schedule.strip() for job, _, schedule in
+    (spec.partition('=') for spec in os.environ.get('RSES_JOB_SCHEDULES', '').split(';') if spec.strip())
+}
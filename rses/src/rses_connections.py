@@ -1,26 +1,244 @@
 # coding=utf-8
-"""Connections"""
+"""
+Connections
+
+psycopg2 is imported when the first connection is made rather than with this module, so tools that don't
+touch the database (and the ones that do, until they do) start faster.
+"""
+import contextlib
+import io
 import logging
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, Sequence, Set, TypeVar, TYPE_CHECKING
 from typing import List, Optional, Any  # TODO any isn't really what we want, but namedtuple interface with mypy is weird
 from urllib.parse import urlparse, ParseResult
 
-import psycopg2
-import psycopg2.extras
+if TYPE_CHECKING:
+    import psycopg2.extensions
 
-from rses_config import DATABASE_URL
+from rses_cache import QueryCache, tables_written
+from rses_config import DATABASE_URL, RSES_QUERY_CACHE_BYTES, RSES_TRANSACTION_RETRIES, RSES_TRANSACTION_BACKOFF
+from rses_config import RSES_DB_POOL_SIZE, RSES_DB_POOL_TIMEOUT, RSES_PREPARED_STATEMENTS, RSES_STATEMENT_TIMEOUT
+from rses_deadlines import deadlines, timeouts, watchdog
+from rses_errors import QueryTimeout
+from rses_statements import StatementCache
 
 log = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
+
+class QueryCounter(threading.local):
+    """Queries run by the current thread, reset at the start of a request to tell how many it took"""
+
+    def __init__(self) -> None:
+        self.count: int = 0
+
+    def reset(self) -> int:
+        """Starts counting again, returns the count until now"""
+        count, self.count = self.count, 0
+        return count
+
+
+queries: QueryCounter = QueryCounter()
+
+
+def psycopg2_module():
+    """The database driver with its extensions, imported on first use"""
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.extras
+    return psycopg2
+
+
+class CountingCursor:
+    """
+    Cursor counting the queries it runs into `queries`, everything else is done by the wrapped cursor
+
+    Queries are run as prepared statements when the connection has a `rses_statements.StatementCache`.
+    A query is cancelled when it runs past the tightest of `rses_deadlines.deadlines`, which raises `QueryTimeout`.
+    """
+
+    def __init__(self, cursor: 'psycopg2.extensions.cursor') -> None:
+        self._cursor: 'psycopg2.extensions.cursor' = cursor
+        # The query as written when it ran as a prepared statement, the cursor has just the EXECUTE
+        self._prepared: Optional[bytes] = None
+
+    def __str__(self):
+        return f'Counting cursor of {self._cursor}'
+
+    def __repr__(self):
+        return f'CountingCursor(cursor={self._cursor!r})'
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def query(self) -> bytes:
+        """The last query that ran, with placeholders instead of the arguments when it was prepared"""
+        return self._prepared if self._prepared is not None else self._cursor.query
+
+    def execute(self, query, vars=None):
+        queries.count += 1
+        tightest = deadlines.tightest()
+        token: Optional[int] = None
+        if tightest is not None:
+            remaining = tightest.at - time.monotonic()
+            if remaining <= 0:
+                timeouts[tightest.name] += 1
+                raise QueryTimeout(tightest.seconds, tightest.name)
+            token = watchdog.watch(self._cursor.connection, remaining)
+        try:
+            return self.__execute(query, vars)
+        except psycopg2_module().extensions.QueryCanceledError as e:
+            if tightest is not None and time.monotonic() >= tightest.at:
+                timeouts[tightest.name] += 1
+                raise QueryTimeout(tightest.seconds, tightest.name) from e
+            timeouts['statement_timeout'] += 1
+            raise QueryTimeout() from e
+        finally:
+            if token is not None:
+                watchdog.unwatch(token)
+
+    def __execute(self, query, vars):
+        statements: Optional[StatementCache] = getattr(self._cursor.connection, 'statements', None)
+        if statements is not None and isinstance(query, str) and statements.execute(self._cursor, query, vars):
+            self._prepared = query.encode()
+            return None
+        self._prepared = None
+        return self._cursor.execute(query, vars)
+
+
+class TransactionCursor(CountingCursor):
+    """Cursor of a transaction, remembers which tables were written to invalidate the cache after commit"""
+
+    def __init__(self, cursor: 'psycopg2.extensions.cursor') -> None:
+        super().__init__(cursor)
+        self.written: Set[str] = set()
+
+    def __repr__(self):
+        return f'TransactionCursor(cursor={self._cursor!r}, written={self.written})'
+
+    def execute(self, query, vars=None):
+        result = super().execute(query, vars)
+        log.debug("Ran query in transaction\n'%s'", _query_for_log(self.query))
+        self.written.update(tables_written(self.query.decode()))
+        return result
+
+
+class PoolTimeout(Exception):
+    """No pooled connection got free in time"""
+
+
+class ConnectionPool:
+    """
+    Connections kept open between queries, up to a limit, waiting for a free one when all are taken.
+
+    Connections must not be shared by forked processes, so the pool notices it is used in a child process
+    (a worker forked by the server after the app was preloaded) and starts over without touching what the
+    parent opened.
+    """
+
+    def __init__(self, connect: Callable[[], 'psycopg2.extensions.connection'], size: int, timeout: float) -> None:
+        """
+        :param connect: Opens a new connection
+        :param size:    Most connections open at once
+        :param timeout: Seconds to wait for a free connection
+        """
+        self.connect: Callable[[], 'psycopg2.extensions.connection'] = connect
+        self.size: int = size
+        self.timeout: float = timeout
+        self._lock = threading.Lock()
+        self.__start()
+
+    def __str__(self):
+        return f'Connection pool {len(self._idle)} idle of {self.size}'
+
+    def __repr__(self):
+        return f'ConnectionPool(size={self.size}, timeout={self.timeout}, idle={len(self._idle)})'
+
+    def get(self) -> 'psycopg2.extensions.connection':
+        """Takes an idle connection or opens a new one, has to be given back by `put`"""
+        if self._pid != os.getpid():
+            self.reset()
+        if not self._free.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'No free connection within {self.timeout}s, all {self.size} are taken')
+        try:
+            with self._lock:
+                while self._idle:
+                    conn = self._idle.pop()
+                    if not conn.closed:
+                        return conn
+            return self.connect()
+        except BaseException:
+            self._free.release()
+            raise
+
+    def put(self, conn: 'psycopg2.extensions.connection') -> None:
+        """Gives the connection back, it is closed instead when broken or left in a transaction"""
+        if self._pid != os.getpid():
+            # Taken before a fork, it belongs to the parent
+            return
+        try:
+            idle = psycopg2_module().extensions.TRANSACTION_STATUS_IDLE
+            if conn.closed or conn.get_transaction_status() != idle:
+                conn.close()
+            else:
+                conn.autocommit = True
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._free.release()
+
+    def reset(self) -> None:
+        """Forgets all connections without closing them, for the child process after a fork"""
+        with self._lock:
+            self.__start()
+        log.debug('Connection pool reset in process %s', self._pid)
+
+    def close(self) -> None:
+        """Closes the idle connections"""
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    def __start(self) -> None:
+        self._pid: int = os.getpid()
+        self._idle: List['psycopg2.extensions.connection'] = list()
+        self._free = threading.BoundedSemaphore(self.size)
+
 
 class DatabaseAdapter:
     """More friendly adapter for the database, takes care of logging and abstracts the connection/cursor"""
 
-    def __init__(self, url: str = DATABASE_URL) -> None:
+    def __init__(self, url: str = DATABASE_URL, cache_bytes: int = RSES_QUERY_CACHE_BYTES,
+                 pool_size: int = RSES_DB_POOL_SIZE, pool_timeout: float = RSES_DB_POOL_TIMEOUT,
+                 prepared_statements: int = RSES_PREPARED_STATEMENTS,
+                 statement_timeout: float = RSES_STATEMENT_TIMEOUT) -> None:
+        """
+        :param url:                 Url of the database
+        :param cache_bytes:         Memory budget of the query result cache, 0 for no caching
+        :param pool_size:           Connections kept open for reuse, 0 opens a new connection for every query
+        :param pool_timeout:        Seconds to wait for a free pooled connection
+        :param prepared_statements: Queries prepared on each pooled connection, 0 prepares none
+        :param statement_timeout:   Seconds the server lets a statement run, 0 for no limit
+        """
         connection_data: ParseResult = urlparse(url)
         self.username: str = connection_data.username
         self.password: str = connection_data.password
         self.database: str = connection_data.path[1:]
         self.hostname: str = connection_data.hostname
+        self.cache: Optional[QueryCache] = QueryCache(cache_bytes) if cache_bytes else None
+        self.pool: Optional[ConnectionPool] = ConnectionPool(self.__pooled_connection, pool_size, pool_timeout) \
+            if pool_size else None
+        self.prepared_statements: int = prepared_statements
+        self.statement_timeout: float = statement_timeout
 
     def __str__(self):
         return 'Database adapter'
@@ -29,38 +247,89 @@ class DatabaseAdapter:
         return f'DatabaseAdapter(username={self.username}, hostname={self.hostname}, database={self.database})'
 
     @property
-    def connection(self) -> psycopg2.extensions.connection:
+    def connection(self) -> 'psycopg2.extensions.connection':
         """Creates and returns new connection to the database"""
+        psycopg2 = psycopg2_module()
         conn: psycopg2.extensions.connection = psycopg2.connect(
             database=self.database,
             user=self.username,
             password=self.password,
             host=self.hostname,
             connection_factory=psycopg2.extras.NamedTupleConnection,
-            cursor_factory=psycopg2.extras.NamedTupleCursor
+            cursor_factory=psycopg2.extras.NamedTupleCursor,
+            options=f'-c statement_timeout={round(self.statement_timeout * 1000)}' if self.statement_timeout else None
         )
         conn.autocommit = True
         # log.debug("Connection made to host: %s, database: %s. Server version: %s, server encoding: %s",
         #           self.hostname, self.database, conn.server_version, conn.encoding)
         return conn
 
+    def __pooled_connection(self) -> 'psycopg2.extensions.connection':
+        """New connection for the pool, which lives long enough to prepare statements on it"""
+        conn = self.connection
+        if self.prepared_statements:
+            conn.statements = StatementCache(self.prepared_statements)
+        return conn
+
     @property
-    def cursor(self) -> psycopg2.extras.NamedTupleCursor:
+    def cursor(self) -> 'psycopg2.extras.NamedTupleCursor':
         """Creates and returns new database cursor"""
         with self.connection as conn:
             return conn.cursor()
 
-    def select(self, query: str, *args) -> Any:
-        """Wrapped execute around select statement for single result"""
-        with self.cursor as cur:
+    @contextlib.contextmanager
+    def pooled(self) -> Iterator['psycopg2.extensions.connection']:
+        """Connection from the pool for the duration of the block, or a new one closed after it without a pool"""
+        if self.pool is None:
+            conn = self.connection
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+        conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+
+    @contextlib.contextmanager
+    def __cursor(self) -> Iterator[CountingCursor]:
+        with self.pooled() as conn:
+            with conn.cursor() as cur:
+                yield CountingCursor(cur)
+
+    def select(self, query: str, *args, cache: bool = False) -> Any:
+        """
+        Wrapped execute around select statement for single result
+
+        :param cache:   Serve the result from the query cache if it is turned on
+        """
+        if cache and self.cache is not None:
+            return self.cache.get_or_load(query, args, lambda: self.__select(query, args))
+        return self.__select(query, args)
+
+    def select_all(self, query: str, *args, cache: bool = False) -> List[Any]:
+        """
+        Wrapped execute around select statement for multiple results
+
+        :param cache:   Serve the result from the query cache if it is turned on
+        """
+        if cache and self.cache is not None:
+            return self.cache.get_or_load(query, args, lambda: self.__select_all(query, args))
+        return self.__select_all(query, args)
+
+    def __select(self, query: str, args: tuple) -> Any:
+        """Runs select statement for single result"""
+        with self.__cursor() as cur:
             cur.execute(query, args)
             result = cur.fetchone()
             log.debug("Ran select query\n'%s'\nResult: %s", _query_for_log(cur.query), result)
         return result
 
-    def select_all(self, query: str, *args) -> List[Any]:
-        """Wrapped execute around select statement for multiple results"""
-        with self.cursor as cur:
+    def __select_all(self, query: str, args: tuple) -> List[Any]:
+        """Runs select statement for multiple results"""
+        with self.__cursor() as cur:
             cur.execute(query, args)
             result = cur.fetchall()
             log.debug("Ran select all query\n'%s'\nResult: %s", _query_for_log(cur.query), result)
@@ -68,28 +337,71 @@ class DatabaseAdapter:
 
     def delete(self, query: str, *args) -> int:
         """Wrapped execute around delete statement"""
-        with self.cursor as cur:
+        with self.__cursor() as cur:
             cur.execute(query, args)
             log.debug("Ran delete query\n'%s'\nRows affected: %s", _query_for_log(cur.query), cur.rowcount)
             row_count = cur.rowcount
+            self.__invalidate(cur.query)
         return row_count
 
     def insert(self, query: str, *args) -> Optional[Any]:
-        """Wrapped execute around insert statement"""
-        with self.cursor as cur:
+        """Wrapped execute around insert statement, returns the first returned row, if any"""
+        with self.__cursor() as cur:
             cur.execute(query, args)
-            result = cur.fetchone()
+            result = cur.fetchone() if cur.description is not None else None
             log.debug("Ran insert query\n'%s'\nReturning: %s", _query_for_log(cur.query), result)
+            self.__invalidate(cur.query)
         return result
 
     def update(self, query: str, *args) -> int:
         """Wrapped execute around update statement"""
-        with self.cursor as cur:
+        with self.__cursor() as cur:
             cur.execute(query, args)
             log.debug("Ran update query\n'%s'\nRows affected: %s", _query_for_log(cur.query), cur.rowcount)
             row_count = cur.rowcount
+            self.__invalidate(cur.query)
         return row_count
 
+    def run_transaction(self, work: Callable[[TransactionCursor], T], retries: int = RSES_TRANSACTION_RETRIES,
+                        backoff: float = RSES_TRANSACTION_BACKOFF) -> T:
+        """
+        Runs the work in a single transaction, which is committed if the work returns and rolled back if it raises
+
+        Serialization failures and deadlocks roll back and run the whole work again, after a randomized
+        exponential backoff, so the work must not have side effects outside of the database.
+
+        :param work:        Function doing the queries with the cursor it gets
+        :param retries:     How many times to try again after a serialization failure or deadlock
+        :param backoff:     Base of the wait between attempts in seconds, doubled with every attempt
+        :return:            What the work returned
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.pooled() as conn:
+                    conn.autocommit = False
+                    with conn:
+                        with conn.cursor() as raw:
+                            cur = TransactionCursor(raw)
+                            result = work(cur)
+                            written = cur.written
+                break
+            except psycopg2_module().extensions.TransactionRollbackError as e:
+                if attempt >= retries:
+                    raise
+                wait = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                attempt += 1
+                log.debug('Transaction conflict (%s), retrying in %.3fs, attempt %s', e.pgcode, wait, attempt)
+                time.sleep(wait)
+        if self.cache is not None and written:
+            self.cache.invalidate(written)
+        return result
+
+    def __invalidate(self, query: bytes) -> None:
+        """Drops cached results of the table the query that ran wrote into"""
+        if self.cache is not None:
+            self.cache.invalidate_query(query.decode())
+
 
 def _query_for_log(query: bytes) -> str:
     """
@@ -101,4 +413,119 @@ def _query_for_log(query: bytes) -> str:
     """
     return ' '.join(query.decode().replace('\n', ' ').split())
 
-db: DatabaseAdapter = DatabaseAdapter()
+
+def copy_rows(cur: 'psycopg2.extensions.cursor', table: str, columns: Sequence[str],
+              rows: Iterable[Sequence[Any]]) -> int:
+    """
+    Loads rows into a table with COPY, which is a lot faster than inserting them one by one
+
+    :param cur:         Cursor to copy with, usually of a transaction
+    :param table:       Table to copy into
+    :param columns:     Columns in the order of the values in the rows
+    :param rows:        Rows to load, all of them are buffered in memory - copy in chunks
+    :return:            How many rows were copied
+    """
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write('\t'.join(_copy_value(value) for value in row))
+        buffer.write('\n')
+        count += 1
+    buffer.seek(0)
+    from psycopg2 import sql
+    query = sql.SQL('COPY {} ({}) FROM STDIN').format(
+        sql.Identifier(table), sql.SQL(', ').join(sql.Identifier(column) for column in columns)
+    )
+    cur.copy_expert(query, buffer)
+    log.debug('Copied %s rows into %s', count, table)
+    return count
+
+
+def _copy_value(value: Any) -> str:
+    """Formats a value for the text format of COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class LazyDatabaseAdapter:
+    """
+    Stands in for the database adapter until it is first used, then creates it and passes everything to it
+
+    The adapter is configured from `rses_config` unless `configure` was called before, e.g. by an app factory.
+    """
+
+    def __init__(self) -> None:
+        self._adapter: Optional[DatabaseAdapter] = None
+        self._options: Dict[str, Any] = dict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return 'Database adapter' if self._adapter is None else str(self._adapter)
+
+    def __repr__(self):
+        return f'LazyDatabaseAdapter(adapter={self._adapter!r})'
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.adapter, name)
+
+    @property
+    def adapter(self) -> DatabaseAdapter:
+        """The adapter, created on first use"""
+        if self._adapter is None:
+            with self._lock:
+                if self._adapter is None:
+                    self._adapter = create_adapter(**self._options)
+        return self._adapter
+
+    @property
+    def created(self) -> bool:
+        """Whether the adapter was created already, by a query or `use`"""
+        return self._adapter is not None
+
+    def configure(self, **options: Any) -> None:
+        """
+        Sets the arguments of `DatabaseAdapter` the adapter is created with, replacing an adapter already created
+
+        :param options: Any of url, cache_bytes, pool_size, pool_timeout, prepared_statements, statement_timeout,
+                        the rest comes from `rses_config`
+        """
+        with self._lock:
+            self.__close()
+            self._options = options
+            self._adapter = None
+
+    def use(self, adapter: Any) -> None:
+        """
+        Replaces the adapter with one created elsewhere, e.g. a `rses_sqlite.SQLiteAdapter` of a test
+
+        :param adapter: Anything with the select, select_all, insert, update, delete and run_transaction of
+                        `DatabaseAdapter`
+        """
+        with self._lock:
+            if adapter is not self._adapter:
+                self.__close()
+            self._adapter = adapter
+
+    def __close(self) -> None:
+        if self._adapter is not None and self._adapter.pool is not None:
+            self._adapter.pool.close()
+
+
+def create_adapter(url: str = DATABASE_URL, **options: Any) -> Any:
+    """
+    Creates the adapter of the storage the url points to, sqlite:// urls get `rses_sqlite.SQLiteAdapter`
+
+    :param url:     Url of the database
+    :param options: Other arguments of `DatabaseAdapter`, the ones SQLite has no use for are ignored there
+    :return:        `DatabaseAdapter` or `rses_sqlite.SQLiteAdapter`
+    """
+    if urlparse(url or '').scheme == 'sqlite':
+        from rses_sqlite import SQLiteAdapter
+        return SQLiteAdapter(url, **options)
+    return DatabaseAdapter(url, **options)
+
+
+db: LazyDatabaseAdapter = LazyDatabaseAdapter()
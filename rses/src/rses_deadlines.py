@@ -0,0 +1,168 @@
+# coding=utf-8
+"""
+Latency budgets of queries
+
+A budget is opened around a call (`with deadline(2): ...`) or a whole request (by the API, RSES_REQUEST_BUDGET or
+RSES_ROUTE_BUDGETS), every query run by the thread inside it has to finish by then. The `watchdog` cancels queries
+running past the tightest budget, the database adapter then raises `rses_errors.QueryTimeout`. The server caps
+every statement at RSES_STATEMENT_TIMEOUT on its own, in case the client is gone.
+"""
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Timed out queries by the name of the budget they ran out of, approximate under concurrency
+timeouts: 'Counter[str]' = Counter()
+
+
+class Budget(tuple):
+    """Latency budget, when it runs out, how long it was and what it is for"""
+
+    def __new__(cls, at: float, seconds: float, name: str) -> 'Budget':
+        return super().__new__(cls, (at, seconds, name))
+
+    @property
+    def at(self) -> float:
+        return self[0]
+
+    @property
+    def seconds(self) -> float:
+        return self[1]
+
+    @property
+    def name(self) -> str:
+        return self[2]
+
+
+class Deadlines(threading.local):
+    """Budgets open in the current thread, the one running out first applies"""
+
+    def __init__(self) -> None:
+        self._budgets: List[Budget] = list()
+
+    def __str__(self):
+        tightest = self.tightest()
+        return 'No deadline' if tightest is None else f'Deadline of {tightest.name} in {self.remaining():.3f}s'
+
+    def __repr__(self):
+        return f'Deadlines(budgets={self._budgets})'
+
+    def push(self, seconds: float, name: str) -> None:
+        """Opens a budget of the seconds from now"""
+        self._budgets.append(Budget(time.monotonic() + seconds, seconds, name))
+
+    def pop(self) -> None:
+        """Closes the budget opened last"""
+        self._budgets.pop()
+
+    def reset(self) -> None:
+        """Closes all budgets, at the end of a request"""
+        self._budgets.clear()
+
+    def tightest(self) -> Optional[Budget]:
+        """The budget running out first"""
+        return min(self._budgets) if self._budgets else None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left of the tightest budget, None without one"""
+        tightest = self.tightest()
+        return None if tightest is None else tightest.at - time.monotonic()
+
+
+deadlines: Deadlines = Deadlines()
+
+
+@contextlib.contextmanager
+def deadline(seconds: float, name: str = 'call') -> Iterator[None]:
+    """
+    Queries run in the block have to finish within the seconds, tighter budgets already open still apply
+
+    :param seconds: The budget
+    :param name:    What the budget is for, timeouts are counted by it
+    """
+    deadlines.push(seconds, name)
+    try:
+        yield
+    finally:
+        deadlines.pop()
+
+
+class Watchdog:
+    """
+    Cancels queries running past their deadline, one thread watches the connections of all threads of the process
+
+    A connection is cancelled under the lock `unwatch` takes, so once `unwatch` returns, no cancel of the
+    finished query can hit the next one.
+    """
+
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, Any]] = list()
+        self._watched: Dict[int, Any] = dict()
+        self._tokens = itertools.count()
+        self._condition = threading.Condition()
+        self._pid: Optional[int] = None
+
+    def __str__(self):
+        return f'Query watchdog of {len(self._watched)} queries'
+
+    def __repr__(self):
+        return f'Watchdog(watched={len(self._watched)}, pid={self._pid})'
+
+    def watch(self, conn: Any, seconds: float) -> int:
+        """
+        Cancels the query running on the connection when it takes longer than the seconds
+
+        :param conn:    Connection with a `cancel` method, like the ones of psycopg2
+        :param seconds: Time left for the query
+        :return:        Token for `unwatch`
+        """
+        token = next(self._tokens)
+        with self._condition:
+            if self._pid != os.getpid():
+                # The thread of the parent does not exist in a forked child
+                self._pid = os.getpid()
+                self._heap.clear()
+                self._watched.clear()
+                threading.Thread(target=self.__run, name='rses-watchdog', daemon=True).start()
+            self._watched[token] = conn
+            heapq.heappush(self._heap, (time.monotonic() + seconds, token, conn))
+            self._condition.notify()
+        return token
+
+    def unwatch(self, token: int) -> None:
+        """Stops watching the query, it finished"""
+        with self._condition:
+            self._watched.pop(token, None)
+
+    def __run(self) -> None:
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                at, token, conn = self._heap[0]
+                if token not in self._watched:
+                    heapq.heappop(self._heap)
+                    continue
+                wait = at - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                del self._watched[token]
+                try:
+                    conn.cancel()
+                    log.debug('Cancelled a query past its deadline')
+                except Exception:
+                    log.exception('Could not cancel a query past its deadline')
+
+
+watchdog: Watchdog = Watchdog()
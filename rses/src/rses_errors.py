@@ -1,6 +1,6 @@
 # coding=utf-8
 """Errors"""
-from typing import Optional, Type
+from typing import Optional, Type, Dict
 
 
 class DoesNotExist(Exception):
@@ -55,4 +55,30 @@ class MissingParameter(Exception):
 
 class NotEnoughIngredients(Exception):
     """Error raised when ingredients are missing to cook a recipe"""
-    pass
+    def __init__(self, missing: Optional[Dict[int, float]] = None) -> None:
+        """
+        :param missing:     How much is missing of which ingredient, by ingredient id
+        """
+        self.missing: Dict[int, float] = missing or dict()
+
+    def __str__(self):
+        if not self.missing:
+            return 'Not enough ingredients'
+        missing = ', '.join(f'{amount} of ingredient {ingredient}' for ingredient, amount in self.missing.items())
+        return f'Not enough ingredients, missing {missing}'
+
+
+class QueryTimeout(Exception):
+    """Error raised when a query ran out of its latency budget and was cancelled"""
+    def __init__(self, budget: Optional[float] = None, name: str = 'statement_timeout') -> None:
+        """
+        :param budget:      Seconds the query had, None when the server cancelled it on its own
+        :param name:        What the budget was for, a route, a call or the statement timeout of the server
+        """
+        self.budget: Optional[float] = budget
+        self.name: str = name
+
+    def __str__(self):
+        if self.budget is None:
+            return f'Query cancelled by {self.name}'
+        return f'Query ran out of the {self.budget}s budget of {self.name}'
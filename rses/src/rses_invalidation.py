@@ -0,0 +1,167 @@
+# coding=utf-8
+"""Cache invalidation across workers and hosts over Postgres LISTEN/NOTIFY"""
+import logging
+import select
+import threading
+from typing import Callable, List, Optional
+
+from rses_config import RSES_INVALIDATION_BUS
+from rses_connections import db, DatabaseAdapter, psycopg2_module
+
+log = logging.getLogger(__name__)
+
+CHANNEL: str = 'rses_invalidate'
+# Key telling listeners that notifications could have been missed and everything has to go
+EVERYTHING: str = '*'
+# Postgres refuses payloads of 8000 bytes and more
+_MAX_PAYLOAD: int = 7900
+
+
+def entity_key(table: str, identifier: Optional[int] = None) -> str:
+    """
+    Key of a changed entity, 'ingredient:5' for a single row or 'stock' for the whole table
+
+    :param table:       Table the entity is stored in
+    :param identifier:  Id of the row, if only one changed
+    """
+    if identifier is None:
+        return table
+    return f'{table}:{identifier}'
+
+
+def table_of(key: str) -> str:
+    """Table part of an entity key"""
+    return key.split(':', 1)[0]
+
+
+class InvalidationBus:
+    """
+    Publishes keys of changed entities to all workers and evicts them from the local caches.
+
+    Writes call `publish`, which notifies every listening worker (including this one) through the database,
+    each worker runs a background thread started by `start` that hands the keys to subscribed handlers.
+    When the bus is disabled, publishing only evicts the local caches.
+    """
+
+    def __init__(self, adapter: DatabaseAdapter, enabled: bool = RSES_INVALIDATION_BUS,
+                 poll_timeout: float = 5.0) -> None:
+        """
+        :param adapter:         Database to publish and listen through
+        :param enabled:         Whether to notify other workers at all
+        :param poll_timeout:    How often (in seconds) the listener checks whether it should stop
+        """
+        self.adapter: DatabaseAdapter = adapter
+        self.enabled: bool = enabled
+        self.poll_timeout: float = poll_timeout
+        self._handlers: List[Callable[[str], None]] = list()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __str__(self):
+        return f"Invalidation bus on channel '{CHANNEL}'"
+
+    def __repr__(self):
+        return f'InvalidationBus(enabled={self.enabled}, listening={self.listening}, handlers={len(self._handlers)})'
+
+    @property
+    def listening(self) -> bool:
+        """Whether the listener thread is running"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def subscribe(self, handler: Callable[[str], None]) -> None:
+        """Registers a function evicting a key (or everything for `EVERYTHING`) from a local cache"""
+        self._handlers.append(handler)
+
+    def publish(self, *keys: str) -> None:
+        """Announces that entities identified by the keys changed"""
+        if not keys:
+            return
+        # Apply locally right away, so this worker reads its own writes before the notification comes back
+        self._dispatch(keys)
+        if self.enabled:
+            for payload in _payloads(keys):
+                self.adapter.select('SELECT pg_notify(%s, %s)', CHANNEL, payload)
+
+    def start(self) -> None:
+        """Starts the listener thread, has to be called in every process (after forking)"""
+        if not self.enabled or self.listening:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.__listen, name='rses-invalidation', daemon=True)
+        self._thread.start()
+        log.debug('Started listening on %s', CHANNEL)
+
+    def stop(self) -> None:
+        """Stops the listener thread"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _dispatch(self, keys) -> None:
+        """Hands the keys to all handlers, a failing handler does not stop the others"""
+        for key in keys:
+            for handler in self._handlers:
+                try:
+                    handler(key)
+                except Exception:
+                    log.exception('Invalidation handler %s failed for key %s', handler, key)
+
+    def __listen(self) -> None:
+        """Listens for notifications until stopped, reconnecting when the connection is lost"""
+        backoff = 0.5
+        psycopg2 = psycopg2_module()
+        while not self._stop.is_set():
+            try:
+                conn = self.adapter.connection
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(f'LISTEN {CHANNEL}')
+                    # Anything published while we were not listening is lost
+                    self._dispatch([EVERYTHING])
+                    backoff = 0.5
+                    self.__poll(conn)
+                finally:
+                    conn.close()
+            except psycopg2.Error:
+                log.exception('Lost connection of the invalidation listener, reconnecting in %ss', backoff)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def __poll(self, conn) -> None:
+        """Hands incoming notifications to the handlers"""
+        while not self._stop.is_set():
+            if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notification = conn.notifies.pop(0)
+                self._dispatch(notification.payload.split())
+
+
+def _payloads(keys) -> List[str]:
+    """Packs the keys into as few notification payloads as possible"""
+    payloads: List[str] = list()
+    current = ''
+    for key in keys:
+        if current and len(current) + len(key) + 1 > _MAX_PAYLOAD:
+            payloads.append(current)
+            current = ''
+        current = f'{current} {key}' if current else key
+    payloads.append(current)
+    return payloads
+
+
+def _evict_from_query_cache(key: str) -> None:
+    """Drops cached query results of the table the key belongs to"""
+    if db.cache is None:
+        return
+    if key == EVERYTHING:
+        db.cache.clear()
+    else:
+        db.cache.invalidate([table_of(key)])
+
+
+bus: InvalidationBus = InvalidationBus(db)
+# Checks for the cache on every key, the database adapter is created on first use
+bus.subscribe(_evict_from_query_cache)
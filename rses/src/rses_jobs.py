@@ -0,0 +1,60 @@
+# coding=utf-8
+"""
+Background jobs of the kitchen, registered on `rses_scheduler.scheduler` when this module is imported
+
+Their schedules can be replaced or turned off by RSES_JOB_SCHEDULES. Jobs without their own command line
+counterpart can be run once by `rses_cli.py scheduler --run <job>`.
+"""
+import datetime
+import logging
+
+from rses_config import RSES_FORECAST_HORIZON_DAYS, RSES_PLANNER_EXPIRY_DAYS
+from rses_connections import db
+from rses_scheduler import scheduler
+from objects.forecasting import ConsumptionForecaster
+from objects.ledger import StockLedger
+from objects.stock import IngredientListing, IngredientTypeListing
+
+log = logging.getLogger(__name__)
+
+
+@scheduler.job('forecast', '15 3 * * *')
+def refresh_forecast() -> None:
+    """Refreshes the forecast consumption, so the shopping list suggests what will run out"""
+    log.info('Forecast consumption of %s ingredients', ConsumptionForecaster().refresh())
+
+
+@scheduler.job('snapshot-stock', '30 3 * * *')
+def snapshot_stock() -> None:
+    """Snapshots the amounts in stock, so the stock at any point in time is computed from a recent one"""
+    log.info('Took a stock snapshot at %s', StockLedger.snapshot())
+
+
+@scheduler.job('expiry-warnings', '0 7 * * *')
+def warn_about_expiry() -> None:
+    """Warns about what is left of lots expiring soon, while it can still be cooked"""
+    query = """
+    SELECT i.name, i.unit, sum(s.amount_left) AS amount,
+           min(COALESCE(s.expiration_date, s.time_bought::DATE + i.durability)) AS expires
+    FROM stock s
+    JOIN ingredient i ON i.id = s.ingredient
+    WHERE s.amount_left > 0
+    AND COALESCE(s.expiration_date, s.time_bought::DATE + i.durability) BETWEEN %s AND %s
+    GROUP BY i.id
+    ORDER BY expires, i.name
+    """
+    today = datetime.date.today()
+    for row in db.select_all(query, today, today + datetime.timedelta(days=RSES_PLANNER_EXPIRY_DAYS)):
+        log.warning('%s %s of %s expire on %s', row.amount, row.unit, row.name, row.expires)
+
+
+@scheduler.job('warm-cache', '5m', exclusive=False)
+def warm_cache() -> None:
+    """Loads the hot reads into the query cache of this process again, after writes evicted them"""
+    if db.cache is None:
+        return
+    IngredientTypeListing().total
+    IngredientTypeListing.show()
+    IngredientListing().total
+    IngredientListing.show()
+    ConsumptionForecaster.due(RSES_FORECAST_HORIZON_DAYS)
@@ -0,0 +1,200 @@
+# coding=utf-8
+"""
+Versioned, forward-only schema migrations
+
+database/create.sql creates the schema of version 0, every later change of it is a script in database/migrations
+named <version>_<what>.sql. `rses_cli.py migrate` applies the ones the database does not have yet, in the order of
+their versions, and records them in the schema_migration table. A script runs in a single transaction unless its
+first line is `-- rses: no-transaction`, which statements like CREATE INDEX CONCURRENTLY need. Such a script runs
+statement by statement, so it has to be safe to run again after it failed halfway (IF NOT EXISTS). A failed
+CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which IF NOT EXISTS would take for done, so every index
+such a statement names is checked after it ran, and an invalid one is dropped and built again.
+"""
+import datetime
+import logging
+import os
+import re
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from rses_connections import db
+
+log = logging.getLogger(__name__)
+
+MIGRATIONS: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'database', 'migrations')
+NO_TRANSACTION: str = '-- rses: no-transaction'
+# Key of the advisory lock keeping processes migrating at the same time apart
+_LOCK: int = 7_372_657_365
+_FILE = re.compile(r'^(\d+)_(\w+)\.sql$')
+# Statements end with a semicolon at the end of a line
+_STATEMENT_END = re.compile(r';[ \t]*$', re.MULTILINE)
+# Name of the index built by a statement
+_CREATE_INDEX = re.compile(r'^CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?("?[\w.]+"?)',
+                           re.IGNORECASE | re.MULTILINE)
+
+
+class Migration(NamedTuple):
+    """Script changing the schema from the version before to this one"""
+    version: int
+    name: str
+    path: str
+
+    @property
+    def sql(self) -> str:
+        with open(self.path, encoding='utf-8') as script:
+            return script.read()
+
+    @property
+    def transactional(self) -> bool:
+        """Runs in a single transaction, unless the first line of the script says otherwise"""
+        return not self.sql.startswith(NO_TRANSACTION)
+
+    @property
+    def statements(self) -> List[str]:
+        """Statements of the script, without the ones that are only comments"""
+        statements = (statement.strip() for statement in _STATEMENT_END.split(self.sql))
+        return [statement for statement in statements if any(
+            line.strip() and not line.strip().startswith('--') for line in statement.splitlines()
+        )]
+
+
+def discover(directory: str = MIGRATIONS) -> List[Migration]:
+    """
+    Finds the migrations in the directory
+
+    :param directory:   Directory with the scripts
+    :return:            Migrations sorted by version
+    :raises ValueError: When two scripts have the same version
+    """
+    migrations: Dict[int, Migration] = dict()
+    for file_name in os.listdir(directory):
+        match = _FILE.match(file_name)
+        if match is None:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise ValueError(f'Migrations {migrations[version].path} and {file_name} have the same version {version}')
+        migrations[version] = Migration(version, match.group(2), os.path.join(directory, file_name))
+    return [migrations[version] for version in sorted(migrations)]
+
+
+class Migrator:
+    """Applies the migrations the database does not have yet, one process at a time"""
+
+    QUERY_CREATE = """
+    CREATE TABLE IF NOT EXISTS schema_migration
+    (
+      version    INT PRIMARY KEY,
+      name       TEXT      NOT NULL,
+      applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    """
+    QUERY_APPLIED = """
+    SELECT version, applied_at
+    FROM schema_migration
+    """
+    QUERY_RECORD = """
+    INSERT INTO schema_migration (version, name)
+    VALUES (%s, %s)
+    """
+    QUERY_INDEX_VALID = """
+    SELECT indisvalid AS valid
+    FROM pg_index
+    WHERE indexrelid = to_regclass(%s)
+    """
+
+    def __init__(self, adapter: Any = db, directory: str = MIGRATIONS) -> None:
+        """
+        :param adapter:     Database adapter of a Postgres database
+        :param directory:   Directory with the scripts
+        """
+        self.adapter: Any = adapter
+        self.directory: str = directory
+
+    def __str__(self):
+        return f'Migrator of {self.directory}'
+
+    def __repr__(self):
+        return f'Migrator(adapter={self.adapter!r}, directory={self.directory})'
+
+    @property
+    def migrations(self) -> List[Migration]:
+        return discover(self.directory)
+
+    def applied(self) -> Dict[int, datetime.datetime]:
+        """When the applied migrations were applied, by version"""
+        with self.adapter.pooled() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self.QUERY_CREATE)
+                cur.execute(self.QUERY_APPLIED)
+                return {row.version: row.applied_at for row in cur.fetchall()}
+
+    def pending(self) -> List[Migration]:
+        """Migrations the database does not have yet"""
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def migrate(self, target: Optional[int] = None) -> List[Migration]:
+        """
+        Applies the migrations the database does not have yet, waits for another process migrating to finish first
+
+        :param target:  Last version to apply, all of them by default
+        :return:        The migrations that were applied
+        """
+        done: List[Migration] = list()
+        with self.adapter.pooled() as conn:
+            with conn.cursor() as cur:
+                cur.execute(self.QUERY_CREATE)
+                cur.execute('SELECT pg_advisory_lock(%s)', (_LOCK,))
+                try:
+                    cur.execute(self.QUERY_APPLIED)
+                    applied = {row.version for row in cur.fetchall()}
+                    for migration in self.migrations:
+                        if migration.version in applied or (target is not None and migration.version > target):
+                            continue
+                        self.__apply(conn, cur, migration)
+                        done.append(migration)
+                finally:
+                    cur.execute('SELECT pg_advisory_unlock(%s)', (_LOCK,))
+        return done
+
+    def __apply(self, conn, cur, migration: Migration) -> None:
+        log.info('Applying migration %s %s', migration.version, migration.name)
+        if not migration.transactional:
+            for statement in migration.statements:
+                log.debug('Running %s', ' '.join(statement.split()))
+                cur.execute(statement)
+                self.__rebuild_invalid(cur, statement)
+            cur.execute(self.QUERY_RECORD, (migration.version, migration.name))
+            return
+        conn.autocommit = False
+        try:
+            cur.execute(migration.sql)
+            cur.execute(self.QUERY_RECORD, (migration.version, migration.name))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+
+    def __rebuild_invalid(self, cur, statement: str) -> None:
+        """
+        Drops and builds again the index of a CREATE INDEX CONCURRENTLY, if an earlier failed build left it invalid
+
+        :raises RuntimeError:   When it is still invalid after building it again
+        """
+        match = _CREATE_INDEX.search(statement)
+        if match is None:
+            return
+        index = match.group(1)
+        for attempt in range(2):
+            cur.execute(self.QUERY_INDEX_VALID, (index,))
+            row = cur.fetchone()
+            if row is None or row.valid:
+                return
+            if attempt:
+                break
+            log.warning('Index %s was left invalid by a failed build, building it again', index)
+            cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index}')
+            cur.execute(statement)
+        raise RuntimeError(f'Index {index} is still invalid after building it again, drop it and migrate again')
@@ -0,0 +1,153 @@
+# coding=utf-8
+"""Compact streaming sketch of a distribution, for quantiles of values that can't all be kept"""
+import math
+from typing import Any, Dict, List, Optional
+
+
+class TDigest:
+    """
+    Merging t-digest, summarizes any number of values in a few times `compression` centroids
+    (the count grows with the logarithm of the number of values, a few hundred for millions).
+
+    Centroids near the tails are kept small and those around the median large, so extreme quantiles
+    stay accurate. Exact count, mean, variance (Welford), minimum and maximum are tracked on the side.
+    """
+
+    def __init__(self, compression: int = 50) -> None:
+        """
+        :param compression:     Bounds the number of centroids, higher is more accurate and bigger
+        """
+        self.compression: int = compression
+        self.count: float = 0.0
+        self.mean: float = 0.0
+        self.m2: float = 0.0
+        self.minimum: float = math.inf
+        self.maximum: float = -math.inf
+        # Sorted [mean, weight] pairs
+        self._centroids: List[List[float]] = list()
+        self._buffer: List[List[float]] = list()
+
+    def __str__(self):
+        return f'T-digest of {self.count} values in {len(self.centroids)} centroids'
+
+    def __repr__(self):
+        return f'TDigest(compression={self.compression}, count={self.count}, mean={self.mean})'
+
+    def __len__(self):
+        return int(self.count)
+
+    @property
+    def centroids(self) -> List[List[float]]:
+        """Sorted [mean, weight] pairs, with everything added so far merged in"""
+        if self._buffer:
+            self.__compress()
+        return self._centroids
+
+    @property
+    def variance(self) -> float:
+        """Population variance of the values"""
+        return self.m2 / self.count if self.count else 0.0
+
+    @property
+    def std(self) -> float:
+        """Population standard deviation of the values"""
+        return math.sqrt(self.variance)
+
+    def add(self, value: float, weight: float = 1.0) -> None:
+        """Adds a value to the summary"""
+        self.count += weight
+        delta = value - self.mean
+        self.mean += delta * weight / self.count
+        self.m2 += delta * (value - self.mean) * weight
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        self._buffer.append([value, weight])
+        if len(self._buffer) >= self.compression * 5:
+            self.__compress()
+
+    def cdf(self, value: float) -> float:
+        """Estimated fraction of the values that are lower than or equal to the value, nan if there are none"""
+        if not self.count:
+            return math.nan
+        if value < self.minimum:
+            return 0.0
+        if value >= self.maximum:
+            return 1.0
+        centroids = self.centroids
+        cumulative = 0.0
+        for index, (mean, weight) in enumerate(centroids):
+            if value < mean:
+                if index == 0:
+                    # Left half of the first centroid spreads from the minimum
+                    return (value - self.minimum) / (mean - self.minimum) * weight / 2 / self.count
+                previous_mean, previous_weight = centroids[index - 1]
+                left = cumulative - previous_weight / 2
+                right = cumulative + weight / 2
+                return (left + (value - previous_mean) / (mean - previous_mean) * (right - left)) / self.count
+            cumulative += weight
+        last_mean, last_weight = centroids[-1]
+        left = self.count - last_weight / 2
+        return (left + (value - last_mean) / (self.maximum - last_mean) * last_weight / 2) / self.count
+
+    def quantile(self, q: float) -> float:
+        """Estimated value below which the q fraction of the values lies, nan if there are none"""
+        if not self.count:
+            return math.nan
+        centroids = self.centroids
+        target = q * self.count
+        cumulative = 0.0
+        previous_mean, previous_center = self.minimum, 0.0
+        for mean, weight in centroids:
+            center = cumulative + weight / 2
+            if target < center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (target - previous_center) / (center - previous_center) * (mean - previous_mean)
+            previous_mean, previous_center = mean, center
+            cumulative += weight
+        if self.count == previous_center:
+            return self.maximum
+        return previous_mean + (target - previous_center) / (self.count - previous_center) * \
+            (self.maximum - previous_mean)
+
+    @property
+    def json_dict(self) -> Dict[str, Any]:
+        """Everything needed to restore the sketch, for storing in the database"""
+        return dict(compression=self.compression, count=self.count, mean=self.mean, m2=self.m2,
+                    minimum=self.minimum if self.count else None, maximum=self.maximum if self.count else None,
+                    centroids=self.centroids)
+
+    @classmethod
+    def from_json_dict(cls, data: Optional[Dict[str, Any]]) -> 'TDigest':
+        """Restores the sketch stored with json_dict, an empty one for None"""
+        if not data:
+            return cls()
+        digest = cls(data['compression'])
+        digest.count = data['count']
+        digest.mean = data['mean']
+        digest.m2 = data['m2']
+        if digest.count:
+            digest.minimum = data['minimum']
+            digest.maximum = data['maximum']
+        digest._centroids = [list(centroid) for centroid in data['centroids']]
+        return digest
+
+    def __compress(self) -> None:
+        """Merges the buffer into the centroids, keeping each centroid within the size its quantile allows"""
+        points = sorted(self._centroids + self._buffer)
+        self._buffer = list()
+        merged: List[List[float]] = list()
+        cumulative = 0.0
+        current = list(points[0])
+        for mean, weight in points[1:]:
+            proposed = current[1] + weight
+            q = (cumulative + proposed / 2) / self.count
+            if proposed <= 4 * self.count * q * (1 - q) / self.compression:
+                current[0] += (mean - current[0]) * weight / proposed
+                current[1] = proposed
+            else:
+                merged.append(current)
+                cumulative += current[1]
+                current = [mean, weight]
+        merged.append(current)
+        self._centroids = merged
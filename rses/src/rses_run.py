@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 # coding=utf-8
 """Run - mainly for development"""
+import os
 
-from flask_app.app import app
+from flask_app.app import create_app
 
+app = create_app()
+# The reloader runs the app in a child process, the scheduler belongs there and not into the watching parent
+if app.config['RSES_SCHEDULER'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+    from rses_jobs import scheduler
+    scheduler.start()
 port = app.config['PORT']
 app.run(host='0.0.0.0', port=port, debug=True)
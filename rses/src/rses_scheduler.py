@@ -0,0 +1,406 @@
+# coding=utf-8
+"""
+Background jobs, run on interval or cron-like schedules off the request path
+
+The scheduler runs in a thread of every web worker when RSES_SCHEDULER is on, or on its own in a separate process
+(`rses_cli.py scheduler`). Any number of them can run against one database. Each slot of a job (the time it is due)
+runs once: the node running it holds a Postgres advisory lock of the job, and the last slot that ran is recorded in
+the scheduled_job table, so the nodes that were due at the same time skip it. Jobs run on a thread pool and use
+`rses_connections.db` like everything else. The lock is held on a pooled connection while the job runs, so the pool
+needs one more connection than the busiest job uses.
+"""
+import concurrent.futures
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+import zlib
+from typing import Any, Callable, Dict, Optional, Set, Tuple, Union
+
+from rses_config import RSES_SCHEDULER_WORKERS, RSES_JOB_SCHEDULES
+from rses_connections import db
+
+log = logging.getLogger(__name__)
+
+# First key of the advisory locks of jobs, the second is made from the name of the job
+_LOCK_SPACE: int = 7_372_657
+_EVERY = re.compile(r'^(?:@every\s+)?(\d+(?:\.\d+)?)\s*([smhd]?)$')
+_UNITS = dict(s=1, m=60, h=3600, d=86400)
+# Names of the fields of a cron expression with their ranges
+_CRON_FIELDS: Tuple[Tuple[str, int, int], ...] = (
+    ('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7)
+)
+_CRON_ALIASES = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@weekly': '0 0 * * 0', '@monthly': '0 0 1 * *'}
+
+
+class Every:
+    """Interval schedule, aligned to the epoch so all nodes agree on the slots"""
+
+    def __init__(self, seconds: float) -> None:
+        """
+        :param seconds:     Time between runs
+        """
+        if seconds <= 0:
+            raise ValueError(f'Interval has to be positive, not {seconds}')
+        self.seconds: float = seconds
+
+    def __str__(self):
+        return f'Every {self.seconds}s'
+
+    def __repr__(self):
+        return f'Every(seconds={self.seconds})'
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        """The first slot after the moment"""
+        slots = moment.timestamp() // self.seconds + 1
+        return datetime.datetime.fromtimestamp(slots * self.seconds)
+
+
+class Cron:
+    """
+    Cron-like schedule in local time: minute, hour, day of month, month and day of week (0 or 7 is Sunday)
+
+    Fields take *, numbers, ranges (1-5), steps (*/15, 8-18/2) and lists of them (0,30). Like cron, a day matches
+    either of the day of month and the day of week when both are restricted.
+    """
+
+    def __init__(self, expression: str) -> None:
+        """
+        :param expression:  Five fields separated by whitespace, or @hourly, @daily, @weekly, @monthly
+        :raises ValueError: When the expression can't be parsed
+        """
+        self.expression: str = expression
+        fields = _CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(_CRON_FIELDS):
+            raise ValueError(f"Cron expression '{expression}' does not have {len(_CRON_FIELDS)} fields")
+        parsed = [_cron_field(field, *limits) for field, (_, *limits) in zip(fields, _CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        # Sunday is both 0 and 7, Python has Monday as 0
+        self.weekdays: Set[int] = {(weekday - 1) % 7 for weekday in weekdays}
+        self._any_day: bool = fields[2] == '*'
+        self._any_weekday: bool = fields[4] == '*'
+
+    def __str__(self):
+        return f"Cron '{self.expression}'"
+
+    def __repr__(self):
+        return f"Cron(expression='{self.expression}')"
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        """
+        The first slot after the moment
+
+        :raises ValueError: When there is none within years, like on the 31st of February
+        """
+        candidate = moment.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = candidate + datetime.timedelta(days=366 * 5)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                month = candidate.month % 12 + 1
+                candidate = candidate.replace(year=candidate.year + (month == 1), month=month, day=1, hour=0, minute=0)
+            elif not self.__day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + datetime.timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += datetime.timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f'{self} never comes')
+
+    def __day_matches(self, moment: datetime.datetime) -> bool:
+        day, weekday = moment.day in self.days, moment.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+def _cron_field(field: str, low: int, high: int) -> Set[int]:
+    """Values a field of a cron expression matches"""
+    values: Set[int] = set()
+    for part in field.split(','):
+        spread, _, step = part.partition('/')
+        if spread == '*':
+            start, end = low, high
+        else:
+            start, _, end = spread.partition('-')
+            start = int(start)
+            end = int(end) if end else (high if step else start)
+        if not low <= start <= end <= high:
+            raise ValueError(f"Cron field '{field}' is out of {low}-{high}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+def parse_schedule(spec: str) -> Union[Every, Cron]:
+    """
+    Schedule from its text, as in RSES_JOB_SCHEDULES
+
+    :param spec:    Cron expression, or an interval like 300, 90s, 15m, 6h, 1d or @every 15m
+    """
+    every = _EVERY.match(spec.strip())
+    if every is not None:
+        return Every(float(every.group(1)) * _UNITS[every.group(2) or 's'])
+    return Cron(spec)
+
+
+class JobStats:
+    """Runtimes and failures of a job in this process"""
+
+    def __init__(self) -> None:
+        self.runs: int = 0
+        self.failures: int = 0
+        self.skipped: int = 0
+        self.running: bool = False
+        self.total_seconds: float = 0.0
+        self.last_started: Optional[datetime.datetime] = None
+        self.last_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.next_run: Optional[datetime.datetime] = None
+
+    def __str__(self):
+        return f'{self.runs} runs, {self.failures} failed'
+
+    def __repr__(self):
+        return f'JobStats(runs={self.runs}, failures={self.failures}, skipped={self.skipped}, ' \
+               f'running={self.running})'
+
+    @property
+    def json_dict(self) -> Dict[str, Any]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(runs=self.runs, failures=self.failures, skipped=self.skipped, running=self.running,
+                    total_seconds=round(self.total_seconds, 3),
+                    last_started=None if self.last_started is None else self.last_started.isoformat(),
+                    last_seconds=None if self.last_seconds is None else round(self.last_seconds, 3),
+                    last_error=self.last_error,
+                    next_run=None if self.next_run is None else self.next_run.isoformat())
+
+
+class Job:
+    """Function run on a schedule"""
+
+    def __init__(self, name: str, schedule: Union[Every, Cron], function: Callable[[], Any],
+                 exclusive: bool = True) -> None:
+        """
+        :param name:        Unique name, jobs are locked and recorded by it
+        :param schedule:    When it runs
+        :param function:    What it runs, without arguments
+        :param exclusive:   Run by one node per slot, otherwise by every process, e.g. to warm its caches
+        """
+        self.name: str = name
+        self.schedule: Union[Every, Cron] = schedule
+        self.function: Callable[[], Any] = function
+        self.exclusive: bool = exclusive
+        self.stats: JobStats = JobStats()
+
+    def __str__(self):
+        return f'Job {self.name} ({self.schedule})'
+
+    def __repr__(self):
+        return f'Job(name={self.name}, schedule={self.schedule!r}, exclusive={self.exclusive})'
+
+    @property
+    def lock_key(self) -> int:
+        """Second key of the advisory lock of the job"""
+        return zlib.crc32(self.name.encode()) - 2 ** 31
+
+
+class Scheduler:
+    """Runs the registered jobs when they are due, in a background thread handing them to a thread pool"""
+
+    QUERY_LAST_SLOT = """
+    SELECT last_slot
+    FROM scheduled_job
+    WHERE name = %s
+    """
+    QUERY_RECORD = """
+    INSERT INTO scheduled_job (name, last_slot, last_started, last_seconds, last_error, runs, failures)
+    VALUES (%(name)s, %(slot)s, %(started)s, %(seconds)s, %(error)s, 1, %(failed)s::INT)
+    ON CONFLICT (name) DO UPDATE SET
+      last_slot = EXCLUDED.last_slot,
+      last_started = EXCLUDED.last_started,
+      last_seconds = EXCLUDED.last_seconds,
+      last_error = EXCLUDED.last_error,
+      runs = scheduled_job.runs + 1,
+      failures = scheduled_job.failures + EXCLUDED.failures
+    """
+
+    def __init__(self, adapter: Any = db, workers: int = RSES_SCHEDULER_WORKERS,
+                 schedules: Optional[Dict[str, str]] = None) -> None:
+        """
+        :param adapter:     Database the jobs are locked and recorded in, without `pooled` (SQLite) they are not
+        :param workers:     Jobs running at once
+        :param schedules:   Schedules replacing the ones jobs are registered with, by name, empty turns a job off,
+                            RSES_JOB_SCHEDULES by default
+        """
+        self.adapter: Any = adapter
+        self.workers: int = workers
+        self.schedules: Dict[str, str] = RSES_JOB_SCHEDULES if schedules is None else schedules
+        self.jobs: Dict[str, Job] = dict()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+
+    def __str__(self):
+        return f'Scheduler of {len(self.jobs)} jobs'
+
+    def __repr__(self):
+        return f'Scheduler(jobs={list(self.jobs)}, workers={self.workers}, running={self.running})'
+
+    @property
+    def running(self) -> bool:
+        """Whether the scheduler thread of this process is running"""
+        return self._thread is not None and self._thread.is_alive() and self._pid == os.getpid()
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Metrics of all jobs in this process, by name"""
+        return {name: job.stats.json_dict for name, job in self.jobs.items()}
+
+    def add(self, name: str, schedule: Union[Every, Cron, str], function: Callable[[], Any],
+            exclusive: bool = True) -> Optional[Job]:
+        """
+        Registers a job, see `Job`, its schedule in `schedules` wins
+
+        :return:    The job, None when it is turned off
+        """
+        spec = self.schedules.get(name, schedule)
+        if not spec or spec == 'off':
+            log.debug('Job %s is turned off', name)
+            return None
+        job = Job(name, parse_schedule(spec) if isinstance(spec, str) else spec, function, exclusive)
+        with self._lock:
+            if name in self.jobs:
+                raise ValueError(f'Job {name} is registered already')
+            self.jobs[name] = job
+        self._wake.set()
+        return job
+
+    def job(self, name: str, schedule: Union[Every, Cron, str],
+            exclusive: bool = True) -> Callable[[Callable[[], Any]], Callable[[], Any]]:
+        """Decorator registering the function as a job, see `add`"""
+        def register(function: Callable[[], Any]) -> Callable[[], Any]:
+            self.add(name, schedule, function, exclusive)
+            return function
+        return register
+
+    def start(self) -> None:
+        """Starts the scheduler thread, has to be called in every process (after forking)"""
+        if self.running:
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='rses-job')
+        self._thread = threading.Thread(target=self.__loop, name='rses-scheduler', daemon=True)
+        self._thread.start()
+        log.debug('Started scheduler of %s', ', '.join(map(str, self.jobs.values())))
+
+    def stop(self, wait: bool = True) -> None:
+        """Stops scheduling, waits for the running jobs to finish unless told not to"""
+        self._stop.set()
+        self._wake.set()
+        if self.running:
+            self._thread.join()
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait)
+        self._thread = None
+        self._executor = None
+
+    def run(self, name: str, slot: Optional[datetime.datetime] = None) -> bool:
+        """
+        Runs the job now in this thread, unless another node runs it or ran the slot already
+
+        :param name:    Name of the job
+        :param slot:    Time the run is due, now by default
+        :return:        Whether it ran
+        """
+        job = self.jobs[name]
+        slot = slot or datetime.datetime.now()
+        with self._lock:
+            if job.stats.running:
+                job.stats.skipped += 1
+                log.warning('%s is still running, skipping its run due at %s', job, slot)
+                return False
+            job.stats.running = True
+        try:
+            if job.exclusive and hasattr(self.adapter, 'pooled'):
+                return self.__run_locked(job, slot)
+            self.__execute(job)
+            return True
+        finally:
+            job.stats.running = False
+
+    def __loop(self) -> None:
+        due: Dict[str, datetime.datetime] = dict()
+        while not self._stop.is_set():
+            now = datetime.datetime.now()
+            with self._lock:
+                jobs = list(self.jobs.values())
+            for job in jobs:
+                if job.name not in due:
+                    due[job.name] = job.stats.next_run = job.schedule.next_after(now)
+                elif due[job.name] <= now:
+                    self._executor.submit(self.__submitted, job.name, due[job.name])
+                    due[job.name] = job.stats.next_run = job.schedule.next_after(now)
+            wait = min((slot - now).total_seconds() for slot in due.values()) if due else None
+            self._wake.wait(None if wait is None else max(wait, 0))
+            self._wake.clear()
+
+    def __submitted(self, name: str, slot: datetime.datetime) -> None:
+        try:
+            self.run(name, slot)
+        except Exception:
+            log.exception('Could not run job %s due at %s', name, slot)
+
+    def __run_locked(self, job: Job, slot: datetime.datetime) -> bool:
+        with self.adapter.pooled() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_lock(%s, %s) AS locked', (_LOCK_SPACE, job.lock_key))
+                if not cur.fetchone().locked:
+                    job.stats.skipped += 1
+                    log.debug('%s is run by another node', job)
+                    return False
+                try:
+                    cur.execute(self.QUERY_LAST_SLOT, (job.name,))
+                    last = cur.fetchone()
+                    if last is not None and last.last_slot >= slot:
+                        job.stats.skipped += 1
+                        log.debug('%s due at %s was run by another node', job, slot)
+                        return False
+                    started = datetime.datetime.now()
+                    error = self.__execute(job)
+                    cur.execute(self.QUERY_RECORD, dict(name=job.name, slot=slot, started=started,
+                                                        seconds=job.stats.last_seconds, error=error,
+                                                        failed=error is not None))
+                finally:
+                    cur.execute('SELECT pg_advisory_unlock(%s, %s)', (_LOCK_SPACE, job.lock_key))
+        return True
+
+    @staticmethod
+    def __execute(job: Job) -> Optional[str]:
+        """Runs the function of the job and measures it, returns the error it failed with"""
+        job.stats.last_started = datetime.datetime.now()
+        start = time.perf_counter()
+        error = None
+        try:
+            job.function()
+        except Exception as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            job.stats.failures += 1
+            log.exception('%s failed', job)
+        seconds = time.perf_counter() - start
+        job.stats.runs += 1
+        job.stats.total_seconds += seconds
+        job.stats.last_seconds = seconds
+        job.stats.last_error = error
+        log.info('%s took %.3fs%s', job, seconds, '' if error is None else f', failed with {error}')
+        return error
+
+
+scheduler: Scheduler = Scheduler()
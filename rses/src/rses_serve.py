@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+Production server, gunicorn with the worker model and timeouts of `rses_config`
+
+`python rses/src/rses_serve.py` serves on PORT. The app is loaded once before forking the workers (RSES_PRELOAD),
+every worker then starts with an empty connection pool, its own invalidation listener and scheduler of jobs (with
+RSES_SCHEDULER). Send HUP to the master to replace the workers gracefully, each finishes its requests within
+RSES_GRACEFUL_TIMEOUT - with preloading the new workers run the code loaded at start, send USR2 to start a new
+master for new code.
+"""
+import logging
+import multiprocessing
+import sys
+from typing import Any, Dict, Optional
+
+from rses_config import PORT, RSES_WORKERS, RSES_WORKER_CLASS, RSES_THREADS, RSES_TIMEOUT, RSES_GRACEFUL_TIMEOUT
+from rses_config import RSES_KEEPALIVE, RSES_PRELOAD, RSES_SCHEDULER
+
+log = logging.getLogger(__name__)
+
+WORKER_CLASSES = ('gthread', 'sync', 'gevent')
+
+
+def default_workers() -> int:
+    """Twice the CPU count plus one, so a worker waiting for the database does not leave a CPU idle"""
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def post_fork(server, worker) -> None:
+    """Runs in every new worker, nothing opened by the master before forking can be used here"""
+    if worker.__class__.__name__.lower().startswith('gevent'):
+        # Queries would block the whole worker otherwise
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    from rses_connections import db
+    from rses_invalidation import bus
+    if db.pool is not None:
+        db.pool.reset()
+    bus.start()
+    if RSES_SCHEDULER:
+        from rses_jobs import scheduler
+        scheduler.start()
+
+
+def options(bind: Optional[str] = None, workers: int = RSES_WORKERS, worker_class: str = RSES_WORKER_CLASS,
+            threads: int = RSES_THREADS) -> Dict[str, Any]:
+    """
+    Gunicorn settings
+
+    :param bind:            Address to listen on, all interfaces on PORT by default
+    :param workers:         Worker processes, 0 for `default_workers`
+    :param worker_class:    One of WORKER_CLASSES
+    :param threads:         Threads of a gthread worker, concurrent requests of a gevent worker
+    """
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError(f'Unknown worker class {worker_class}, pick from {", ".join(WORKER_CLASSES)}')
+    settings = dict(
+        bind=bind or f'0.0.0.0:{PORT}',
+        workers=workers or default_workers(),
+        worker_class=worker_class,
+        timeout=RSES_TIMEOUT,
+        graceful_timeout=RSES_GRACEFUL_TIMEOUT,
+        keepalive=RSES_KEEPALIVE,
+        preload_app=RSES_PRELOAD,
+        post_fork=post_fork,
+    )
+    if worker_class == 'gthread':
+        settings['threads'] = threads
+    elif worker_class == 'gevent':
+        settings['worker_connections'] = threads
+    return settings
+
+
+def serve(**kwargs) -> None:
+    """Runs the app under gunicorn until it is stopped, takes the arguments of `options`"""
+    from gunicorn.app.base import BaseApplication
+
+    settings = options(**kwargs)
+
+    class Application(BaseApplication):
+        def load_config(self) -> None:
+            for name, value in settings.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            from flask_app.app import create_app
+            return create_app()
+
+    log.info('Serving with %s %s workers', settings['workers'], settings['worker_class'])
+    Application().run()
+
+
+if __name__ == '__main__':
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        sys.exit('Serving needs gunicorn, `pip install gunicorn` (and gevent psycogreen for gevent workers)')
+    logging.basicConfig(level=logging.INFO)
+    serve()
@@ -0,0 +1,294 @@
+# coding=utf-8
+"""
+SQLite storage backend, for tests and single-household deployments with no database server
+
+`SQLiteAdapter` has the contract of `rses_connections.DatabaseAdapter` - select, select_all, insert, update,
+delete and run_transaction with the same queries - and translates the Postgres dialect the object layer is
+written in on the fly (placeholders, casts, = ANY of a list, unnest of arrays, row locks). Ingredients, stock,
+recipes, cooking and the shopping list work on it; full text search, forecasting, the archive and bulk imports
+need Postgres features with no SQLite counterpart. Use it with RSES_DB_URL=sqlite:// (in memory) or
+sqlite:///path/to/kitchen.db.
+"""
+import datetime
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar, Union
+from urllib.parse import urlparse
+
+from rses_cache import QueryCache, tables_written
+from rses_config import RSES_QUERY_CACHE_BYTES
+from rses_connections import queries
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+SCHEMA: str = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'database', 'create_sqlite.sql')
+
+_PARAMETERS = re.compile(r"""
+    (?P<unnest>(?P<select>SELECT\s+\*\s+FROM\s+)?unnest\((?P<arrays>(?:\s*%s(?:::\w+\[\])?\s*,?)+)\)
+        (?:\s+AS\s+(?P<alias>\w+)\s*\((?P<columns>[^)]*)\))?)
+  | (?P<any>=\s*ANY\(\s*%s(?:::\w+\[\])?\s*\))
+  | %\((?P<name>\w+)\)s
+  | (?P<positional>%s)
+  | (?P<percent>%%)
+""", re.VERBOSE | re.IGNORECASE)
+_NOW: str = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')"
+# Rewrites of the dialect, applied in order after the parameters
+_REWRITES: Tuple[Tuple[Any, str], ...] = tuple((re.compile(pattern, re.IGNORECASE | re.MULTILINE), replacement)
+                                                for pattern, replacement in (
+    (r'extract\(\s*EPOCH\s+FROM\s+([\w.()]+)\s*-\s*([\w.()]+)\s*\)', r'((julianday(\1) - julianday(\2)) * 86400)'),
+    (r'\b(?:NOW|clock_timestamp)\(\)', _NOW),
+    (r'::\w+(?:\[\])?', ''),
+    (r'\bILIKE\b', 'LIKE'),
+    (r'\bGREATEST\(', 'max('),
+    (r'\bLEAST\(', 'min('),
+    (r'\bIS\s+DISTINCT\s+FROM\b', 'IS NOT'),
+    (r'\bFOR\s+(?:UPDATE|SHARE)(?:\s+OF\s+\w+)?(?:\s+(?:NOWAIT|SKIP\s+LOCKED))?', ''),
+    # Transactions hold the only connection, nothing to lock against
+    (r'^\s*LOCK\s+TABLE\b.*$', ''),
+))
+
+
+def translate(query: str, args: Union[Sequence[Any], Dict[str, Any]]) -> Tuple[str, List[Any]]:
+    """
+    Translates a query for Postgres and its arguments into a query for SQLite and its parameters
+
+    :param query:   Query with psycopg2 placeholders, %s or %(name)s
+    :param args:    Arguments of the query, a dictionary for named placeholders
+    :return:        Query with ? placeholders and the parameters in their order
+    """
+    positional = iter(()) if isinstance(args, dict) else iter(args)
+    parameters: List[Any] = list()
+
+    def argument(name: Optional[str] = None) -> Any:
+        return args[name] if name is not None else next(positional)
+
+    def replace(match: Any) -> str:
+        if match.group('percent'):
+            return '%'
+        if match.group('name'):
+            parameters.append(_adapt(argument(match.group('name'))))
+            return '?'
+        if match.group('positional'):
+            parameters.append(_adapt(argument()))
+            return '?'
+        if match.group('any'):
+            values = [_adapt(value) for value in argument()]
+            parameters.extend(values)
+            return f"IN ({', '.join('?' * len(values))})"
+        arrays = [list(argument()) for _ in range(match.group('arrays').count('%s'))]
+        columns = [column.strip() for column in (match.group('columns') or '').split(',') if column.strip()] or \
+                  [f'column{index}' for index in range(1, len(arrays) + 1)]
+        alias = f" AS {match.group('alias')}" if match.group('alias') else ''
+        rows = list(zip(*arrays))
+        if not rows:
+            table = f"(SELECT {', '.join(f'NULL AS {column}' for column in columns)} WHERE 0){alias}"
+        else:
+            for row in rows:
+                parameters.extend(_adapt(value) for value in row)
+            values = ', '.join(f"({', '.join('?' * len(arrays))})" for _ in rows)
+            named = ', '.join(f'column{index} AS {column}' for index, column in enumerate(columns, 1))
+            table = f'(SELECT {named} FROM (VALUES {values})){alias}'
+        select = match.group('select') or ''
+        if select and not alias:
+            # INSERT ... SELECT needs a WHERE before ON CONFLICT, SQLite would take the ON for a join otherwise
+            return f'{select}{table} WHERE true'
+        return select + table
+
+    translated = _PARAMETERS.sub(replace, query)
+    for pattern, replacement in _REWRITES:
+        translated = pattern.sub(replacement, translated)
+    return translated, parameters
+
+
+def _adapt(value: Any) -> Any:
+    """Values SQLite can't store as they are, the way Postgres would return them as text"""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def _timestamp(value: bytes) -> datetime.datetime:
+    """Parses timestamps as stored by `_adapt` or the defaults of the schema, with any precision of seconds"""
+    text = value.decode()
+    whole, _, fraction = text.partition('.')
+    parsed = datetime.datetime.strptime(whole, '%Y-%m-%d %H:%M:%S' if ' ' in whole else '%Y-%m-%d')
+    return parsed.replace(microsecond=int(fraction[:6].ljust(6, '0'))) if fraction else parsed
+
+
+sqlite3.register_converter('TIMESTAMP', _timestamp)
+sqlite3.register_converter('DATE', lambda value: datetime.datetime.strptime(value.decode()[:10], '%Y-%m-%d').date())
+sqlite3.register_converter('JSON', lambda value: json.loads(value.decode()))
+
+
+class SQLiteCursor:
+    """Cursor translating the queries, returns rows as named tuples like the cursors of psycopg2"""
+
+    def __init__(self, cursor: sqlite3.Cursor) -> None:
+        self._cursor: sqlite3.Cursor = cursor
+        self.query: bytes = b''
+        # Tables written, for invalidating the cache after commit
+        self.written: Set[str] = set()
+
+    def __str__(self):
+        return 'SQLite cursor'
+
+    def __repr__(self):
+        return f'SQLiteCursor(written={self.written})'
+
+    def __iter__(self) -> Iterator[Any]:
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    def execute(self, query: str, vars: Union[Sequence[Any], Dict[str, Any], None] = None) -> None:
+        translated, parameters = translate(query, vars or ())
+        queries.count += 1
+        self.query = translated.encode()
+        self._cursor.execute(translated, parameters)
+        self.written.update(tables_written(translated))
+
+    def fetchone(self) -> Optional[Any]:
+        row = self._cursor.fetchone()
+        return None if row is None else self.__row_type()(*row)
+
+    def fetchall(self) -> List[Any]:
+        row_type = self.__row_type()
+        return [row_type(*row) for row in self._cursor.fetchall()]
+
+    def __row_type(self) -> type:
+        return _row_type(tuple(column[0] for column in self._cursor.description))
+
+
+_ROW_TYPES: Dict[Tuple[str, ...], type] = dict()
+
+
+def _row_type(columns: Tuple[str, ...]) -> type:
+    """Named tuple of the columns, made once for every shape of rows"""
+    if columns not in _ROW_TYPES:
+        _ROW_TYPES[columns] = namedtuple('Record', columns, rename=True)
+    return _ROW_TYPES[columns]
+
+
+class SQLiteAdapter:
+    """
+    Adapter with the contract of `rses_connections.DatabaseAdapter`, over a single SQLite connection.
+
+    All queries go through the one connection one at a time (SQLite writes one at a time anyway), so an in-memory
+    database is shared by all threads. A new database gets the schema of database/create_sqlite.sql.
+    """
+
+    def __init__(self, url: str = 'sqlite://', cache_bytes: int = RSES_QUERY_CACHE_BYTES, schema: str = SCHEMA,
+                 **ignored: Any) -> None:
+        """
+        :param url:         sqlite:// for a database in memory, sqlite:///path/to/file.db for a file
+        :param cache_bytes: Memory budget of the query result cache, 0 for no caching
+        :param schema:      Script creating the tables when the database has none
+        :param ignored:     Options of `DatabaseAdapter` that mean nothing here, like the pool size
+        """
+        self.path: str = urlparse(url).path[1:] or ':memory:'
+        self.cache: Optional[QueryCache] = QueryCache(cache_bytes) if cache_bytes else None
+        # Nothing to pool, there is just the one connection
+        self.pool = None
+        self._lock = threading.RLock()
+        self._conn: sqlite3.Connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                                                         detect_types=sqlite3.PARSE_DECLTYPES)
+        self._conn.execute('PRAGMA foreign_keys = ON')
+        for name, arguments, function in (('exp', 1, math.exp), ('ln', 1, math.log), ('sqrt', 1, math.sqrt),
+                                          ('power', 2, math.pow)):
+            self._conn.create_function(name, arguments, function)
+        if not self._conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table'").fetchone():
+            with open(schema) as script:
+                self._conn.executescript(script.read())
+            log.debug('Created the schema in %s', self.path)
+
+    def __str__(self):
+        return f'SQLite adapter of {self.path}'
+
+    def __repr__(self):
+        return f'SQLiteAdapter(path={self.path})'
+
+    def select(self, query: str, *args, cache: bool = False) -> Any:
+        """Wrapped execute around select statement for single result, see `DatabaseAdapter.select`"""
+        if cache and self.cache is not None:
+            return self.cache.get_or_load(query, args, lambda: self.__run(query, args, SQLiteCursor.fetchone))
+        return self.__run(query, args, SQLiteCursor.fetchone)
+
+    def select_all(self, query: str, *args, cache: bool = False) -> List[Any]:
+        """Wrapped execute around select statement for multiple results, see `DatabaseAdapter.select_all`"""
+        if cache and self.cache is not None:
+            return self.cache.get_or_load(query, args, lambda: self.__run(query, args, SQLiteCursor.fetchall))
+        return self.__run(query, args, SQLiteCursor.fetchall)
+
+    def delete(self, query: str, *args) -> int:
+        """Wrapped execute around delete statement"""
+        return self.__write(query, args, lambda cur: cur.rowcount)
+
+    def insert(self, query: str, *args) -> Optional[Any]:
+        """Wrapped execute around insert statement, returns the first returned row, if any"""
+        return self.__write(query, args, lambda cur: cur.fetchone() if cur.description is not None else None)
+
+    def update(self, query: str, *args) -> int:
+        """Wrapped execute around update statement"""
+        return self.__write(query, args, lambda cur: cur.rowcount)
+
+    def run_transaction(self, work: Callable[[SQLiteCursor], T], retries: int = 0, backoff: float = 0.0) -> T:
+        """
+        Runs the work in a single transaction, committed if the work returns and rolled back if it raises
+
+        Transactions run one at a time, so they never conflict and there is nothing to retry.
+        """
+        with self._lock:
+            cur = SQLiteCursor(self._conn.cursor())
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(cur)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        if self.cache is not None and cur.written:
+            self.cache.invalidate(cur.written)
+        return result
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __run(self, query: str, args: tuple, fetch: Callable[[SQLiteCursor], T]) -> T:
+        with self._lock:
+            cur = SQLiteCursor(self._conn.cursor())
+            cur.execute(query, args[0] if len(args) == 1 and isinstance(args[0], dict) else args)
+            result = fetch(cur)
+        log.debug("Ran query\n'%s'\nResult: %s", cur.query.decode(), result)
+        return result
+
+    def __write(self, query: str, args: tuple, result: Callable[[SQLiteCursor], T]) -> T:
+        with self._lock:
+            cur = SQLiteCursor(self._conn.cursor())
+            cur.execute(query, args)
+            returned = result(cur)
+            # Rows of RETURNING are produced as they are fetched, the statement is done after the rest is read
+            cur._cursor.fetchall()
+        if self.cache is not None:
+            self.cache.invalidate_query(cur.query.decode())
+        return returned
@@ -0,0 +1,285 @@
+# coding=utf-8
+"""
+Server-side prepared statements, kept per connection
+
+psycopg2 interpolates the arguments into the query on the client, so Postgres parses and plans every execution
+again. A query run a second time on a connection is prepared there instead (PREPARE with $n parameters) and from
+then on run by EXECUTE with just the arguments. The parameters are declared with the types psycopg2 would give the
+literals of the arguments, lists as arrays of the type of their items (psycopg2 sends them as ARRAY[...]). Where that
+still isn't what the interpolated query meant, the first EXECUTE fails - it runs under a savepoint, and the query is
+then run as it is, from then on.
+"""
+import datetime
+import decimal
+import logging
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+log = logging.getLogger(__name__)
+
+_PLACEHOLDERS = re.compile(r'%\((\w+)\)s|%s|%%')
+_PREPARABLE = re.compile(r'^\s*(?:SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+# Seen once, not prepared yet
+_SEEN: str = ''
+# Failed to prepare, always run as it is
+_NEVER: str = '-'
+# Types of numbers from the narrowest, items of an array get the widest of them
+_NUMBERS: Tuple[str, ...] = ('integer', 'bigint', 'numeric')
+
+
+class StatementStats:
+    """Counters of all the statement caches of the process, approximate under concurrency"""
+
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+        self.prepared: int = 0
+        self.evicted: int = 0
+        self.skipped: int = 0
+        self.failed: int = 0
+
+    def __str__(self):
+        return f'Prepared statements {self.hit_rate:.1%} hits'
+
+    def __repr__(self):
+        return f'StatementStats(hits={self.hits}, misses={self.misses}, prepared={self.prepared}, ' \
+               f'evicted={self.evicted}, skipped={self.skipped}, failed={self.failed})'
+
+    @property
+    def hit_rate(self) -> float:
+        """Share of the executions of preparable queries that ran a statement prepared before"""
+        executions = self.hits + self.misses + self.prepared
+        return self.hits / executions if executions else 0.0
+
+    @property
+    def json_dict(self) -> Dict[str, Union[int, float]]:
+        """Returns dictionary that can be jsonified and served by the api"""
+        return dict(hits=self.hits, misses=self.misses, prepared=self.prepared, evicted=self.evicted,
+                    skipped=self.skipped, failed=self.failed, hit_rate=round(self.hit_rate, 4))
+
+
+statement_stats: StatementStats = StatementStats()
+
+
+class StatementCache:
+    """
+    Statements prepared on one connection, the least recently used are deallocated beyond the size.
+
+    A connection is used by one thread at a time, the cache belongs to it and needs no locking.
+    """
+
+    def __init__(self, size: int) -> None:
+        """
+        :param size:    Most queries remembered, prepared or seen once
+        """
+        self.size: int = size
+        self._statements: 'OrderedDict[Tuple[str, Tuple[str, ...]], str]' = OrderedDict()
+        self._next: int = 0
+
+    def __str__(self):
+        return f'Statement cache {len(self._statements)}/{self.size}'
+
+    def __repr__(self):
+        return f'StatementCache(size={self.size}, statements={len(self._statements)})'
+
+    def __len__(self):
+        return len(self._statements)
+
+    def execute(self, cur, query: str, args: Union[Sequence[Any], Dict[str, Any], None]) -> bool:
+        """
+        Runs the query as a prepared statement, preparing it when it is seen the second time
+
+        :param cur:     Raw cursor of the connection the cache belongs to
+        :param query:   Query with psycopg2 placeholders
+        :param args:    Its arguments
+        :return:        False when the query was not run, because it can't or shouldn't be prepared yet
+        """
+        parametrized = parametrize(query, args)
+        if parametrized is None:
+            statement_stats.skipped += 1
+            return False
+        text, values, types = parametrized
+        key = (query, types)
+        name = self._statements.get(key)
+        if name is None:
+            statement_stats.misses += 1
+            self._statements[key] = _SEEN
+            self.__evict(cur)
+            return False
+        if name == _NEVER:
+            statement_stats.skipped += 1
+            return False
+        self._statements.move_to_end(key)
+        if name == _SEEN:
+            name = self.__prepare(cur, key, text)
+            if name is None:
+                return False
+            return self.__execute_first(cur, key, name, values)
+        statement_stats.hits += 1
+        cur.execute(_execute(name, values), values)
+        return True
+
+    def clear(self) -> None:
+        """Forgets all statements, for when the connection lost them"""
+        self._statements.clear()
+
+    def __prepare(self, cur, key: Tuple[str, Tuple[str, ...]], text: str) -> Optional[str]:
+        """Prepares the statement, returns its name or None when it can't be prepared"""
+        import psycopg2
+        import psycopg2.extensions
+        name = f'rses_{self._next}'
+        self._next += 1
+        types = f" ({', '.join(key[1])})" if key[1] else ''
+        prepare = f'PREPARE {name}{types} AS {text}'
+        in_transaction = not cur.connection.autocommit
+        try:
+            # A failure must not abort the transaction the query is run in
+            cur.execute(f'SAVEPOINT rses_prepare; {prepare}; RELEASE SAVEPOINT rses_prepare' if in_transaction
+                        else prepare)
+        except psycopg2.extensions.QueryCanceledError:
+            # Out of its deadline, not a statement that can't be prepared
+            raise
+        except psycopg2.Error as e:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT rses_prepare; RELEASE SAVEPOINT rses_prepare')
+            log.debug('Could not prepare %s (%s), running it as it is', ' '.join(key[0].split()), e)
+            statement_stats.failed += 1
+            self._statements[key] = _NEVER
+            return None
+        statement_stats.prepared += 1
+        self._statements[key] = name
+        return name
+
+    def __execute_first(self, cur, key: Tuple[str, Tuple[str, ...]], name: str, values: List[Any]) -> bool:
+        """
+        Runs the statement just prepared, returns False when the parameters turned out not to fit the arguments
+
+        The statement is then deallocated and the query is always run as it is.
+        """
+        import psycopg2
+        import psycopg2.extensions
+        # A failure must not abort the transaction the query is run in, the cursor keeps the result of the EXECUTE
+        guard = None if cur.connection.autocommit else cur.connection.cursor()
+        if guard is not None:
+            guard.execute('SAVEPOINT rses_execute')
+        try:
+            cur.execute(_execute(name, values), values)
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except psycopg2.Error as e:
+            if guard is not None:
+                guard.execute('ROLLBACK TO SAVEPOINT rses_execute; RELEASE SAVEPOINT rses_execute')
+                guard.close()
+            log.debug('Could not execute %s (%s), running it as it is', ' '.join(key[0].split()), e)
+            cur.execute(f'DEALLOCATE {name}')
+            statement_stats.failed += 1
+            self._statements[key] = _NEVER
+            return False
+        if guard is not None:
+            guard.execute('RELEASE SAVEPOINT rses_execute')
+            guard.close()
+        return True
+
+    def __evict(self, cur) -> None:
+        while len(self._statements) > self.size:
+            _, name = self._statements.popitem(last=False)
+            if name not in (_SEEN, _NEVER):
+                cur.execute(f'DEALLOCATE {name}')
+                statement_stats.evicted += 1
+
+
+def parametrize(query: str, args: Union[Sequence[Any], Dict[str, Any], None]) -> \
+        Optional[Tuple[str, List[Any], Tuple[str, ...]]]:
+    """
+    Turns a query with psycopg2 placeholders into a statement to prepare
+
+    :param query:   Query with %s or %(name)s placeholders
+    :param args:    Its arguments, a dictionary for named placeholders
+    :return:        Statement with $n parameters, the values and the types of the parameters in their order,
+                    None when the query is not a single statement or the arguments have an unknown type
+    """
+    if not _PREPARABLE.match(query) or ';' in query:
+        return None
+    named = isinstance(args, dict)
+    positional = iter(()) if named or args is None else iter(args)
+    numbers: Dict[str, int] = dict()
+    values: List[Any] = list()
+
+    def replace(match: Any) -> str:
+        placeholder = match.group(0)
+        if placeholder == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            if named:
+                raise ValueError(placeholder)
+            values.append(next(positional))
+            return f'${len(values)}'
+        if not named:
+            raise ValueError(placeholder)
+        if name not in numbers:
+            values.append(args[name])
+            numbers[name] = len(values)
+        return f'${numbers[name]}'
+
+    try:
+        text = _PLACEHOLDERS.sub(replace, query)
+    except (ValueError, KeyError, StopIteration):
+        # Let psycopg2 tell what is wrong
+        return None
+    if any(True for _ in positional):
+        # More arguments than placeholders
+        return None
+    types = tuple(_parameter_type(value) for value in values)
+    if None in types:
+        return None
+    return text, values, types
+
+
+def _execute(name: str, values: List[Any]) -> str:
+    """EXECUTE of the prepared statement with placeholders of the values"""
+    return f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f'EXECUTE {name}'
+
+
+def _parameter_type(value: Any) -> Optional[str]:
+    """Type of the literal psycopg2 makes of the value, unknown is inferred from the query like for a literal"""
+    if value is None or isinstance(value, str):
+        return 'unknown'
+    if isinstance(value, list):
+        return _array_type(value)
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer' if -2 ** 31 <= value < 2 ** 31 else 'bigint' if -2 ** 63 <= value < 2 ** 63 else 'numeric'
+    if isinstance(value, (float, decimal.Decimal)):
+        return 'numeric'
+    if isinstance(value, datetime.datetime):
+        return 'timestamptz' if value.tzinfo is not None else 'timestamp'
+    if isinstance(value, datetime.date):
+        return 'date'
+    if isinstance(value, datetime.timedelta):
+        return 'interval'
+    return None
+
+
+def _array_type(values: List[Any]) -> Optional[str]:
+    """
+    Type of the ARRAY[...] psycopg2 makes of the list, the common type of its items like Postgres resolves it
+
+    An empty list is sent as an untyped '{}', None for nested lists or items of types that don't mix
+    """
+    if not values:
+        return 'unknown'
+    types = {'text' if isinstance(value, str) else _parameter_type(value) for value in values if value is not None}
+    if None in types or any(isinstance(value, list) for value in values):
+        return None
+    if not types:
+        # ARRAY[NULL, ...]
+        return 'text[]'
+    if len(types) > 1:
+        widest = [number for number in _NUMBERS if number in types]
+        if not types.issubset(_NUMBERS):
+            return None
+        types = {widest[-1]}
+    return f'{types.pop()}[]'
@@ -1,13 +1,37 @@
 # coding=utf-8
 import logging
 
-from pytest import fixture
+from pytest import fixture, importorskip
 
 from rses.src.objects import stock
+from rses_connections import db
+from rses_sqlite import SQLiteAdapter
 
 logging.basicConfig(level=logging.INFO)
 
 
+@fixture
+def kitchen():
+    """Empty kitchen in memory, used by the whole object layer for the test"""
+    adapter = SQLiteAdapter('sqlite://')
+    db.use(adapter)
+    yield adapter
+    db.configure()
+    adapter.close()
+
+
+@fixture
+def client(kitchen):
+    """Authorized client of the API over the kitchen in memory"""
+    importorskip('flask')
+    from flask_app.app import create_app
+    app = create_app(dict(RSES_WEB_CLIENT=False, TESTING=True), backend=kitchen)
+    with app.test_client() as test_client:
+        with test_client.session_transaction() as session:
+            session['authorized'] = True
+        yield test_client
+
+
 @fixture(params=['D_4.i-R;Y', 'Mléčné výrobky'])
 def ingredient_type_name(request):
     return request.param
@@ -0,0 +1,18 @@
+# coding=utf-8
+from pytest import approx
+
+from rses.src.objects.forecasting import smooth, Forecast
+
+
+def test_smooth_constant():
+    assert smooth([2.0] * 30, 0.1) == approx(2.0)
+    assert smooth([], 0.1) == 0.0
+
+
+def test_smooth_follows_recent():
+    assert smooth([0.0] * 20 + [3.0] * 20, 0.3) > smooth([3.0] * 20 + [0.0] * 20, 0.3)
+
+
+def test_buy_within():
+    assert Forecast(1, 'Milk', 0.5, 3.0, 4.0, None).buy_within == 4.0
+    assert Forecast(1, 'Milk', 0.5, 3.0, 4.0, 2.0).buy_within == 2.0
@@ -0,0 +1,83 @@
+# coding=utf-8
+import io
+
+from rses.src.objects import importing, stock
+
+
+def test_read_jsonl():
+    stream = io.StringIO('{"name": "Pancakes", "portions": 4, "ingredients": {"Flour": 250}}\n'
+                         '\n'
+                         '{"name": "Tea", "portions": 1, "ingredients": [{"name": "Water", "amount": 0.3}]}\n')
+    records = list(importing.read_jsonl(stream))
+    assert [record['name'] for record in records] == ['Pancakes', 'Tea']
+    assert list(importing._ingredients(records[0])) == [('Flour', 250)]
+    assert list(importing._ingredients(records[1])) == [('Water', 0.3)]
+
+
+def test_read_csv():
+    stream = io.StringIO('name,portions,ingredients,categories\n'
+                         'Pancakes,4,Flour:250;Milk: 0.5,Sweet; Quick\n'
+                         'Water,1,,\n')
+    pancakes, water = importing.read_csv(stream)
+    assert pancakes['ingredients'] == {'Flour': 250.0, 'Milk': 0.5}
+    assert pancakes['categories'] == ['Sweet', 'Quick']
+    assert water['ingredients'] == {}
+    assert water['categories'] == []
+
+
+def test_read_jsonl_skips_malformed_lines():
+    stream = io.StringIO('{"name": "Pancakes", "portions": 4}\n'
+                         '{"name": "Tea", "portions": 1\n'
+                         '\n'
+                         '["Soup"]\n'
+                         '{"name": "Goulash", "portions": 6}\n')
+    report = importing.ImportReport()
+    records = list(importing.read_jsonl(stream, report))
+    assert [record['name'] for record in records] == ['Pancakes', 'Goulash']
+    assert (report.read, report.invalid, report.invalid_lines) == (2, 2, [2, 4])
+
+
+def test_read_csv_skips_malformed_amounts():
+    stream = io.StringIO('name,portions,ingredients,categories\n'
+                         'Pancakes,4,Flour:a lot;Milk:0.5,Sweet\n'
+                         'Tea,1,Water:0.3,\n'
+                         'Soup,2,Water,\n')
+    report = importing.ImportReport()
+    tea, = importing.read_csv(stream, report)
+    assert tea['ingredients'] == {'Water': 0.3}
+    assert (report.read, report.invalid, report.invalid_lines) == (2, 2, [2, 4])
+    assert report.json_dict['invalid_lines'] == [2, 4]
+
+
+def test_read_stock_csv():
+    stream = io.StringIO('ingredient,amount,price,time_bought,expiration_date\n'
+                         'Flour,1000,25.9,2017-05-17T18:30:00,\n')
+    flour, = importing.read_stock_csv(stream)
+    assert flour['ingredient'] == 'Flour'
+    assert flour['amount'] == '1000'
+    assert flour['expiration_date'] is None
+
+
+def test_ingest_stock_malformed_amounts():
+    records = [dict(ingredient='Flour', amount='a lot'), dict(ingredient='Flour', amount=[1000]),
+               dict(ingredient='Flour', amount='-1')]
+    report = importing.StockIngester().ingest_records(records)
+    assert (report.read, report.created, report.invalid) == (3, 0, 3)
+
+
+def test_ingest_stock(ingredient_type, ingredient_no_create, ingredient_unit, positive_int):
+    ingredient = stock.Ingredient(name=ingredient_no_create, unit=ingredient_unit, ingredient_type=ingredient_type,
+                                  suggestion_threshold=0, rebuy_threshold=0, durability=positive_int)
+    records = [
+        dict(ingredient=ingredient_no_create, amount=2, price=10, time_bought='2017-05-17T18:30:00'),
+        dict(ingredient=ingredient_no_create, amount=3),
+        dict(ingredient='Certainly not an ingredient', amount=1),
+        dict(ingredient=ingredient_no_create, amount=0),
+        dict(ingredient=ingredient_no_create, amount='a lot'),
+    ]
+    report = importing.StockIngester(chunk_size=2).ingest_records(records)
+    assert report.read == 5
+    assert report.created == 2
+    assert report.invalid == 3
+    assert report.missing_ingredients == {'Certainly not an ingredient'}
+    assert ingredient.in_stock == 5
@@ -0,0 +1,27 @@
+# coding=utf-8
+import datetime
+
+from rses.src.objects import importing, ledger, stock
+
+
+def test_ledger_point_in_time(ingredient_type, ingredient_no_create, ingredient_unit):
+    ingredient = stock.Ingredient(name=ingredient_no_create, unit=ingredient_unit, ingredient_type=ingredient_type)
+    bought = datetime.datetime(2018, 1, 1, 12)
+    importing.StockIngester().ingest_records([dict(ingredient=ingredient_no_create, amount=5, time_bought=bought)])
+    before_snapshot = ledger.StockLedger.snapshot()
+    ingredient.remove_stock(2)
+
+    assert ledger.StockLedger.stock_at(bought - datetime.timedelta(days=1), ingredient.id) == {}
+    assert ledger.StockLedger.stock_at(bought, ingredient.id) == {ingredient.id: 5}
+    assert ledger.StockLedger.stock_at(before_snapshot, ingredient.id) == {ingredient.id: 5}
+    movements = ledger.StockLedger.history(ingredient.id)
+    assert [(movement.movement, movement.amount) for movement in movements] == [
+        (ledger.ADJUST, -2), (ledger.PURCHASE, 5)
+    ]
+    # Times of the database clock, the one the ledger is written with
+    removed = movements[0].time
+    assert ledger.StockLedger.stock_at(removed, ingredient.id) == {ingredient.id: 3}
+    assert [movement.amount for movement in ledger.StockLedger.history(ingredient.id, since=removed)] == [-2]
+    assert [movement.amount for movement in ledger.StockLedger.history(ingredient.id, until=before_snapshot)] == [5]
+    assert ledger.StockLedger.snapshot() > before_snapshot
+    assert ledger.StockLedger.stock_at(removed, ingredient.id) == {ingredient.id: 3}
@@ -0,0 +1,56 @@
+# coding=utf-8
+import time
+
+from rses_connections import DatabaseAdapter
+from rses_invalidation import EVERYTHING, InvalidationBus, entity_key, table_of
+
+COUNT_TYPES = 'SELECT count(*) AS total FROM ingredient_type'
+
+
+def worker():
+    """Adapter with its own query cache and bus, like a worker process of the server"""
+    adapter = DatabaseAdapter(cache_bytes=100000)
+    worker_bus = InvalidationBus(adapter, enabled=True, poll_timeout=0.1)
+    worker_bus.subscribe(lambda key: adapter.cache.clear() if key == EVERYTHING
+                         else adapter.cache.invalidate([table_of(key)]))
+    return adapter, worker_bus
+
+
+def wait_for(condition, seconds: float = 5.0) -> bool:
+    deadline = time.monotonic() + seconds
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_write_of_one_worker_evicts_the_cache_of_another(ingredient_type_new_name):
+    writer, writer_bus = worker()
+    reader, reader_bus = worker()
+    received = list()
+    reader_bus.subscribe(received.append)
+    reader_bus.start()
+    try:
+        # Starting to listen evicts everything, as anything published before could have been missed
+        assert wait_for(lambda: EVERYTHING in received)
+        total = reader.select(COUNT_TYPES, cache=True).total
+        hits = reader.cache.hits
+        assert reader.select(COUNT_TYPES, cache=True).total == total
+        assert reader.cache.hits == hits + 1
+
+        def create(cur):
+            cur.execute('INSERT INTO ingredient_type (name) VALUES (%s) RETURNING id', (ingredient_type_new_name,))
+            return cur.fetchone().id
+
+        key = entity_key('ingredient_type', writer.run_transaction(create))
+        writer_bus.publish(key)
+        # Comes through the listener thread of the reader, its cache knows nothing of the write otherwise
+        assert wait_for(lambda: key in received)
+        assert len(reader.cache) == 0
+        assert reader.select(COUNT_TYPES, cache=True).total == total + 1
+    finally:
+        reader_bus.stop()
+        for adapter in (writer, reader):
+            if adapter.pool is not None:
+                adapter.pool.close()
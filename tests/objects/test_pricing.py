@@ -0,0 +1,15 @@
+# coding=utf-8
+from pytest import approx
+
+from rses.src.objects import pricing, stock
+from rses_connections import db
+
+
+def test_record_prices_repeatedly(ingredient_type, ingredient_no_create, ingredient_unit):
+    ingredient = stock.Ingredient(name=ingredient_no_create, unit=ingredient_unit, ingredient_type=ingredient_type)
+    # Prepared on the second run of the same queries on a connection, run as prepared from the third
+    for price in (2.0, 4.0, 3.0):
+        db.run_transaction(lambda cur: pricing.record_prices(cur, {ingredient.id: [price]}))
+    check = pricing.DealDetector().check(ingredient.id, 3.0)
+    assert check.purchases == 3
+    assert check.median == approx(3.0)
@@ -0,0 +1,16 @@
+# coding=utf-8
+from rses.src.objects import stock
+from rses.src.objects.projections import IngredientRow
+
+
+def test_ingredient_row_matches_active_record(ingredient_type, ingredient_no_create, ingredient_unit):
+    ingredient = stock.Ingredient(name=ingredient_no_create, unit=ingredient_unit, ingredient_type=ingredient_type)
+    row = IngredientRow(ingredient.id, ingredient.name, ingredient.unit, ingredient_type.id, ingredient_type.name,
+                        ingredient.suggestion_threshold, ingredient.rebuy_threshold, ingredient.durability)
+    assert row.json_dict == ingredient.json_dict
+
+
+def test_ingredient_listing_filters_by_type_name(ingredient_type, ingredient_no_create, ingredient_unit):
+    stock.Ingredient(name=ingredient_no_create, unit=ingredient_unit, ingredient_type=ingredient_type)
+    listing = stock.IngredientListing.show(wanted_filters=dict(ingredient_type=ingredient_type.name.lower()))
+    assert ingredient_no_create in [item['name'] for item in listing]
@@ -0,0 +1,21 @@
+# coding=utf-8
+from rses_connections import db
+from rses_migrations import discover
+
+# Versions adding what database/create.sql created itself before it was kept at version 0
+FROM_CREATE_SQL = range(3, 8)
+
+
+def test_migrations_run_again_on_a_database_created_with_their_schema():
+    """Databases created by an older create.sql already have what these migrations add"""
+    with db.pooled() as conn:
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                for migration in discover():
+                    if migration.version in FROM_CREATE_SQL:
+                        assert migration.transactional
+                        cur.execute(migration.sql)
+        finally:
+            conn.rollback()
+            conn.autocommit = True
@@ -1,7 +1,10 @@
 # coding=utf-8
+import threading
+
 from pytest import raises
 
-from rses.src.objects import stock
+from rses.src.objects import importing, stock
+from rses_connections import db
 import rses_errors
 
 
@@ -49,3 +52,69 @@ def test_ingredient_create(ingredient_type,
     assert ingredient.suggestion_threshold == positive_float
     assert ingredient.rebuy_threshold == positive_float2
     assert ingredient.durability == positive_int
+
+
+def test_ingredient_deferred_save(ingredient_type,
+                                  ingredient_no_create,
+                                  ingredient_unit,
+                                  positive_float,
+                                  positive_int):
+    ingredient = stock.Ingredient(name=ingredient_no_create,
+                                  unit=ingredient_unit,
+                                  ingredient_type=ingredient_type)
+    with ingredient.deferred():
+        ingredient.suggestion_threshold = positive_float
+        ingredient.durability = positive_int
+        assert ingredient.dirty == dict(suggestion_threshold=positive_float, durability=positive_int)
+        assert stock.Ingredient(ingredient_id=ingredient.id).durability is None
+    assert not ingredient.dirty
+    loaded = stock.Ingredient(ingredient_id=ingredient.id)
+    assert loaded.suggestion_threshold == positive_float
+    assert loaded.durability == positive_int
+
+
+def test_ingredient_type_create_duplicate(ingredient_type):
+    with raises(rses_errors.AlreadyExists):
+        stock.IngredientType(name=ingredient_type.name)
+
+
+def test_ingredient_type_get_or_create(ingredient_type_no_create):
+    created = stock.IngredientType.get_or_create(ingredient_type_no_create)
+    loaded = stock.IngredientType.get_or_create(ingredient_type_no_create)
+    assert created.id
+    assert created == loaded
+
+
+def test_concurrent_reservations_of_the_last_lot(ingredient_type, ingredient_no_create, ingredient_unit):
+    """The second reservation waits for the lock of the first and then sees the lot is gone"""
+    ingredient = stock.Ingredient(name=ingredient_no_create, unit=ingredient_unit, ingredient_type=ingredient_type)
+    importing.StockIngester().ingest_records([dict(ingredient=ingredient_no_create, amount=4)])
+    first_locked, first_may_commit = threading.Event(), threading.Event()
+    second_done = threading.Event()
+    outcomes = dict()
+
+    def hold(cur):
+        stock.StockReservation({ingredient.id: 3}).take(cur)
+        first_locked.set()
+        assert first_may_commit.wait(10)
+
+    def reserve(name, work):
+        try:
+            db.run_transaction(work)
+            outcomes[name] = 'taken'
+        except rses_errors.NotEnoughIngredients:
+            outcomes[name] = 'missing'
+
+    first = threading.Thread(target=reserve, args=('first', hold))
+    second = threading.Thread(target=lambda: (reserve('second', stock.StockReservation({ingredient.id: 3}).take),
+                                              second_done.set()))
+    first.start()
+    assert first_locked.wait(10)
+    second.start()
+    # Waits for the lot locked by the uncommitted first reservation
+    assert not second_done.wait(0.5)
+    first_may_commit.set()
+    first.join(10)
+    second.join(10)
+    assert outcomes == dict(first='taken', second='missing')
+    assert ingredient.in_stock == 1
@@ -0,0 +1,86 @@
+# coding=utf-8
+import importlib
+
+import pytest
+
+pytest.importorskip('flask')
+
+import rses_config
+from objects.cooking import RecipeSearch
+from objects.shopping import ShoppingItem
+from objects.stock import Ingredient, IngredientType
+
+
+@pytest.fixture
+def milk(kitchen):
+    return Ingredient(name='milk', unit='l', ingredient_type=IngredientType(name='dairy'))
+
+
+def test_ingredient_change(client, milk):
+    response = client.post(f'/rses/api/ingredient/{milk.id}/change', json=dict(unit='ml', durability=5))
+    assert response.status_code == 200
+    loaded = Ingredient(ingredient_id=milk.id)
+    assert (loaded.unit, loaded.durability) == ('ml', 5)
+
+
+@pytest.mark.parametrize('change', [dict(_dirty=dict(name='x')), dict(_id=2), dict(average_price=1), 'milk'])
+def test_ingredient_change_refuses_other_keys(client, milk, change):
+    response = client.post(f'/rses/api/ingredient/{milk.id}/change', json=change)
+    assert response.status_code == 400
+    assert Ingredient(ingredient_id=milk.id).name == 'milk'
+
+
+@pytest.fixture
+def searched(kitchen, monkeypatch):
+    """Queries and arguments of searches, full text search needs Postgres"""
+    searches = list()
+
+    def select_all(query, *args):
+        searches.append((query, args))
+        return list()
+
+    monkeypatch.setattr(kitchen, 'select_all', select_all)
+    return searches
+
+
+def test_search_with_categories(client, searched):
+    response = client.get('/rses/api/search/recipe/10/0?q=soup&category=3&category=5&cookable=true')
+    assert response.status_code == 200
+    assert response.get_json()['total'] == 0
+    query, args = searched[0]
+    assert args[-6:] == ([3, 5], [3, 5], [3, 5], True, 10, 0)
+
+
+@pytest.mark.parametrize('arguments', ['q=soup&category=abc', 'q=soup&category=3&category=', 'category=3'])
+def test_search_refuses_bad_arguments(client, searched, arguments):
+    assert client.get(f'/rses/api/search/recipe/10/0?{arguments}').status_code == 400
+    assert searched == []
+
+
+def test_search_in_every_language(searched):
+    RecipeSearch(['simple', 'english', 'german']).show('knödel')
+    query, args = searched[0]
+    assert query.count('websearch_to_tsquery') == 3
+    assert args[:6] == ('simple', 'knödel', 'english', 'knödel', 'german', 'knödel')
+
+
+def test_search_languages_configuration(monkeypatch):
+    try:
+        monkeypatch.setenv('RSES_SEARCH_LANGUAGES', ' english, ,simple ,')
+        assert importlib.reload(rses_config).RSES_SEARCH_LANGUAGES == ['english', 'simple']
+        monkeypatch.setenv('RSES_SEARCH_LANGUAGES', ' , ')
+        assert importlib.reload(rses_config).RSES_SEARCH_LANGUAGES == ['simple']
+    finally:
+        monkeypatch.undo()
+        importlib.reload(rses_config)
+
+
+def test_stock_at(client, milk):
+    item = ShoppingItem(milk.id, 2.0)
+    item.create()
+    item.purchase()
+    response = client.get('/rses/api/stock/at/2999-01-01T00:00:00')
+    assert response.status_code == 200
+    assert response.get_json()['stock'] == [dict(ingredient=milk.id, amount=2.0)]
+    assert client.get('/rses/api/stock/at/2000-01-01T00:00:00').get_json()['stock'] == []
+    assert client.get('/rses/api/stock/at/yesterday').status_code == 400
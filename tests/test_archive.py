@@ -0,0 +1,13 @@
+# coding=utf-8
+import io
+
+from rses_archive import KitchenArchive
+
+
+def test_export_restore_roundtrip(ingredient_type):
+    archive = KitchenArchive(chunk_bytes=1024)
+    stream = io.BytesIO()
+    exported = archive.export(stream)
+    assert exported['ingredient_type'] >= 1
+    stream.seek(0)
+    assert archive.restore(stream) == {table: rows for table, rows in exported.items() if rows}
@@ -0,0 +1,81 @@
+# coding=utf-8
+import asyncio
+import time
+
+import pytest
+
+import rses_async
+from rses_async import AsyncDatabaseAdapter, BackgroundLoop, _CountingCursor
+from rses_connections import queries
+from objects.shopping import ShoppingItem
+from objects.stock import Ingredient, IngredientType
+
+
+class Cursor:
+    async def execute(self, query, vars=None):
+        await asyncio.sleep(0.05)
+
+
+async def fan_out(width):
+    await asyncio.gather(*(_CountingCursor(Cursor()).execute('SELECT 1') for _ in range(width)))
+    return width
+
+
+def test_gathered_queries_run_concurrently_and_are_counted():
+    loop = BackgroundLoop(AsyncDatabaseAdapter())
+    queries.reset()
+    start = time.perf_counter()
+    assert loop.run(fan_out(10)) == 10
+    assert time.perf_counter() - start < 0.4
+    assert queries.count == 10
+    loop.stop()
+
+
+@pytest.fixture
+def async_client(kitchen, monkeypatch):
+    """Authorized client of the async API, its queries run on the kitchen in memory"""
+    pytest.importorskip('flask')
+    from flask_app.app import create_app
+
+    async def select(query, *args):
+        return kitchen.select(query, *args)
+
+    async def select_all(query, *args):
+        return kitchen.select_all(query, *args)
+
+    monkeypatch.setattr(rses_async.adb, 'select', select)
+    monkeypatch.setattr(rses_async.adb, 'select_all', select_all)
+    app = create_app(dict(RSES_WEB_CLIENT=False, RSES_ASYNC_API=True, TESTING=True), backend=kitchen)
+    with app.test_client() as test_client:
+        with test_client.session_transaction() as session:
+            session['authorized'] = True
+        yield test_client
+    rses_async.loop.stop()
+
+
+@pytest.fixture
+def dairy(kitchen):
+    dairy = IngredientType(name='dairy')
+    milk = Ingredient(name='milk', unit='l', ingredient_type=dairy, rebuy_threshold=1)
+    Ingredient(name='cheese', unit='kg', ingredient_type=dairy)
+    ShoppingItem(milk.id, 2.0).create()
+    return milk
+
+
+def test_async_listings(async_client, dairy):
+    response = async_client.get('/rses/api/async/list/ingredient/1/0')
+    assert response.status_code == 200
+    assert response.get_json()['total'] == 2
+    assert [item['name'] for item in response.get_json()['ingredients']] == ['cheese']
+    response = async_client.get('/rses/api/async/list/ingredient_type/10/0/dai')
+    assert response.get_json()['ingredient_types'][0]['name'] == 'dairy'
+    assert response.get_json()['total'] == 1
+
+
+def test_async_shopping_list(async_client, dairy):
+    response = async_client.get('/rses/api/async/shopping_list')
+    assert response.status_code == 200
+    shopping = response.get_json()
+    assert [(item['name'], item['amount']) for item in shopping['list']] == [('milk', 2.0)]
+    assert shopping['below_rebuy'] == [] and shopping['forecast'] == []
+    assert async_client.get('/rses/api/async/shopping_list?horizon=soon').status_code == 400
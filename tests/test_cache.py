@@ -0,0 +1,71 @@
+# coding=utf-8
+from rses_cache import QueryCache, tables_read, tables_written
+
+QUERY = """
+SELECT id, name
+FROM ingredient_type
+WHERE name LIKE %s
+"""
+
+
+def loader(result):
+    calls = []
+
+    def load():
+        calls.append(1)
+        return result
+    return load, calls
+
+
+def test_tables_read():
+    assert tables_read(QUERY) == {'ingredient_type'}
+    assert tables_read('SELECT i.id FROM ingredient i LEFT JOIN stock s ON i.id = s.ingredient') == \
+        {'ingredient', 'stock'}
+
+
+def test_tables_written():
+    assert tables_written('INSERT INTO stock (ingredient) VALUES (1)') == {'stock'}
+    assert tables_written('  UPDATE ingredient SET name = 1') == {'ingredient'}
+    assert tables_written('DELETE FROM shopping_list WHERE ingredient = 1') == {'shopping_list'}
+    assert tables_written('WITH created AS (INSERT INTO recipe_category (name) VALUES (1) RETURNING id) '
+                          'SELECT id FROM created') == {'recipe_category'}
+    assert not tables_written(QUERY)
+
+
+def test_hit_ignores_whitespace():
+    cache = QueryCache(10000)
+    load, calls = loader([(1, 'dairy')])
+    assert cache.get_or_load(QUERY, ('%a%',), load) == [(1, 'dairy')]
+    assert cache.get_or_load(' '.join(QUERY.split()), ('%a%',), load) == [(1, 'dairy')]
+    assert len(calls) == 1
+    cache.get_or_load(QUERY, ('%b%',), load)
+    assert len(calls) == 2
+
+
+def test_write_invalidates_with_cascades():
+    cache = QueryCache(10000)
+    load, calls = loader([(1, 'dairy')])
+    cache.get_or_load('SELECT count(*) FROM stock', (), load)
+    cache.get_or_load(QUERY, ('%a%',), load)
+    cache.invalidate_query('DELETE FROM ingredient_type WHERE id = 1')
+    assert len(cache) == 0
+    cache.get_or_load(QUERY, ('%a%',), load)
+    assert len(calls) == 3
+
+
+def test_lru_eviction_within_budget():
+    cache = QueryCache(1000)
+    for i in range(50):
+        cache.get_or_load(QUERY, (i,), lambda: [(i, 'x' * 20)])
+    assert 0 < cache.size <= 1000
+    assert len(cache) < 50
+
+
+def test_no_stale_store_during_write():
+    cache = QueryCache(10000)
+
+    def load():
+        cache.invalidate(['ingredient_type'])
+        return [(1, 'old')]
+    cache.get_or_load(QUERY, (), load)
+    assert len(cache) == 0
@@ -0,0 +1,101 @@
+# coding=utf-8
+import threading
+import time
+
+import pytest
+
+from rses_config import RSES_ROUTE_BUDGETS
+from rses_connections import CountingCursor
+from rses_deadlines import Watchdog, deadline, deadlines, timeouts
+from rses_errors import QueryTimeout
+
+
+class Connection:
+    """Tells when it was cancelled"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class Cursor:
+    """Runs a statement taking the seconds, unless its connection is cancelled before"""
+
+    def __init__(self, seconds=0.0):
+        self.connection = Connection()
+        self.seconds = seconds
+
+    def execute(self, query, vars=None):
+        if self.connection.cancelled.wait(self.seconds):
+            import psycopg2.extensions
+            raise psycopg2.extensions.QueryCanceledError('canceling statement due to user request')
+
+
+def test_tightest_deadline_applies():
+    assert deadlines.remaining() is None
+    with deadline(10, 'route'):
+        with deadline(0.5):
+            assert deadlines.tightest().name == 'call'
+            assert 0 < deadlines.remaining() <= 0.5
+        with deadline(60, 'loose'):
+            assert deadlines.tightest().name == 'route'
+    assert deadlines.tightest() is None
+
+
+def test_watchdog_cancels_only_late_queries():
+    watchdog = Watchdog()
+    late, finished = Connection(), Connection()
+    watchdog.watch(late, 0.05)
+    watchdog.unwatch(watchdog.watch(finished, 0.05))
+    assert late.cancelled.wait(2)
+    time.sleep(0.1)
+    assert not finished.cancelled.is_set()
+
+
+def test_query_past_the_deadline_times_out():
+    before = timeouts['call']
+    with deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(QueryTimeout) as error:
+            CountingCursor(Cursor()).execute('SELECT 1')
+    assert (error.value.budget, error.value.name) == (0.01, 'call')
+    assert timeouts['call'] == before + 1
+
+
+def test_statement_over_the_deadline_is_cancelled():
+    pytest.importorskip('psycopg2')
+    cursor = Cursor(seconds=5)
+    start = time.monotonic()
+    with deadline(0.05, 'slow'):
+        with pytest.raises(QueryTimeout) as error:
+            CountingCursor(cursor).execute('SELECT pg_sleep(5)')
+    assert time.monotonic() - start < 2
+    assert cursor.connection.cancelled.is_set()
+    assert error.value.name == 'slow'
+
+
+def test_route_over_its_budget_is_unavailable(client, kitchen, monkeypatch):
+    def slow_select_all(query, *args, **kwargs):
+        time.sleep(0.1)
+        return CountingCursor(Cursor()).execute(query, args)
+
+    monkeypatch.setitem(RSES_ROUTE_BUDGETS, 'list_ingredient_types', 0.05)
+    monkeypatch.setattr(kitchen, 'select_all', slow_select_all)
+    response = client.get('/rses/api/list/ingredient_type/10/0')
+    assert response.status_code == 503
+    assert response.get_json()['error'] == 'timeout'
+    assert response.get_json()['budget'] == 0.05
+    assert 'Retry-After' in response.headers
+    assert deadlines.tightest() is None
+
+
+def test_imports_have_no_budget_by_default(client, kitchen, monkeypatch):
+    opened = list()
+    monkeypatch.setattr(deadlines, 'push', lambda budget, name: opened.append(name))
+    client.get('/rses/api/list/ingredient_type/10/0')
+    assert opened == ['list_ingredient_types']
+    response = client.post('/rses/api/import/stock', data='')
+    assert response.status_code == 201
+    assert opened == ['list_ingredient_types']
@@ -0,0 +1,42 @@
+# coding=utf-8
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+SRC = os.path.join(ROOT, 'rses', 'src')
+# Cumulative import time of the module, in microseconds - generous, so a slow CI machine passes
+BUDGET_US = 300000
+
+
+def import_times(statement):
+    """Cumulative import time of every module imported by the statement in a fresh interpreter"""
+    env = dict(os.environ, PYTHONPATH=SRC)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], env=env, cwd=ROOT,
+                            stderr=subprocess.PIPE, check=True)
+    times = dict()
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime is new in Python 3.7')
+
+
+@pytest.mark.parametrize('module', ['rses_cli', 'objects.stock', 'objects.cooking', 'rses_connections'])
+def test_import_does_not_load_the_driver_or_flask(module):
+    times = import_times(f'import {module}')
+    assert 'psycopg2' not in times
+    assert 'flask' not in times
+    assert times[module] < BUDGET_US
+
+
+def test_package_loads_blueprints_on_demand():
+    times = import_times('import rses.src')
+    assert 'flask' not in times
+    assert 'flask_app.blueprints.api.api' not in times
@@ -0,0 +1,60 @@
+# coding=utf-8
+import pytest
+
+from rses_connections import db
+from rses_invalidation import EVERYTHING, InvalidationBus, _payloads, _MAX_PAYLOAD, bus, entity_key, table_of
+from rses_sqlite import SQLiteAdapter
+from objects.stock import IngredientListing
+
+
+@pytest.fixture
+def cached_kitchen():
+    adapter = SQLiteAdapter('sqlite://', cache_bytes=100000)
+    db.use(adapter)
+    yield adapter
+    db.configure()
+    adapter.close()
+
+
+def test_entity_keys():
+    assert entity_key('ingredient', 5) == 'ingredient:5'
+    assert entity_key('stock') == 'stock'
+    assert table_of('ingredient:5') == table_of('ingredient') == 'ingredient'
+
+
+def test_payloads_fit_a_notification():
+    keys = [entity_key('stock', identifier) for identifier in range(2000)]
+    payloads = _payloads(keys)
+    assert len(payloads) > 1
+    assert all(len(payload) <= _MAX_PAYLOAD for payload in payloads)
+    assert ' '.join(payloads).split() == keys
+
+
+def test_disabled_bus_dispatches_locally():
+    received = []
+
+    def failing(key):
+        raise RuntimeError(key)
+
+    local = InvalidationBus(adapter=None, enabled=False)
+    local.subscribe(failing)
+    local.subscribe(received.append)
+    local.publish(entity_key('ingredient', 1), entity_key('stock'))
+    local.start()
+    assert received == ['ingredient:1', 'stock']
+    assert not local.listening
+
+
+def test_published_keys_evict_the_query_cache(cached_kitchen):
+    IngredientListing().total
+    hits = cached_kitchen.cache.hits
+    IngredientListing().total
+    assert cached_kitchen.cache.hits == hits + 1
+    bus.publish(entity_key('ingredient', 1))
+    IngredientListing().total
+    assert cached_kitchen.cache.hits == hits + 1
+    IngredientListing().total
+    bus.publish(EVERYTHING)
+    misses = cached_kitchen.cache.misses
+    IngredientListing().total
+    assert cached_kitchen.cache.misses == misses + 1
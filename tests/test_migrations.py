@@ -0,0 +1,83 @@
+# coding=utf-8
+import contextlib
+from collections import namedtuple
+
+import pytest
+
+from rses_migrations import Migrator, discover
+
+Valid = namedtuple('Valid', 'valid')
+
+
+class Cursor:
+    """Runs nothing, tells the index is valid only after it was dropped and built `builds_to_valid` times"""
+
+    def __init__(self, builds_to_valid):
+        self.executed = list()
+        self.builds_to_valid = builds_to_valid
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, vars=None):
+        self.executed.append(' '.join(query.split()))
+        if 'indisvalid' in query:
+            built = sum('CREATE INDEX' in statement for statement in self.executed)
+            self.result = Valid(built > self.builds_to_valid)
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return []
+
+
+class Adapter:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @contextlib.contextmanager
+    def pooled(self):
+        yield self
+
+    def cursor(self):
+        return self._cursor
+
+
+@pytest.fixture
+def index_migration(tmp_path):
+    script = '-- rses: no-transaction\n-- An index\n' \
+             'CREATE INDEX CONCURRENTLY IF NOT EXISTS stock_idx ON stock (ingredient);\n'
+    (tmp_path / '0001_index.sql').write_text(script)
+    return str(tmp_path)
+
+
+def test_discover(index_migration):
+    migration, = discover(index_migration)
+    assert (migration.version, migration.name, migration.transactional) == (1, 'index', False)
+    statement, = migration.statements
+    assert statement.endswith('CREATE INDEX CONCURRENTLY IF NOT EXISTS stock_idx ON stock (ingredient)')
+
+
+def test_valid_index_is_kept(index_migration):
+    cursor = Cursor(builds_to_valid=0)
+    Migrator(Adapter(cursor), index_migration).migrate()
+    assert not any(statement.startswith('DROP INDEX') for statement in cursor.executed)
+
+
+def test_invalid_index_is_built_again(index_migration):
+    cursor = Cursor(builds_to_valid=1)
+    assert [migration.version for migration in Migrator(Adapter(cursor), index_migration).migrate()] == [1]
+    assert 'DROP INDEX CONCURRENTLY IF EXISTS stock_idx' in cursor.executed
+    assert sum('CREATE INDEX' in statement for statement in cursor.executed) == 2
+
+
+def test_index_invalid_again_fails(index_migration):
+    cursor = Cursor(builds_to_valid=2)
+    with pytest.raises(RuntimeError):
+        Migrator(Adapter(cursor), index_migration).migrate()
+    assert not any(statement.startswith('INSERT INTO schema_migration') for statement in cursor.executed)
@@ -0,0 +1,57 @@
+# coding=utf-8
+import pytest
+
+from rses_connections import db
+from objects.planning import MealPlan, MealPlanner, PlannedMeal
+from objects.shopping import ShoppingItem
+from objects.stock import Ingredient, IngredientType
+
+MILK, CREAM, OATS = 1, 2, 3
+
+
+@pytest.fixture
+def planner(monkeypatch):
+    """Planner over a pantry with milk about to expire, cream for a month and no oats"""
+    planner = MealPlanner(expiry_days=3)
+
+    def load():
+        planner._recipes.update({10: 'porridge', 20: 'custard', 30: 'muesli'})
+        for recipe, ingredient, per_portion in ((10, MILK, 0.5), (20, CREAM, 0.25), (30, OATS, 0.1), (30, MILK, 0.2)):
+            planner._needs[recipe].append((ingredient, per_portion))
+            planner._used_by[ingredient].append(recipe)
+        planner._lots[MILK].append([1, 1.0])
+        planner._lots[CREAM].append([30, 1.0])
+        planner._prices = {MILK: 2.0, CREAM: 8.0, OATS: 4.0}
+        planner._default_price = 1.0
+
+    monkeypatch.setattr(planner, '_MealPlanner__load', load)
+    return planner
+
+
+def test_plan_rescues_what_expires(planner):
+    plan = planner.plan(1, 2)
+    assert [meal.name for meal in plan.meals] == ['porridge']
+    assert plan.meals[0].rescued > 0 and plan.cost == 0.0
+    assert plan.shopping == {}
+
+
+def test_plan_shops_for_what_is_missing(planner):
+    plan = planner.plan(3, 4)
+    # Custard costs nothing, muesli rescues most of the milk for little, porridge gets what is left of it
+    assert [meal.name for meal in plan.meals] == ['custard', 'muesli', 'porridge']
+    assert plan.shopping == {MILK: pytest.approx(1.8), OATS: pytest.approx(0.4)}
+    assert plan.cost == pytest.approx(1.6 + 3.6)
+
+
+def test_push_is_idempotent(kitchen):
+    milk = Ingredient(name='milk', unit='l', ingredient_type=IngredientType(name='dairy'))
+    plan = MealPlan([PlannedMeal(1, 'porridge', 2, 2.0, 0.0)], {milk.id: 1.0})
+    query = 'SELECT wanted_amount FROM shopping_list WHERE ingredient = %s'
+    plan.push_to_shopping_list()
+    assert db.select(query, milk.id).wanted_amount == 1.0
+    plan.push_to_shopping_list()
+    assert db.select(query, milk.id).wanted_amount == 1.0
+    db.delete('DELETE FROM shopping_list WHERE ingredient = %s', milk.id)
+    ShoppingItem(milk.id, 3.0).create()
+    plan.push_to_shopping_list()
+    assert db.select(query, milk.id).wanted_amount == 3.0
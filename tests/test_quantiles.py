@@ -0,0 +1,49 @@
+# coding=utf-8
+import json
+import math
+import random
+
+from pytest import approx
+
+from rses_quantiles import TDigest
+
+
+def digest_of(values):
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+    return digest
+
+
+def test_empty():
+    digest = TDigest()
+    assert math.isnan(digest.cdf(1.0))
+    assert math.isnan(digest.quantile(0.5))
+
+
+def test_quantiles_close_to_exact():
+    rng = random.Random(42)
+    values = [rng.lognormvariate(3, 0.5) for _ in range(20000)]
+    digest = digest_of(values)
+    values.sort()
+    for q in (0.01, 0.1, 0.5, 0.9, 0.99):
+        exact = values[int(q * len(values))]
+        assert digest.cdf(exact) == approx(q, abs=0.005)
+    assert len(digest.centroids) < 500
+
+
+def test_moments():
+    digest = digest_of([1.0, 2.0, 3.0, 4.0])
+    assert digest.mean == approx(2.5)
+    assert digest.variance == approx(1.25)
+    assert digest.cdf(0.5) == 0.0
+    assert digest.cdf(4.0) == 1.0
+
+
+def test_json_roundtrip():
+    digest = digest_of(range(1000))
+    restored = TDigest.from_json_dict(json.loads(json.dumps(digest.json_dict)))
+    assert restored.cdf(250) == digest.cdf(250)
+    assert restored.quantile(0.5) == digest.quantile(0.5)
+    restored.add(5000)
+    assert restored.maximum == 5000
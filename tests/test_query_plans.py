@@ -0,0 +1,54 @@
+# coding=utf-8
+"""
+Hot queries have to be planned with an index on the tables that grow with the history of the kitchen
+
+Sequential scans are turned off for the check, so a query that can't use an index plans one anyway while any query
+that can is planned with it. That is what the planner picks at benchmark scale (`benchmarks/generate.py`), but does
+not need the data - on a few rows it would scan sequentially just because it is cheaper.
+"""
+import datetime
+import json
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+from objects.forecasting import ConsumptionForecaster
+from objects.stock import Ingredient, StockReservation
+from rses_connections import db
+
+# Tables with many rows at benchmark scale
+LARGE_TABLES = {'stock', 'recipe_ingredients', 'recipe_made', 'stock_ledger'}
+# Registered hot queries with arguments to plan them with
+HOT_QUERIES = dict(
+    average_price=(Ingredient.QUERY_AVERAGE_PRICE, (1,)),
+    in_stock=(Ingredient.QUERY_IN_STOCK, (1,)),
+    reserve_stock=(StockReservation.QUERY_LOCK, ([1, 2, 3],)),
+    stock_rates=(ConsumptionForecaster.QUERY_STOCK_RATES, (datetime.date(2018, 1, 1), datetime.date(2017, 10, 1))),
+    # What deleting an ingredient or a recipe cascades to
+    recipes_of_ingredient=('SELECT recipe FROM recipe_ingredients WHERE ingredient = %s', (1,)),
+    recipe_history=('SELECT time_made FROM recipe_made WHERE recipe = %s ORDER BY time_made DESC', (1,)),
+)
+
+
+def sequential_scans(plan: dict):
+    """Tables the plan and its subplans scan sequentially"""
+    if plan['Node Type'] == 'Seq Scan':
+        yield plan['Relation Name']
+    for subplan in plan.get('Plans', ()):
+        yield from sequential_scans(subplan)
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_index(name):
+    query, args = HOT_QUERIES[name]
+
+    def explain(cur):
+        cur.execute('SET LOCAL enable_seqscan = off')
+        cur.execute(f'EXPLAIN (FORMAT JSON) {query}', args)
+        plan = cur.fetchone()[0]
+        # Parsed by psycopg2 unless the server sent it as text
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    plan = db.run_transaction(explain)[0]['Plan']
+    assert not LARGE_TABLES.intersection(sequential_scans(plan)), json.dumps(plan, indent=2)
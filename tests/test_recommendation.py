@@ -0,0 +1,84 @@
+# coding=utf-8
+import datetime
+import time
+
+import pytest
+
+from rses_connections import db
+from rses_invalidation import bus
+from objects.cooking import Recipe
+from objects.recommendation import FAVOURITES, FORGOTTEN, RecipeProfile, RecipeRecommender
+from objects.shopping import ShoppingItem
+from objects.stock import Ingredient, IngredientType
+
+NOW = datetime.datetime(2018, 5, 20, 12, 0)
+
+
+def recommender_of(*profiles):
+    recommender = RecipeRecommender(half_life_days=7)
+    recommender._profiles = list(profiles)
+    recommender._loaded_at = time.monotonic()
+    return recommender
+
+
+def test_forgotten_and_favourites():
+    cooked_daily = RecipeProfile(1, 'porridge', 30, NOW - datetime.timedelta(days=1), 5.0, True, 1.0)
+    cooked_long_ago = RecipeProfile(2, 'goulash', 2, NOW - datetime.timedelta(days=60), 2.0, True, 1.0)
+    never_cooked = RecipeProfile(3, 'soup', 0, None, 0.0, True, 1.0)
+    recommender = recommender_of(cooked_daily, cooked_long_ago, never_cooked)
+    forgotten = [recommendation.profile.name for recommendation in recommender.recommend(FORGOTTEN, now=NOW)]
+    assert forgotten == ['soup', 'goulash', 'porridge']
+    favourites = recommender.recommend(FAVOURITES, limit=1, now=NOW)
+    assert [recommendation.profile.name for recommendation in favourites] == ['porridge']
+    with pytest.raises(ValueError):
+        recommender.recommend('random')
+
+
+def test_cookable_and_cheap_preferred():
+    expensive = RecipeProfile(1, 'steak', 0, None, 0.0, True, 10.0)
+    cheap = RecipeProfile(2, 'porridge', 0, None, 0.0, True, 1.0)
+    missing = RecipeProfile(3, 'soup', 0, None, 0.0, False, 1.0)
+    recommender = recommender_of(expensive, cheap, missing)
+    recommendations = recommender.recommend(now=NOW)
+    assert [recommendation.profile.name for recommendation in recommendations] == ['porridge', 'steak', 'soup']
+    assert recommendations[0].score == pytest.approx(1.0 - 0.15 * 0.1)
+    assert [recommendation.profile.name for recommendation in recommender.recommend(cookable_only=True, now=NOW)] \
+        == ['porridge', 'steak']
+
+
+def test_stats_of_cooking(kitchen, monkeypatch):
+    milk = Ingredient(name='milk', unit='l', ingredient_type=IngredientType(name='dairy'))
+    item = ShoppingItem(milk.id, 3.0)
+    item.create()
+    item.purchase()
+    porridge = Recipe(name='porridge', directions='Boil the oats in milk', portions=2)
+    porridge.add_ingredient(milk, 0.5)
+    porridge.cook()
+    porridge.cook()
+    query = 'SELECT times_cooked, frequency FROM recipe_stats WHERE recipe = %s'
+    cooked = db.select(query, porridge.id)
+    assert cooked.times_cooked == 2 and 1.0 < cooked.frequency <= 2.0
+    received = list()
+    monkeypatch.setattr(bus, '_handlers', [received.append])
+    RecipeRecommender(half_life_days=7).rebuild_stats()
+    assert received == ['recipe_stats']
+    rebuilt = db.select(query, porridge.id)
+    assert rebuilt.times_cooked == 2 and rebuilt.frequency == pytest.approx(cooked.frequency, abs=0.01)
+
+
+def test_invalidated_while_loading():
+    recommender = RecipeRecommender()
+    cooked = RecipeProfile(1, 'porridge', 1, NOW, 1.0, True, 1.0)
+
+    def load_during_a_write():
+        recommender.invalidate('recipe_made:1')
+        return [cooked]
+
+    recommender._RecipeRecommender__load_profiles = load_during_a_write
+    assert recommender.profiles == [cooked]
+    # Loaded before the write committed, so loaded again next time
+    assert recommender._profiles is None
+    recommender._RecipeRecommender__load_profiles = lambda: []
+    assert recommender.profiles == []
+    recommender._RecipeRecommender__load_profiles = lambda: [cooked]
+    assert recommender.profiles == []
@@ -0,0 +1,39 @@
+# coding=utf-8
+import datetime
+
+import pytest
+
+import rses_errors
+from rses_connections import db
+from objects.shopping import ShoppingItem
+from objects.stock import Ingredient, IngredientType, StockReservation
+
+
+@pytest.fixture
+def eggs(kitchen):
+    ingredient = Ingredient(name='eggs', unit='pcs', ingredient_type=IngredientType(name='dairy'))
+    for amount in (2.0, 4.0):
+        item = ShoppingItem(ingredient.id, amount)
+        item.create()
+        item.expiration_date = datetime.date.today()
+        item.purchase()
+    return ingredient
+
+
+def lots(ingredient):
+    query = 'SELECT amount_left FROM stock WHERE ingredient = %s ORDER BY time_bought, id'
+    return [row.amount_left for row in db.select_all(query, ingredient.id)]
+
+
+def test_reservation_takes_the_oldest_lots(eggs):
+    db.run_transaction(StockReservation({eggs.id: 3.0}).take)
+    assert lots(eggs) == [0.0, 3.0]
+    assert eggs.in_stock == 3.0
+
+
+def test_reservation_takes_nothing_when_missing(eggs):
+    with pytest.raises(rses_errors.NotEnoughIngredients) as error:
+        db.run_transaction(StockReservation({eggs.id: 7.0}).take)
+    assert error.value.missing == {eggs.id: 1.0}
+    assert lots(eggs) == [2.0, 4.0]
+
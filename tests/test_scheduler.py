@@ -0,0 +1,47 @@
+# coding=utf-8
+import datetime
+import threading
+
+import pytest
+
+from rses_scheduler import Cron, Every, Scheduler, parse_schedule
+
+
+def test_cron_next_after():
+    moment = datetime.datetime(2018, 5, 20, 12, 34, 56)
+    assert Cron('*/15 * * * *').next_after(moment) == datetime.datetime(2018, 5, 20, 12, 45)
+    assert Cron('30 3 * * *').next_after(moment) == datetime.datetime(2018, 5, 21, 3, 30)
+    # 20th of May 2018 is a Sunday
+    assert Cron('0 9 * * 1-5').next_after(moment) == datetime.datetime(2018, 5, 21, 9, 0)
+    assert Cron('0 0 1 * 7').next_after(moment) == datetime.datetime(2018, 5, 27, 0, 0)
+    assert Cron('@monthly').next_after(moment) == datetime.datetime(2018, 6, 1, 0, 0)
+    assert Cron('0 0 29 2 *').next_after(moment) == datetime.datetime(2020, 2, 29, 0, 0)
+    with pytest.raises(ValueError):
+        Cron('0 0 31 2 *').next_after(moment)
+    with pytest.raises(ValueError):
+        Cron('60 * * * *')
+
+
+def test_parse_schedule():
+    assert parse_schedule('15m').seconds == 900
+    assert parse_schedule('@every 2h').seconds == 7200
+    assert isinstance(parse_schedule('0 4 * * *'), Cron)
+    moment = datetime.datetime(2018, 5, 20, 12, 34, 56)
+    assert Every(60).next_after(moment) == datetime.datetime(2018, 5, 20, 12, 35)
+
+
+def test_jobs_run_without_locks_and_count_failures():
+    scheduler = Scheduler(adapter=object(), schedules=dict(off=''))
+    ran = threading.Event()
+    scheduler.add('ok', '1s', ran.set)
+    scheduler.add('failing', '1h', lambda: 1 / 0)
+    assert scheduler.add('off', '1s', ran.set) is None
+    scheduler.start()
+    try:
+        assert ran.wait(5)
+    finally:
+        scheduler.stop()
+    assert scheduler.run('failing')
+    stats = scheduler.stats
+    assert stats['ok']['runs'] >= 1 and stats['ok']['last_error'] is None
+    assert stats['failing']['failures'] == 1 and 'ZeroDivisionError' in stats['failing']['last_error']
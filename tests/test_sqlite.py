@@ -0,0 +1,97 @@
+# coding=utf-8
+import datetime
+
+import pytest
+
+from rses_sqlite import translate
+from objects.cooking import Recipe
+from objects.pricing import DealDetector
+from objects.shopping import ShoppingItem
+from objects.stock import Ingredient, IngredientListing, IngredientType
+
+
+@pytest.fixture
+def milk(kitchen):
+    return Ingredient(name='milk', unit='l', ingredient_type=IngredientType(name='dairy'))
+
+
+def buy(ingredient, amount, price):
+    item = ShoppingItem(ingredient.id, amount)
+    item.create()
+    item.current_price = price
+    item.expiration_date = datetime.date.today()
+    item.purchase()
+
+
+def test_translate_placeholders():
+    assert translate('SELECT %s, %s::INT, 5 %% 2', (1, 2)) == ('SELECT ?, ?, 5 % 2', [1, 2])
+    assert translate('SELECT %(a)s + %(b)s + %(a)s', dict(a=1, b=2)) == ('SELECT ? + ? + ?', [1, 2, 1])
+    assert translate('SELECT id FROM stock WHERE ingredient = ANY(%s)', ([3, 4],)) == \
+        ('SELECT id FROM stock WHERE ingredient IN (?, ?)', [3, 4])
+
+
+def test_translate_unnest():
+    query, parameters = translate('UPDATE stock SET amount_left = amount_left - taken.amount '
+                                  'FROM unnest(%s::INT[], %s::FLOAT[]) AS taken (id, amount)', ([1, 2], [0.5, 1.5]))
+    assert 'FROM (SELECT column1 AS id, column2 AS amount FROM (VALUES (?, ?), (?, ?))) AS taken' in query
+    assert parameters == [1, 0.5, 2, 1.5]
+    query, parameters = translate('SELECT * FROM unnest(%s::INT[]) AS taken (id)', ([],))
+    assert query == 'SELECT * FROM (SELECT NULL AS id WHERE 0) AS taken'
+    assert parameters == []
+
+
+def test_translate_dialect():
+    query, _ = translate('SELECT name FROM recipe WHERE name ILIKE %s FOR UPDATE SKIP LOCKED', ('a',))
+    assert query.strip() == 'SELECT name FROM recipe WHERE name LIKE ?'
+    assert 'julianday' in translate('SELECT extract(EPOCH FROM NOW() - time_made) FROM recipe_made', ())[0]
+
+
+def test_ingredients(milk):
+    assert IngredientType.load_by_name('dairy').id == milk.type.id
+    with milk.deferred():
+        milk.unit = 'ml'
+        milk.rebuy_threshold = 1.5
+    loaded = Ingredient(ingredient_id=milk.id)
+    assert (loaded.unit, loaded.rebuy_threshold) == ('ml', 1.5)
+    assert [row['name'] for row in IngredientListing.show(wanted_filters=dict(name='mil'))] == ['milk']
+    assert IngredientListing().total == 1
+
+
+def test_only_columns_of_setters_are_updated(milk):
+    milk._dirty['name = name, unit'] = 'x'
+    with pytest.raises(ValueError):
+        milk.save()
+    porridge = Recipe(name='porridge', directions='Boil the oats in milk', portions=2)
+    with pytest.raises(ValueError):
+        porridge._Recipe__updater('id', 5)
+    assert Ingredient(ingredient_id=milk.id).unit == 'l'
+    assert Recipe(recipe_id=porridge.id).name == 'porridge'
+
+
+def test_prices_of_repeated_purchases(milk):
+    buy(milk, 1.0, 2.0)
+    buy(milk, 1.0, 4.0)
+    check = DealDetector().check(milk.id, 3.0)
+    assert check.purchases == 2 and check.percentile == 50.0
+
+
+def test_stock_and_cooking(milk):
+    buy(milk, 3.0, 6.0)
+    assert milk.in_stock == 3.0
+    assert milk.average_price == 2.0
+    milk.remove_stock(1.0)
+    assert milk.in_stock == 2.0
+    porridge = Recipe(name='porridge', directions='Boil the oats in milk', portions=2)
+    porridge.add_ingredient(milk, 0.5)
+    assert porridge.can_be_cooked()
+    porridge.cook()
+    assert milk.in_stock == 1.5
+
+
+def test_failed_transaction_rolls_back(kitchen, milk):
+    def fail(cur):
+        cur.execute('DELETE FROM ingredient WHERE id = %s', (milk.id,))
+        raise RuntimeError
+    with pytest.raises(RuntimeError):
+        kitchen.run_transaction(fail)
+    assert milk.exists()
@@ -0,0 +1,98 @@
+# coding=utf-8
+import datetime
+
+import pytest
+
+import rses_statements
+from rses_statements import StatementCache, parametrize, statement_stats
+
+
+class Connection:
+    autocommit = True
+
+
+class Cursor:
+    """Records what would run on the connection"""
+    connection = Connection()
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, query, vars=None):
+        self.executed.append((query, vars))
+
+
+def test_parametrize():
+    assert parametrize('SELECT name FROM ingredient WHERE id = %s AND name LIKE %s', (3, 'milk%')) == \
+        ('SELECT name FROM ingredient WHERE id = $1 AND name LIKE $2', [3, 'milk%'], ('integer', 'unknown'))
+    when = datetime.datetime(2018, 5, 20)
+    assert parametrize('SELECT %(when)s, %(id)s::INT IS NULL OR x = %(id)s', dict(when=when, id=None)) == \
+        ('SELECT $1, $2::INT IS NULL OR x = $2', [when, None], ('timestamp', 'unknown'))
+    assert parametrize("SELECT 5 %% 2, %s", (2.5,))[0] == 'SELECT 5 % 2, $1'
+
+
+def test_parametrize_arrays():
+    query = 'SELECT * FROM unnest(%s::INT[], %s::JSONB[])'
+    assert parametrize(query, ([1, 2], ['{}', '[]']))[2] == ('integer[]', 'text[]')
+    assert parametrize(query, ([1, 2 ** 40], [None, 2.5]))[2] == ('bigint[]', 'numeric[]')
+    assert parametrize(query, ([], [None]))[2] == ('unknown', 'text[]')
+    assert parametrize(query, ([1, 'a'], [1])) is None
+    assert parametrize(query, ([[1]], [1])) is None
+
+
+def test_parametrize_refuses():
+    assert parametrize('LOCK TABLE stock', ()) is None
+    assert parametrize('SELECT 1; SELECT 2', ()) is None
+    assert parametrize('SELECT %s', (1, 2)) is None
+    assert parametrize('SELECT %s', (object(),)) is None
+
+
+def test_prepared_on_second_use_and_evicted():
+    pytest.importorskip('psycopg2')
+    cache = StatementCache(2)
+    cur = Cursor()
+    query = 'SELECT name FROM ingredient WHERE id = %s'
+    assert not cache.execute(cur, query, (1,))
+    assert cur.executed == []
+    assert cache.execute(cur, query, (2,))
+    assert cur.executed == [('PREPARE rses_0 (integer) AS SELECT name FROM ingredient WHERE id = $1', None),
+                            ('EXECUTE rses_0 (%s)', [2])]
+    assert cache.execute(cur, query, (3,))
+    assert cur.executed[-1] == ('EXECUTE rses_0 (%s)', [3])
+    cache.execute(cur, 'SELECT 1', ())
+    cache.execute(cur, 'SELECT 2', ())
+    assert cur.executed[-1] == ('DEALLOCATE rses_0', None)
+    assert len(cache) == 2
+
+
+@pytest.fixture
+def prepared():
+    """Database adapter of a single pooled connection, preparing statements"""
+    pytest.importorskip('psycopg2')
+    from rses_connections import DatabaseAdapter
+    adapter = DatabaseAdapter(pool_size=1, cache_bytes=0, prepared_statements=10)
+    yield adapter
+    adapter.pool.close()
+
+
+def test_array_arguments_run_prepared(prepared):
+    query = 'SELECT sum(amount) AS amount, count(DISTINCT note) AS notes FROM unnest(%s::INT[], %s::JSONB[]) ' \
+            'AS item (amount, note)'
+    hits = statement_stats.hits
+    for amounts in ([1, 2], [3, 4], [5, 6]):
+        assert prepared.select(query, amounts, ['{"a": 1}', '{"b": 2}']) == (sum(amounts), 2)
+    for amounts in ([1, 2], [3, 4], [5, 6]):
+        assert prepared.run_transaction(lambda cur: cur.execute(query, (amounts, ['{}', '{}'])) or cur.fetchone()) \
+            == (sum(amounts), 1)
+    assert statement_stats.hits > hits
+
+
+def test_statement_that_does_not_fit_runs_as_it_is(prepared, monkeypatch):
+    # The type arrays had before, psycopg2 sends them as ARRAY[...] of text, not as an untyped literal
+    monkeypatch.setattr(rses_statements, '_array_type', lambda values: 'unknown')
+    query = 'SELECT count(*) AS notes FROM unnest(%s::JSONB[]) AS note'
+    failed = statement_stats.failed
+    for _ in range(3):
+        assert prepared.run_transaction(lambda cur: cur.execute(query, (['{}', '[]'],)) or cur.fetchone()) == (2,)
+        assert prepared.select(query, ['{}']) == (1,)
+    assert statement_stats.failed == failed + 1